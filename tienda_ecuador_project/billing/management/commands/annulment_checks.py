@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from billing.models import Bill
+
+
+class Command(BaseCommand):
+    help = "Shows the annulment checks scheduled for the next day"
+
+    def handle(self, *args, **options):
+        stats = Bill.annulment_check_stats()
+        self.stdout.write(
+            "{comprobantes} bills pending annulment checks\n"
+            "{checks} checks in the next day, "
+            "{hourly_checks} checking every hour, "
+            "{saved} saved".format(**stats))
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from billing.models import Bill
+
+
+class Command(BaseCommand):
+    help = ("Times the XML of the bills written by sri.xml_builder "
+            "against rendering billing/proformabill_xml.html")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--bills', type=int, default=20,
+            help="Number of bills, the latest with punto de emision")
+        parser.add_argument(
+            '--repeat', type=int, default=10,
+            help="Times the XML of every bill is generated")
+
+    def handle(self, *args, **options):
+        bills = list(Bill.objects
+                     .filter(punto_emision__isnull=False)
+                     .select_related('punto_emision__establecimiento__company',
+                                     'issued_to')
+                     .order_by('-id')[:options['bills']])
+        for bill in bills:
+            # As when they are sent, without saving them
+            bill.ambiente_sri = (bill.ambiente_sri or
+                                 bill.punto_emision.ambiente_sri)
+            bill.secuencial = bill.secuencial or 1
+            # Computes the totals outside the timings
+            bill.totals
+        if not bills:
+            self.stdout.write("No bills with punto de emision")
+            return
+
+        for name, method in (('template', 'gen_unsigned_xml_from_template'),
+                             ('builder', 'gen_unsigned_xml')):
+            size = 0
+            start = time.time()
+            for i in range(options['repeat']):
+                for bill in bills:
+                    xml, clave_acceso = getattr(bill, method)()
+                    size += len(xml)
+            elapsed = time.time() - start
+            count = len(bills) * options['repeat']
+            self.stdout.write(
+                "{}: {} documents in {:.3f}s, {:.2f} ms each, {} bytes each".format(
+                    name, count, elapsed, elapsed * 1000 / count,
+                    size / count))
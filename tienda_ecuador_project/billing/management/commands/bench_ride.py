@@ -0,0 +1,82 @@
+import time
+from io import BytesIO
+
+from django.core.management.base import BaseCommand
+from reportlab.lib.units import inch
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import Frame, Image
+
+from billing.models import Bill
+from public_receipts import barcode, gen_ride
+
+
+def raster_barcode(data):
+    """
+    The barcode as it was drawn before public_receipts.barcode:
+    an image from elaphe, cropped and encoded as PNG
+    """
+    from elaphe.code128 import Code128
+    out = BytesIO()
+    image = Code128().render(data, scale=2, margin=0)
+    for i in range(image.size[0] - 1, 0, -1):
+        if image.getpixel((i, 0))[0] == 0:
+            image = image.crop((0, 0, i + 1, image.size[1]))
+            break
+    image.save(out, "png")
+    out.seek(0)
+    return Image(out, width=3 * inch, height=0.8 * inch)
+
+
+def vector_barcode(data):
+    return barcode.Code128(data, 3 * inch, 0.8 * inch)
+
+
+def barcode_pdf(flowable):
+    out = BytesIO()
+    canvas = Canvas(out)
+    Frame(0, 0, 4 * inch, 2 * inch).addFromList([flowable], canvas)
+    canvas.save()
+    return out.getvalue()
+
+
+class Command(BaseCommand):
+    help = ("Times the RIDEs of the bills, and their barcode "
+            "drawn as vector bars against the elaphe image")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--bills', type=int, default=10,
+            help="Number of bills, the latest with clave de acceso")
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help="Times every RIDE is generated")
+
+    def timed(self, name, count, function):
+        size = 0
+        start = time.time()
+        for i in range(count):
+            size += len(function(i))
+        elapsed = time.time() - start
+        self.stdout.write(
+            "{}: {} documents in {:.3f}s, {:.2f} ms each, {} bytes each".format(
+                name, count, elapsed, elapsed * 1000 / count, size / count))
+
+    def handle(self, *args, **options):
+        clave_acceso = '2209201501170439497000120021000000146680001466819'
+        for name, make in (('vector barcode', vector_barcode),
+                           ('raster barcode', raster_barcode)):
+            try:
+                self.timed(name, options['repeat'] * 10,
+                           lambda i: barcode_pdf(make(clave_acceso)))
+            except Exception as e:
+                self.stdout.write("{}: not available, {}".format(name, e))
+
+        bills = list(Bill.objects
+                     .exclude(clave_acceso='')
+                     .filter(punto_emision__isnull=False)
+                     .order_by('-id')[:options['bills']])
+        if not bills:
+            self.stdout.write("No bills with clave de acceso")
+            return
+        self.timed('ride', len(bills) * options['repeat'],
+                   lambda i: gen_ride.gen_bill_ride(bills[i % len(bills)]))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+
+from billing.models import Bill
+
+
+class Command(BaseCommand):
+    help = "Backfills and verifies the totals stored on the bills"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true', default=False,
+            help="Only check the stored totals, do not change them")
+        parser.add_argument(
+            '--company', type=int, default=None,
+            help="Only process the bills of this company id")
+
+    def handle(self, *args, **options):
+        bills = Bill.objects.order_by('id')
+        if options['company']:
+            bills = bills.filter(company_id=options['company'])
+
+        checked = 0
+        mismatches = 0
+        for bill in bills.iterator():
+            checked += 1
+            expected = bill.get_stored_totals_from_items()
+            differences = [
+                (k, getattr(bill, k), v)
+                for k, v in sorted(expected.iteritems())
+                if getattr(bill, k) != v]
+            if not differences:
+                continue
+            mismatches += 1
+            for k, stored, computed in differences:
+                self.stdout.write(
+                    "Bill {}: {} is {}, should be {}".format(
+                        bill.id, k, stored, computed))
+            if not options['verify']:
+                Bill.objects.filter(id=bill.id).update(**expected)
+
+        if options['verify']:
+            action = "wrong"
+        else:
+            action = "fixed"
+        self.stdout.write("{} bills checked, {} {}".format(
+            checked, mismatches, action))
+        if options['verify'] and mismatches:
+            raise SystemExit(1)
@@ -0,0 +1,69 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand, CommandError
+
+from billing.sri_worker import SRIWorker
+from util import sri_sender
+
+
+class Command(BaseCommand):
+    help = "Sends bills to the SRI, authorizes them and checks for annulments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=1,
+            help="Number of jobs run at the same time")
+        parser.add_argument(
+            '--lease', type=int, default=300,
+            help="Seconds a claimed job is reserved for this worker")
+        parser.add_argument(
+            '--sleep', type=int, default=5,
+            help="Seconds to wait when there are no jobs")
+        parser.add_argument(
+            '--report-interval', type=int, default=60,
+            help="Seconds between counter reports")
+        parser.add_argument(
+            '--lotes', action='store_true', default=False,
+            help="Send the bills in lotes masivos")
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help="Maximum number of jobs claimed at a time")
+        parser.add_argument(
+            '--secuencial-block', type=int, default=1,
+            help="Secuenciales reserved at a time for each punto de emision")
+        parser.add_argument(
+            '--render-processes', type=int,
+            default=multiprocessing.cpu_count(),
+            help="Processes rendering the RIDEs, 0 to leave them to other workers")
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help="Run the jobs that are due and exit")
+
+    def handle(self, *args, **options):
+        try:
+            sri_sender.check_wsdls()
+        except sri_sender.MissingWSDL as e:
+            raise CommandError(str(e))
+        worker = SRIWorker(concurrency=options['concurrency'],
+                           lease_seconds=options['lease'],
+                           lotes=options['lotes'],
+                           batch_size=options['batch_size'],
+                           secuencial_block=options['secuencial_block'],
+                           render_processes=options['render_processes'])
+        self.stdout.write("SRI worker {} started".format(worker.owner))
+        if options['once']:
+            worker.refresh_certs()
+            worker.enqueue_pending()
+            try:
+                while worker.run_once() or worker.wait_renders():
+                    pass
+            finally:
+                worker.close()
+            self.stdout.write(worker.report())
+            return
+        try:
+            worker.run_forever(sleep=options['sleep'],
+                               report_interval=options['report_interval'],
+                               report=self.stdout.write)
+        except KeyboardInterrupt:
+            self.stdout.write(worker.report())
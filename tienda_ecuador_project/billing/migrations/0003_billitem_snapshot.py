@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def take_snapshots(apps, schema_editor):
+    """
+    Copies the current price, name, code and taxes of the SKU
+    into the existing bill items
+    """
+    BillItem = apps.get_model('billing', 'BillItem')
+    Iva = apps.get_model('sri', 'Iva')
+    Ice = apps.get_model('sri', 'Ice')
+    bill_items = BillItem.objects.select_related('sku__batch__item')
+    for bill_item in bill_items.iterator():
+        sku = bill_item.sku
+        item = sku.batch.item
+        tax_ids = item.tax_items.values_list('id', flat=True)
+        iva = Iva.objects.filter(id__in=tax_ids).first()
+        ice = (Ice.objects.filter(id__in=tax_ids)
+                          .exclude(descripcion="No ICE")
+                          .first())
+        values = {
+            'unit_price': sku.unit_price,
+            'name': item.name,
+            'code': u"{}-{}".format(item.code, sku.batch.code),
+            'decimales_qty': item.decimales_qty,
+            'iva_codigo': iva.codigo if iva else "",
+            'iva_porcentaje': iva.porcentaje if iva else Decimal(0),
+            'ice_codigo': ice.codigo if ice else "",
+            'ice_porcentaje': ice.porcentaje if ice else Decimal(0),
+        }
+        BillItem.objects.filter(id=bill_item.id).update(**values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0002_bill_stored_totals'),
+        ('inventory', '0003_auto_20160306_1030'),
+        ('sri', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='billitem',
+            name='code',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='billitem',
+            name='decimales_qty',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='billitem',
+            name='ice_codigo',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='billitem',
+            name='ice_porcentaje',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=6),
+        ),
+        migrations.AddField(
+            model_name='billitem',
+            name='iva_codigo',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='billitem',
+            name='iva_porcentaje',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=6),
+        ),
+        migrations.AddField(
+            model_name='billitem',
+            name='name',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='billitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=20),
+        ),
+        migrations.RunPython(take_snapshots, migrations.RunPython.noop),
+    ]
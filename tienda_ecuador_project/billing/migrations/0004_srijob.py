@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0003_billitem_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SRIJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stage', models.CharField(choices=[('send', 'Enviar al SRI'), ('authorize', 'Autorizar en el SRI'), ('annulment_check', 'Comprobar si ha sido anulada')], max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('next_run', models.DateTimeField(db_index=True)),
+                ('lease_owner', models.CharField(blank=True, max_length=100)),
+                ('lease_expiration', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('bill', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='billing.Bill')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='srijob',
+            unique_together=set([('bill', 'stage')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0004_srijob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='clave_acceso_lote',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+    ]
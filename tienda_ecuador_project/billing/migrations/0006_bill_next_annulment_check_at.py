@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import pytz
+
+from django.db import migrations, models
+
+
+def schedule_annulment_checks(apps, schema_editor):
+    """
+    Replaces the annulment_check jobs with the due queue on the bills.
+    The bills that can still be annulled are checked right away
+    """
+    Bill = apps.get_model('billing', 'Bill')
+    SRIJob = apps.get_model('billing', 'SRIJob')
+    SRIJob.objects.filter(stage='annulment_check').delete()
+    now = datetime.now(tz=pytz.timezone('America/Guayaquil'))
+    (Bill.objects.filter(status='Accepted',
+                         fecha_autorizacion__gte=now - timedelta(days=15))
+                 .update(next_annulment_check_at=now))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0005_bill_clave_acceso_lote'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='next_annulment_check_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='srijob',
+            name='stage',
+            field=models.CharField(choices=[('send', 'Enviar al SRI'), ('authorize', 'Autorizar en el SRI')], max_length=20),
+        ),
+        migrations.RunPython(schedule_annulment_checks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def clear_unsent_secuenciales(apps, schema_editor):
+    """
+    The bills waiting to be sent kept the secuencial of a previous
+    attempt, that was not taken from the punto de emision.
+    They take a new one when they are sent
+    """
+    Bill = apps.get_model('billing', 'Bill')
+    Bill.objects.filter(status='ReadyToSend').update(secuencial=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0006_bill_next_annulment_check_at'),
+        ('company_accounts', '0002_secuencialgap'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_unsent_secuenciales, migrations.RunPython.noop),
+    ]
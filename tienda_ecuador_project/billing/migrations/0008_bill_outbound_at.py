@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0007_clear_unsent_secuenciales'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='outbound_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
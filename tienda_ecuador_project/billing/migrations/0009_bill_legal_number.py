@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import xml.etree.ElementTree as ET
+
+from django.db import migrations, models
+
+
+def backfill_legal_number(apps, schema_editor):
+    """
+    Takes the number of the bills already generated from their XML
+    """
+    Bill = apps.get_model('billing', 'Bill')
+    bills = (Bill.objects.exclude(xml_content='')
+                         .only('id', 'xml_content')
+                         .order_by('id'))
+    for bill in bills.iterator():
+        try:
+            tree = ET.fromstring(bill.xml_content.encode('utf8'))
+            values = {
+                'legal_estab': tree.find("./infoTributaria/estab").text,
+                'legal_pto_emi': tree.find("./infoTributaria/ptoEmi").text,
+                'legal_secuencial': tree.find("./infoTributaria/secuencial").text,
+            }
+        except (ET.ParseError, AttributeError):
+            continue
+        values['legal_number'] = '{legal_estab}-{legal_pto_emi}-{legal_secuencial}'.format(**values)
+        Bill.objects.filter(id=bill.id).update(**values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0008_bill_outbound_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='legal_estab',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='legal_number',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=17),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='legal_pto_emi',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='legal_secuencial',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=9),
+        ),
+        migrations.RunPython(backfill_legal_number, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import util.artifacts
+from util import artifacts
+
+
+def check_artifact_dir(apps, schema_editor):
+    """
+    The documents are moved out of the database,
+    only to a directory that outlives the deploys
+    """
+    artifacts.get_artifact_dir()
+
+
+def move_xml_to_store(apps, schema_editor):
+    """
+    Moves the XML of the bills to the artifact store,
+    the column is left with its key
+    """
+    Bill = apps.get_model('billing', 'Bill')
+    bills = (Bill.objects.exclude(xml_content='')
+                         .only('id', 'xml_content')
+                         .order_by('id'))
+    for bill in bills.iterator():
+        data = bill.xml_content.encode('utf-8')
+        Bill.objects.filter(id=bill.id).update(
+            xml_content=artifacts.put(data), xml_size=len(data))
+
+
+def load_xml_from_store(apps, schema_editor):
+    Bill = apps.get_model('billing', 'Bill')
+    bills = (Bill.objects.exclude(xml_content='')
+                         .only('id', 'xml_content')
+                         .order_by('id'))
+    for bill in bills.iterator():
+        Bill.objects.filter(id=bill.id).update(
+            xml_content=artifacts.get(bill.xml_content).decode('utf-8'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0009_bill_legal_number'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_artifact_dir, check_artifact_dir),
+        migrations.AddField(
+            model_name='bill',
+            name='xml_size',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='authorization_xml',
+            field=util.artifacts.ArtifactField(blank=True, default='', editable=False, max_length=64, size_field='authorization_xml_size'),
+        ),
+        migrations.AddField(
+            model_name='bill',
+            name='authorization_xml_size',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(move_xml_to_store, load_xml_from_store),
+        migrations.AlterField(
+            model_name='bill',
+            name='xml_content',
+            field=util.artifacts.ArtifactField(blank=True, default='', editable=False, max_length=64, size_field='xml_size'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0010_bill_artifacts'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='srijob',
+            name='stage',
+            field=models.CharField(choices=[('send', 'Enviar al SRI'), ('authorize', 'Autorizar en el SRI'), ('render', 'Generar el RIDE')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('billing', '0011_srijob_render'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='srijob',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
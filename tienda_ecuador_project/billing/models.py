@@ -1,21 +1,41 @@
 # * encoding: utf-8 *
-from datetime import date, timedelta
+from collections import namedtuple
+from datetime import date, datetime, timedelta
 from decimal import Decimal
+import random
+import traceback
 import xml.etree.ElementTree as ET
 import pytz
 
 from django.db import models, transaction
+from django.db.models import Count, F, Min, Q
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
 from django.shortcuts import render_to_response
+from django.utils.functional import cached_property
 
 from util.property import Property, ConvertedProperty, ProtectedSetattr
+from util.enum import Enum
 from util import signature
 
 from company_accounts.models import Company, PuntoEmision
 from stakeholders.models import Customer
 from inventory.models import SKU
-from sri.models import ComprobanteSRIMixin, SRIStatus
+from sri.models import ComprobanteSRIMixin, SRIStatus, tax_catalog
+from sri import xml_builder
+
+
+STORED_TOTALS_QUANTUM = Decimal("0.0001")
+
+# Tabla 7 de la ficha tecnica del SRI
+TIPO_IDENTIFICACION_SRI = {
+    'ruc': '04',
+    'cedula': '05',
+    'pasaporte': '06',
+    'consumidor_final': '07',
+    'exterior': '08',
+    'placa': '09',
+}
 
 
 class ReadOnlyObject(Exception):
@@ -37,6 +57,30 @@ class Bill(ComprobanteSRIMixin, models.Model):
     issued_to = models.ForeignKey(Customer, null=True, blank=True)
     punto_emision = models.ForeignKey(PuntoEmision, null=True, blank=True)
     secuencial = models.IntegerField(default=0, blank=True)
+    # Number of the bill as in its XML, set when the XML is generated
+    legal_estab = models.CharField(
+        max_length=3, blank=True, default='', db_index=True)
+    legal_pto_emi = models.CharField(
+        max_length=3, blank=True, default='', db_index=True)
+    legal_secuencial = models.CharField(
+        max_length=9, blank=True, default='', db_index=True)
+    legal_number = models.CharField(
+        max_length=17, blank=True, default='', db_index=True)
+
+    # Totals stored on the bill, kept up to date by update_stored_totals
+    # while the bill can be modified and frozen afterwards
+    stored_subtotal_12 = models.DecimalField(
+        max_digits=20, decimal_places=4, default=0)
+    stored_subtotal_0 = models.DecimalField(
+        max_digits=20, decimal_places=4, default=0)
+    stored_iva = models.DecimalField(
+        max_digits=20, decimal_places=4, default=0)
+    stored_ice = models.DecimalField(
+        max_digits=20, decimal_places=4, default=0)
+    stored_descuento = models.DecimalField(
+        max_digits=20, decimal_places=4, default=0)
+    stored_total = models.DecimalField(
+        max_digits=20, decimal_places=4, default=0)
 
     def __unicode__(self):
         return u"{} - {}".format(self.get_bill_number(), self.date.date())
@@ -50,80 +94,86 @@ class Bill(ComprobanteSRIMixin, models.Model):
         import accounts_receivable.models
         return accounts_receivable.models.Receivable.objects.filter(bill=self)
 
+    @cached_property
+    def totals(self):
+        """
+        Totals of the bill, computed in a single pass over the items
+        and memoized on this instance
+        """
+        return BillTotals(self)
+
+    def invalidate_totals(self):
+        """
+        Forgets the memoized totals, they will be recomputed on next access
+        """
+        self.__dict__.pop('totals', None)
+
+    def get_stored_totals_from_items(self):
+        """
+        Returns the values the stored totals should have,
+        computed from the items
+        """
+        totals = self.totals
+        values = {
+            'stored_subtotal_12': totals.subtotal[12],
+            'stored_subtotal_0': totals.subtotal[0],
+            'stored_iva': totals.total_iva,
+            'stored_ice': totals.total_ice,
+            'stored_descuento': totals.total_descuento,
+            'stored_total': totals.total,
+        }
+        return {k: Decimal(v).quantize(STORED_TOTALS_QUANTUM)
+                for k, v in values.iteritems()}
+
+    def update_stored_totals(self):
+        """
+        Recomputes the stored totals from the items and saves them.
+        Does nothing once the bill can not be modified, as the totals
+        are frozen
+        """
+        if not self.id or not self.can_be_modified:
+            return
+        self.invalidate_totals()
+        values = self.get_stored_totals_from_items()
+        Bill.objects.filter(id=self.id).update(**values)
+        for k, v in values.iteritems():
+            setattr(self, k, v)
+
+    @property
+    def stored_total_sin_iva(self):
+        return self.stored_total - self.stored_iva
+
     @property
     def subtotal(self):
-        res = {0: Decimal(0),
-               12: Decimal(0)}
-        for i in self.items:
-            res[i.iva.porcentaje] = (res.get(i.iva.porcentaje, 0) +
-                                     i.total_sin_impuestos + i.valor_ice)
-        return res
+        return self.totals.subtotal
 
     @property
     def iva(self):
-        res = {
-            Decimal(12): Decimal(0),
-            Decimal(0): Decimal(0),
-        }
-        for item in self.items:
-            iva = item.iva.porcentaje
-            res[iva] = res[iva] + item.valor_iva
-        return res
+        return self.totals.iva
 
     @property
     def total_sin_impuestos(self):
-        return sum([i.total_sin_impuestos for i in self.items])
+        return self.totals.total_sin_impuestos
 
     @property
     def total_con_impuestos(self):
-        return sum([(i.total_sin_impuestos + i.valor_ice + i.valor_iva)
-                    for i in self.items])
+        return self.totals.total_con_impuestos
 
     @property
     def total_sin_iva(self):
-        return sum([(i.total_sin_impuestos + i.valor_ice)
-                    for i in self.items])
+        return self.totals.total_sin_iva
 
     @property
     def total_ice(self):
-        return sum(
-            [item.valor_ice for item in self.items])
+        return self.totals.total_ice
 
     @property
     def impuestos(self):
-        # key: (codigo, codigo_porcentaje, porcentaje)
-        # value: (base_imponible, valor)
-        accum = {}
-        for item in self.items:
-            k = ("2", item.iva.codigo, item.iva.porcentaje)
-            accum[k] = map(sum,
-                           zip(accum.get(k, (0, 0)),
-                               (item.base_imponible_iva, item.valor_iva)))
-            if item.ice:
-                k = ("3", item.ice.codigo, item.ice.porcentaje)
-                accum[k] = map(sum,
-                               zip(accum.get(k, (0, 0)),
-                                   (item.base_imponible_ice, item.valor_ice)))
-
-        return [
-            {
-                "codigo": codigo,
-                "codigo_porcentaje": codigo_porcentaje,
-                "porcentaje": porcentaje,
-                "base_imponible": base_imponible,
-                "valor": valor,
-            } for ((codigo, codigo_porcentaje, porcentaje),
-                   (base_imponible, valor))
-            in sorted(accum.iteritems())
-        ]
+        return self.totals.impuestos
 
     @property
     def total(self):
-        iva = self.iva
-        total_impuestos = sum([iva[k] for k in iva])
-        subtotal = self.subtotal
-        total_subtotales = sum([subtotal[k] for k in self.subtotal])
-        return total_subtotales + total_impuestos
+        return self.totals.total
 
     @property
     def payment(self):
@@ -155,28 +205,31 @@ class Bill(ComprobanteSRIMixin, models.Model):
         # not when it goes from Rejected to ReadyToSend
         decrease_inventory = self.status == SRIStatus.options.NotSent
         with transaction.atomic():
+            # Last chance to update the totals before freezing them
+            self.update_stored_totals()
             res = super(Bill, self).accept()
             if decrease_inventory:
                 for item in self.items:
                     item.substract_from_inventory()
+            SRIJob.enqueue(self.id, SRIJobStage.options.send)
         return res
 
-    def validate_in_SRI(self):
-        res = super(Bill, self).validate_in_SRI()
+    def authorization_applied(self):
+        super(Bill, self).authorization_applied()
         if self.status == SRIStatus.options.Accepted:
             # Create receivables
             import accounts_receivable.models
             for payment in self.payment:
-                if payment.plazo_pago.unidad_tiempo == 'dias':
+                plazo_pago = reference_data.get_plazo_pago(payment.plazo_pago_id)
+                if plazo_pago.unidad_tiempo == 'dias':
                     payment_date = (self.date
-                                    + timedelta(days=payment.plazo_pago.tiempo)).date()
+                                    + timedelta(days=plazo_pago.tiempo)).date()
                 r = accounts_receivable.models.Receivable(
                     bill=self,
                     qty=payment.cantidad,
                     date=payment_date,
-                    method=payment.forma_pago)
+                    method=reference_data.get_forma_pago(payment.forma_pago_id))
                 r.save()
-        return res
 
     def save(self, **kwargs):
         """
@@ -188,8 +241,8 @@ class Bill(ComprobanteSRIMixin, models.Model):
         return super(Bill, self).save(**kwargs)
 
     def gen_pdf(self):
-        from public_receipts import gen_ride
-        return gen_ride.gen_bill_ride(self)
+        from public_receipts import ride_cache
+        return ride_cache.get_ride(self)
 
     def get_bill_number_from_xml(self):
         tree = ET.fromstring(self.xml_content.encode('utf8'))
@@ -200,6 +253,8 @@ class Bill(ComprobanteSRIMixin, models.Model):
     def get_bill_number(self):
         if self.status in [SRIStatus.options.NotSent, SRIStatus.options.ReadyToSend]:
             return self.number
+        elif self.legal_number:
+            return self.legal_number
         else:
             try:
                 return self.get_bill_number_from_xml()
@@ -216,6 +271,33 @@ class Bill(ComprobanteSRIMixin, models.Model):
             date
         @returns: signed_xml_content, clave_acceso
         """
+        xml_content, clave_acceso = self.gen_unsigned_xml(codigo)
+        company = self.punto_emision.establecimiento.company
+        signed_xml_content = signature.sign(company.ruc, company.id, xml_content)
+        return signed_xml_content, clave_acceso
+
+    def gen_unsigned_xml(self, codigo=None):
+        """
+        Like gen_xml, without signing
+        @returns: xml_content, clave_acceso
+        """
+        context, clave_acceso = self.get_xml_context(codigo)
+        return xml_builder.factura(context), clave_acceso
+
+    def gen_unsigned_xml_from_template(self, codigo=None):
+        """
+        Like gen_unsigned_xml, rendering billing/proformabill_xml.html.
+        The same document, with whitespace between the elements
+        """
+        context, clave_acceso = self.get_xml_context(codigo)
+        response = render_to_response("billing/proformabill_xml.html", context)
+        return response.content, clave_acceso
+
+    def get_xml_context(self, codigo=None):
+        """
+        Data of the XML of the bill
+        @returns: context, clave_acceso
+        """
         def get_code_from_proforma_number(number):
             for i in range(len(number)):
                 try:
@@ -237,6 +319,7 @@ class Bill(ComprobanteSRIMixin, models.Model):
 
         context = {
             'proformabill': self,
+            'totals': self.totals,
             'punto_emision': self.punto_emision,
             'establecimiento': self.punto_emision.establecimiento,
             'company': company,
@@ -275,15 +358,9 @@ class Bill(ComprobanteSRIMixin, models.Model):
         context['info_tributaria'] = info_tributaria
 
         info_factura = {}
-        info_factura['tipo_identificacion_comprador'] = {    # tabla 7
-            'ruc': '04',
-            'cedula': '05',
-            'pasaporte': '06',
-            'consumidor_final': '07',
-            'exterior': '08',
-            'placa': '09',
-        }[self.issued_to.tipo_identificacion]
-        info_factura['total_descuento'] = sum([i.discount for i in self.items])
+        info_factura['tipo_identificacion_comprador'] = (
+            TIPO_IDENTIFICACION_SRI[self.issued_to.tipo_identificacion])
+        info_factura['total_descuento'] = self.totals.total_descuento
         info_factura['propina'] = 0             # No hay propinas
         info_factura['moneda'] = 'DOLAR'
         context['info_factura'] = info_factura
@@ -292,13 +369,125 @@ class Bill(ComprobanteSRIMixin, models.Model):
             'Generado Con': 'DSSTI Facturas',
             'Web': 'http://facturas.dssti.com',
         }
+        return context, clave_acceso
 
-        response = render_to_response("billing/proformabill_xml.html", context)
+    @classmethod
+    def gen_clave_acceso_lote(cls, bills):
+        """
+        Clave de acceso of a lote masivo with the bills.
+        Uses the serie and secuencial of the first bill
+        and a random codigo
+        """
+        first = bills[0]
+        thedate = now()
+        c = ClaveAcceso()
+        c.fecha_emision = (thedate.year,
+                           thedate.month,
+                           thedate.day)
+        c.tipo_comprobante = "factura"
+        c.ruc = str(first.company.ruc)
+        c.ambiente = first.ambiente_sri
+        c.establecimiento = int(first.punto_emision.establecimiento.codigo)
+        c.punto_emision = int(first.punto_emision.codigo)
+        c.numero = first.secuencial
+        c.codigo = random.randint(0, 10 ** 8 - 1)
+        c.tipo_emision = "normal"
+        return unicode(c)
 
-        xml_content = response.content
-        # sign xml_content
-        signed_xml_content = signature.sign(company.ruc, company.id, xml_content)
-        return signed_xml_content, clave_acceso
+
+TaxRate = namedtuple("TaxRate", ("codigo", "porcentaje"))
+
+
+class BillTotalsLine(object):
+    """
+    A bill item with its prices and taxes already resolved
+    """
+    def __init__(self, bill_item):
+        self.id = bill_item.id
+        self.code = bill_item.code
+        self.name = bill_item.name
+        self.decimales_qty = bill_item.decimales_qty
+        self.increment_qty = "{}".format(
+            1 / (Decimal("10") ** bill_item.decimales_qty))
+        self.qty = bill_item.qty
+        self.unit_price = bill_item.unit_price
+        self.discount = bill_item.discount
+        self.iva = iva = bill_item.iva
+        self.ice = ice = bill_item.ice
+
+        self.total_sin_impuestos = (self.qty * self.unit_price) - self.discount
+        self.base_imponible_ice = self.total_sin_impuestos
+        if ice:
+            self.valor_ice = (self.total_sin_impuestos *
+                              (ice.porcentaje / Decimal("100.0")))
+        else:
+            self.valor_ice = Decimal(0)
+        self.base_imponible_iva = self.total_sin_impuestos + self.valor_ice
+        self.valor_iva = (self.base_imponible_iva *
+                          (iva.porcentaje / Decimal("100.0")))
+        self.total_impuestos = self.valor_ice + self.valor_iva
+
+
+class BillTotals(object):
+    """
+    All the totals of a bill.
+    Loads the items in a single query and computes every total
+    in a single pass, using the prices and taxes stored on the items
+    """
+    def __init__(self, bill):
+        self.lines = [BillTotalsLine(bill_item)
+                      for bill_item in self.get_items(bill)]
+
+        self.subtotal = {0: Decimal(0),
+                         12: Decimal(0)}
+        self.iva = {Decimal(12): Decimal(0),
+                    Decimal(0): Decimal(0)}
+        self.total_sin_impuestos = Decimal(0)
+        self.total_ice = Decimal(0)
+        self.total_iva = Decimal(0)
+        self.total_descuento = Decimal(0)
+        # key: (codigo, codigo_porcentaje, porcentaje)
+        # value: [base_imponible, valor]
+        accum = {}
+        for line in self.lines:
+            porcentaje = line.iva.porcentaje
+            self.subtotal[porcentaje] = (self.subtotal.get(porcentaje, 0) +
+                                         line.base_imponible_iva)
+            self.iva[porcentaje] = (self.iva.get(porcentaje, 0) +
+                                    line.valor_iva)
+            self.total_sin_impuestos += line.total_sin_impuestos
+            self.total_ice += line.valor_ice
+            self.total_iva += line.valor_iva
+            self.total_descuento += line.discount
+
+            k = ("2", line.iva.codigo, line.iva.porcentaje)
+            acc = accum.setdefault(k, [0, 0])
+            acc[0] += line.base_imponible_iva
+            acc[1] += line.valor_iva
+            if line.ice:
+                k = ("3", line.ice.codigo, line.ice.porcentaje)
+                acc = accum.setdefault(k, [0, 0])
+                acc[0] += line.base_imponible_ice
+                acc[1] += line.valor_ice
+
+        self.total_sin_iva = self.total_sin_impuestos + self.total_ice
+        self.total_con_impuestos = self.total_sin_iva + self.total_iva
+        self.total = self.total_con_impuestos
+        self.impuestos = [
+            {
+                "codigo": codigo,
+                "codigo_porcentaje": codigo_porcentaje,
+                "porcentaje": porcentaje,
+                "base_imponible": base_imponible,
+                "valor": valor,
+            } for ((codigo, codigo_porcentaje, porcentaje),
+                   (base_imponible, valor))
+            in sorted(accum.iteritems())
+        ]
+
+    @staticmethod
+    def get_items(bill):
+        return BillItem.objects.filter(bill=bill).order_by('id')
 
 
 class ClaveAcceso(ProtectedSetattr):
@@ -369,18 +558,57 @@ class BillItem(models.Model):
     discount = models.DecimalField(max_digits=15, decimal_places=2, default=0)
     bill = models.ForeignKey(Bill)
 
+    # Copied from the SKU when the line is added or edited,
+    # so the bill does not change when the inventory does
+    unit_price = models.DecimalField(max_digits=20, decimal_places=4,
+                                     default=0)
+    name = models.CharField(max_length=100, blank=True)
+    code = models.CharField(max_length=100, blank=True)
+    decimales_qty = models.IntegerField(default=0)
+    iva_codigo = models.CharField(max_length=10, blank=True)
+    iva_porcentaje = models.DecimalField(decimal_places=2, max_digits=6,
+                                         default=0)
+    ice_codigo = models.CharField(max_length=10, blank=True)
+    ice_porcentaje = models.DecimalField(decimal_places=2, max_digits=6,
+                                         default=0)
+
     def save(self, **kwargs):
         if self.bill.can_be_modified:
-            super(BillItem, self).save(**kwargs)
+            self.take_snapshot()
+            with transaction.atomic():
+                super(BillItem, self).save(**kwargs)
+                self.bill.update_stored_totals()
         else:
             raise ValidationError("No se puede modificar la factura")
 
     def delete(self, **kwargs):
         if self.bill.can_be_modified:
-            super(BillItem, self).delete(**kwargs)
+            with transaction.atomic():
+                super(BillItem, self).delete(**kwargs)
+                self.bill.update_stored_totals()
         else:
             raise ValidationError("No se puede modificar la factura")
 
+    def take_snapshot(self):
+        """
+        Copies the price, name, code and taxes of the SKU into the line
+        """
+        sku = self.sku
+        item = sku.batch.item
+        iva, ice = item.iva_ice
+        self.unit_price = sku.unit_price
+        self.name = item.name
+        self.code = sku.code
+        self.decimales_qty = item.decimales_qty
+        self.iva_codigo = iva.codigo
+        self.iva_porcentaje = iva.porcentaje
+        if ice:
+            self.ice_codigo = ice.codigo
+            self.ice_porcentaje = ice.porcentaje
+        else:
+            self.ice_codigo = ""
+            self.ice_porcentaje = Decimal(0)
+
     @property
     def unit_cost(self):
         return self.sku.batch.unit_cost
@@ -397,17 +625,14 @@ class BillItem(models.Model):
     def base_unit_price(self):
         return self.sku.unit_price
 
-    @property
-    def unit_price(self):
-        return self.sku.unit_price
-
     @property
     def iva(self):
-        return self.sku.batch.item.iva
+        return TaxRate(self.iva_codigo, self.iva_porcentaje)
 
     @property
     def ice(self):
-        return self.sku.batch.item.ice
+        if self.ice_codigo:
+            return TaxRate(self.ice_codigo, self.ice_porcentaje)
 
     @property
     def base_total_sin_impuestos(self):
@@ -446,18 +671,6 @@ class BillItem(models.Model):
     def increment_qty(self):
         return self.sku.batch.item.increment_qty
 
-    @property
-    def name(self):
-        return self.sku.batch.item.name
-
-    @property
-    def code(self):
-        return self.sku.code
-
-    @property
-    def decimales_qty(self):
-        return self.sku.decimales_qty
-
     def substract_from_inventory(self):
         self.sku.substract(self.qty)
 
@@ -472,6 +685,14 @@ class FormaPago(models.Model):
     codigo = models.CharField(max_length=2)
     descripcion = models.CharField(max_length=50)
 
+    def save(self, **kwargs):
+        super(FormaPago, self).save(**kwargs)
+        reference_data.invalidate()
+
+    def delete(self, **kwargs):
+        super(FormaPago, self).delete(**kwargs)
+        reference_data.invalidate()
+
     def __unicode__(self):
         return u"{}".format(self.descripcion)
 
@@ -484,12 +705,102 @@ class PlazoPago(models.Model):
     unidad_tiempo = models.CharField(max_length=20)
     tiempo = models.IntegerField()
 
+    def save(self, **kwargs):
+        super(PlazoPago, self).save(**kwargs)
+        reference_data.invalidate()
+
+    def delete(self, **kwargs):
+        super(PlazoPago, self).delete(**kwargs)
+        reference_data.invalidate()
+
     def __unicode__(self):
         return u"{} ({} {})".format(self.descripcion,
                                     self.tiempo,
                                     self.unidad_tiempo)
 
 
+class ReferenceData(object):
+    """
+    In-memory copy of the tables loaded from
+    formas_pago.yaml, plazos_pago.yaml and tax_rates.yaml.
+    Loaded once per process and reloaded when one of their rows changes.
+    The instances are shared, so they must not be modified
+    """
+    def __init__(self):
+        self._data = None
+
+    def load(self):
+        formas_pago = tuple(FormaPago.objects.order_by('id'))
+        plazos_pago = tuple(PlazoPago.objects.order_by('id'))
+        self._data = {
+            'formas_pago': formas_pago,
+            'formas_pago_by_id': {f.id: f for f in formas_pago},
+            'plazos_pago': plazos_pago,
+            'plazos_pago_by_id': {p.id: p for p in plazos_pago},
+        }
+        tax_catalog.load()
+        return self._data
+
+    def warm(self):
+        """
+        Loads the tables if they are not loaded yet
+        """
+        if self._data is None:
+            self.load()
+
+    def invalidate(self):
+        self._data = None
+
+    def get(self, key):
+        data = self._data
+        if data is None:
+            data = self.load()
+        return data[key]
+
+    def get_by_id(self, key, model, id):
+        """
+        Looks up a row by id, reloading once if it is not found
+        """
+        try:
+            return self.get(key)[int(id)]
+        except KeyError:
+            try:
+                return self.load()[key][int(id)]
+            except KeyError:
+                raise model.DoesNotExist()
+
+    @property
+    def formas_pago(self):
+        return self.get('formas_pago')
+
+    def get_forma_pago(self, id):
+        return self.get_by_id('formas_pago_by_id', FormaPago, id)
+
+    @property
+    def plazos_pago(self):
+        return self.get('plazos_pago')
+
+    def get_plazo_pago(self, id):
+        return self.get_by_id('plazos_pago_by_id', PlazoPago, id)
+
+    @property
+    def plazos_pago_diferidos(self):
+        return tuple(p for p in self.plazos_pago if p.tiempo != 0)
+
+    @property
+    def plazo_pago_inmediato(self):
+        for p in self.plazos_pago:
+            if p.tiempo == 0:
+                return p
+        raise PlazoPago.DoesNotExist()
+
+    def get_tax(self, id):
+        return tax_catalog.get(id)
+
+
+reference_data = ReferenceData()
+
+
 class Pago(models.Model):
     """
     Pagos en una factura
@@ -501,21 +812,285 @@ class Pago(models.Model):
 
     @property
     def cantidad(self):
-        return ((self.porcentaje * self.bill.total_con_impuestos)
+        return ((self.porcentaje * self.bill.stored_total)
                 / Decimal(100))
 
     @property
     def date(self):
-        return self.bill.date.date() + timedelta(days=self.plazo_pago.tiempo)
+        plazo_pago = reference_data.get_plazo_pago(self.plazo_pago_id)
+        return self.bill.date.date() + timedelta(days=plazo_pago.tiempo)
 
     def save(self, **kwargs):
         if self.bill.can_be_modified:
-            super(Pago, self).save(**kwargs)
+            with transaction.atomic():
+                super(Pago, self).save(**kwargs)
+                self.bill.update_stored_totals()
         else:
             raise ValidationError("No se puede modificar la factura")
 
     def delete(self, **kwargs):
         if self.bill.can_be_modified:
-            super(Pago, self).delete(**kwargs)
+            with transaction.atomic():
+                super(Pago, self).delete(**kwargs)
+                self.bill.update_stored_totals()
         else:
             raise ValidationError("No se puede modificar la factura")
+
+
+############################################
+# Cola de trabajos del SRI
+############################################
+SRIJobStage = Enum(
+    "SRIJobStage",
+    (
+        ('send', 'Enviar al SRI'),
+        ('authorize', 'Autorizar en el SRI'),
+        ('render', 'Generar el RIDE'),
+    )
+)
+
+
+def now():
+    return datetime.now(tz=pytz.timezone('America/Guayaquil'))
+
+
+class SRIJob(models.Model):
+    """
+    Pending SRI operation on a bill, run by manage.py sri_worker.
+    The annulment checks are scheduled on the bill,
+    see Bill.next_annulment_check_at
+    """
+    # Seconds to wait before retrying, doubled on every attempt
+    RETRY_DELAY = 30
+    MAX_RETRY_DELAY = 60 * 60
+
+    bill = models.ForeignKey(Bill)
+    stage = models.CharField(
+        max_length=20,
+        choices=SRIJobStage.__OPTIONS__)
+    attempts = models.IntegerField(default=0)
+    next_run = models.DateTimeField(db_index=True)
+    lease_owner = models.CharField(max_length=100, blank=True)
+    lease_expiration = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # Increased when the job is enqueued again,
+    # then it runs once more after a run that started before
+    version = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (("bill", "stage"),)
+
+    def __unicode__(self):
+        return u"{} {}".format(self.stage, self.bill_id)
+
+    @classmethod
+    def enqueue(cls, bill_id, stage, delay=0):
+        """
+        Schedules a stage for a bill. When it is already scheduled
+        it is run again if it is running now, see run
+        """
+        job, created = cls.objects.get_or_create(
+            bill_id=bill_id, stage=stage,
+            defaults={'next_run': now() + timedelta(seconds=delay)})
+        if not created:
+            cls.objects.filter(id=job.id).update(version=F('version') + 1)
+        return job
+
+    @classmethod
+    def enqueue_pending(cls):
+        """
+        Schedules the bills that should progress and have no job,
+        like the ones processed before this queue existed
+        """
+        pending = [
+            (Bill.objects.filter(status=SRIStatus.options.ReadyToSend),
+             SRIJobStage.options.send),
+            (Bill.objects.filter(status=SRIStatus.options.Sent),
+             SRIJobStage.options.authorize),
+        ]
+        count = 0
+        for bills, stage in pending:
+            bill_ids = (bills.exclude(srijob__stage=stage)
+                             .values_list('id', flat=True))
+            for bill_id in bill_ids:
+                cls.enqueue(bill_id, stage)
+                count += 1
+        return count
+
+    @classmethod
+    def backlog(cls, when=None):
+        """
+        {stage: (due jobs, seconds the oldest one has been due)}
+        """
+        when = when or now()
+        due = (cls.objects.filter(next_run__lte=when)
+                          .values('stage')
+                          .annotate(jobs=Count('id'), oldest=Min('next_run')))
+        return {row['stage']: (row['jobs'],
+                               (when - row['oldest']).total_seconds())
+                for row in due}
+
+    @classmethod
+    def claim(cls, owner, max_jobs, lease_seconds=300, stages=None):
+        """
+        Leases up to max_jobs due jobs to owner, of any of stages
+        when given.
+        The rows are locked while claiming, and only the jobs that
+        nobody leased meanwhile are taken, so several workers
+        can run side by side
+        """
+        current = now()
+        free = Q(lease_expiration=None) | Q(lease_expiration__lt=current)
+        # Some databases drop the microseconds
+        expiration = (current + timedelta(seconds=lease_seconds)).replace(microsecond=0)
+        due = cls.objects.filter(free, next_run__lte=current)
+        if stages is not None:
+            due = due.filter(stage__in=stages)
+        with transaction.atomic():
+            job_ids = list(due.select_for_update()
+                              .order_by('next_run')
+                              .values_list('id', flat=True)[:max_jobs])
+            (cls.objects.filter(free, id__in=job_ids)
+                        .update(lease_owner=owner,
+                                lease_expiration=expiration))
+        return list(cls.objects
+                       .filter(id__in=job_ids,
+                               lease_owner=owner,
+                               lease_expiration=expiration)
+                       .order_by('next_run'))
+
+    def run(self, bill=None, sri_result=None, secuenciales=None,
+            prepared=False):
+        """
+        Runs the stage on the bill and schedules what comes next.
+        Returns 'done', 'waiting' (the SRI has not answered yet)
+        or 'error'.
+        sri_result is the result of checking the bill in the SRI
+        from run_batch, the SRI is not queried again.
+        secuenciales is the SecuencialReservation of the worker.
+        prepared is True when prepare_sends signed the bill
+        """
+        if bill is None:
+            bill = Bill.objects.get(id=self.bill_id)
+        try:
+            if isinstance(sri_result, Exception):
+                raise sri_result
+            delay = getattr(self, 'run_' + self.stage)(
+                bill, checked=sri_result is not None,
+                secuenciales=secuenciales, prepared=prepared)
+        except Exception:
+            self.reschedule(self.get_retry_delay(), traceback.format_exc())
+            return 'error'
+        if delay is None:
+            deleted, rows = self.leased().filter(version=self.version).delete()
+            if not deleted:
+                # Enqueued again meanwhile, it is due again
+                self.leased().update(lease_owner='', lease_expiration=None)
+            return 'done'
+        else:
+            self.reschedule(delay)
+            return 'waiting'
+
+    @classmethod
+    def run_batch(cls, jobs):
+        """
+        Runs authorize jobs, querying the SRI concurrently
+        for all the bills and saving the results in bulk.
+        Returns the results of the jobs, in order
+        """
+        bills = Bill.objects.in_bulk([job.bill_id for job in jobs])
+        sri_results = {}
+        to_validate = [bills[job.bill_id] for job in jobs
+                       if job.stage == SRIJobStage.options.authorize
+                       and bills[job.bill_id].status == SRIStatus.options.Sent]
+        if to_validate:
+            sri_results.update(Bill.validate_many_in_SRI(to_validate))
+        return [job.run(bills[job.bill_id], sri_results.get(job.bill_id))
+                for job in jobs]
+
+    @classmethod
+    def run_lotes(cls, jobs, secuenciales=None):
+        """
+        Runs send jobs, sending the bills in lotes masivos.
+        The bills that do not go in a lote are sent one by one,
+        like the ones with a clave de acceso, which may have reached
+        the SRI already.
+        Returns the results of the jobs, in order
+        """
+        bills = Bill.objects.in_bulk([job.bill_id for job in jobs])
+        ready = [bills[job.bill_id] for job in jobs
+                 if bills[job.bill_id].status == SRIStatus.options.ReadyToSend
+                 and not bills[job.bill_id].clave_acceso]
+        try:
+            sri_results = Bill.send_lotes_to_SRI(ready, secuenciales)
+        except Exception as e:
+            sri_results = dict.fromkeys(bills, e)
+        return [job.run(bills[job.bill_id], sri_results.get(job.bill_id))
+                for job in jobs]
+
+    @classmethod
+    def prepare_sends(cls, jobs, secuenciales=None):
+        """
+        Signs in a batch the bills of the send jobs.
+        Returns the prepared bills by id, they are sent without
+        signing them again.
+        The bills with a clave de acceso may have reached the SRI already,
+        they are left to send_to_SRI, which asks the SRI first
+        """
+        bills = Bill.objects.in_bulk([job.bill_id for job in jobs
+                                      if job.stage == SRIJobStage.options.send])
+        ready = [bill for bill in bills.values()
+                 if bill.status == SRIStatus.options.ReadyToSend
+                 and not bill.clave_acceso]
+        if not ready:
+            return {}
+        errors = Bill.prepare_many_for_SRI(ready, secuenciales)
+        return {bill.id: bill for bill in ready if bill.id not in errors}
+
+    def run_send(self, bill, checked=False, secuenciales=None,
+                 prepared=False):
+        if bill.status == SRIStatus.options.ReadyToSend and not checked:
+            bill.send_to_SRI(secuenciales, prepared)
+        if bill.status == SRIStatus.options.Sent:
+            SRIJob.enqueue(bill.id, SRIJobStage.options.authorize)
+
+    def run_authorize(self, bill, checked=False, secuenciales=None,
+                      prepared=False):
+        if bill.status == SRIStatus.options.Sent and not checked:
+            bill.validate_in_SRI()
+        if bill.status == SRIStatus.options.Sent:
+            # Not processed yet
+            return self.get_retry_delay()
+        if bill.status == SRIStatus.options.Accepted:
+            SRIJob.enqueue(bill.id, SRIJobStage.options.render)
+
+    def run_render(self, bill, checked=False, secuenciales=None,
+                   prepared=False):
+        """
+        Renders the RIDE into the RIDE cache.
+        checked is True when the worker rendered it in its process pool
+        """
+        if not checked:
+            bill.gen_pdf()
+
+    def get_retry_delay(self):
+        return min(self.RETRY_DELAY * 2 ** self.attempts,
+                   self.MAX_RETRY_DELAY)
+
+    def leased(self):
+        """
+        Queryset with this job, if it is still leased by us
+        """
+        return SRIJob.objects.filter(id=self.id,
+                                     lease_owner=self.lease_owner,
+                                     lease_expiration=self.lease_expiration)
+
+    def reschedule(self, delay, error=''):
+        self.attempts += 1
+        self.next_run = now() + timedelta(seconds=delay)
+        self.last_error = error
+        self.leased().update(attempts=self.attempts,
+                             next_run=self.next_run,
+                             last_error=self.last_error,
+                             lease_owner='',
+                             lease_expiration=None)
@@ -0,0 +1,288 @@
+# * encoding: utf-8 *
+"""
+Runs the SRI jobs of billing.models.SRIJob
+and the due annulment checks of the bills
+"""
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from django.db import close_old_connections, connections
+
+from billing.models import Bill, SRIJob, SRIJobStage
+from company_accounts.models import Company, SecuencialReservation
+
+
+class RenderError(Exception):
+    """
+    The RIDE could not be rendered in the process pool
+    """
+
+
+def render_ride(bill_id):
+    """
+    Renders the RIDE of a bill in a process of the render pool.
+    Returns True, or the RenderError with the traceback
+    """
+    close_old_connections()
+    try:
+        Bill.objects.get(id=bill_id).gen_pdf()
+        return True
+    except Exception:
+        return RenderError(traceback.format_exc())
+    finally:
+        close_old_connections()
+
+
+class SRIWorker(object):
+    """
+    Claims due SRI jobs and runs them, with `concurrency` jobs at a time.
+    The RIDEs are rendered by `render_processes` processes in the
+    background, with 0 the render jobs are left to other workers.
+    Keeps per-stage counters of the results
+    """
+    RESULTS = ('done', 'waiting', 'error')
+
+    def __init__(self, owner=None, concurrency=1, lease_seconds=300,
+                 lotes=False, batch_size=None, secuencial_block=1,
+                 render_processes=0):
+        self.render_processes = render_processes
+        self.render_pool = None
+        if render_processes:
+            # Forked before this process has threads or connections,
+            # the processes open their own connections
+            connections.close_all()
+            self.render_pool = multiprocessing.Pool(render_processes)
+        # (render job, AsyncResult) of the RIDEs being rendered
+        self.rendering = []
+        self.owner = owner or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.concurrency = concurrency
+        self.lease_seconds = lease_seconds
+        # Send the bills in lotes masivos
+        self.lotes = lotes
+        self.batch_size = batch_size or concurrency * 2
+        # Secuenciales reserved at a time for each punto de emision
+        self.secuenciales = None
+        if secuencial_block > 1:
+            self.secuenciales = SecuencialReservation(secuencial_block)
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counters = {
+            stage: dict.fromkeys(self.RESULTS, 0)
+            for stage, description in SRIJobStage.__OPTIONS__}
+        self.annulment_counters = dict.fromkeys(
+            ('checked', 'annulled', 'error'), 0)
+        self.pool = None
+        if concurrency > 1:
+            self.pool = ThreadPool(concurrency)
+        # The render jobs are claimed by start_renders
+        self.stages = [stage for stage, description
+                       in SRIJobStage.__OPTIONS__
+                       if stage != SRIJobStage.options.render]
+
+    # Stages that query the SRI for several bills at once
+    BATCH_STAGES = (SRIJobStage.options.authorize,)
+
+    def count(self, job, result):
+        with self.lock:
+            self.counters[job.stage][result] += 1
+
+    def run_job(self, job, bill=None):
+        result = job.run(bill, secuenciales=self.secuenciales,
+                         prepared=bill is not None)
+        self.count(job, result)
+        return result
+
+    def run_job_in_thread(self, job_bill):
+        job, bill = job_bill
+        close_old_connections()
+        try:
+            return self.run_job(job, bill)
+        finally:
+            close_old_connections()
+
+    def start_renders(self):
+        """
+        Claims render jobs for the free processes of the render pool
+        and starts them, without waiting for them.
+        Returns the number of jobs started
+        """
+        free = self.render_processes * 2 - len(self.rendering)
+        if self.render_pool is None or free <= 0:
+            return 0
+        jobs = SRIJob.claim(self.owner, free, self.lease_seconds,
+                            [SRIJobStage.options.render])
+        for job in jobs:
+            self.rendering.append(
+                (job, self.render_pool.apply_async(render_ride,
+                                                   (job.bill_id,))))
+        return len(jobs)
+
+    def collect_renders(self):
+        """
+        Finishes the render jobs whose RIDE is rendered.
+        Returns the number of jobs finished
+        """
+        finished = [(job, result) for job, result in self.rendering
+                    if result.ready()]
+        for job, result in finished:
+            self.rendering.remove((job, result))
+            try:
+                result = result.get()
+            except Exception as e:
+                result = RenderError(e)
+            self.count(job, job.run(sri_result=result))
+        return len(finished)
+
+    def wait_renders(self, timeout=None):
+        """
+        Waits up to timeout seconds for the oldest render.
+        Returns False when nothing is being rendered
+        """
+        if not self.rendering:
+            return False
+        self.rendering[0][1].wait(timeout)
+        return True
+
+    def run_annulment_checks(self, max_checks):
+        """
+        Checks the bills due for an annulment check.
+        Returns the number of bills checked
+        """
+        bills = Bill.claim_annulment_checks(max_checks, self.lease_seconds)
+        if not bills:
+            return 0
+        results = Bill.check_many_if_annulled_in_SRI(bills)
+        with self.lock:
+            for result in results.values():
+                if isinstance(result, Exception):
+                    self.annulment_counters['error'] += 1
+                else:
+                    self.annulment_counters['checked'] += 1
+                    if result:
+                        self.annulment_counters['annulled'] += 1
+        for bill_id, result in results.items():
+            if result is True:
+                # The RIDE shows it is annulled
+                SRIJob.enqueue(bill_id, SRIJobStage.options.render)
+        return len(bills)
+
+    def run_once(self, max_jobs=None):
+        """
+        Runs one batch of due jobs and annulment checks,
+        finishes the rendered RIDEs and starts rendering more.
+        Returns the number of jobs and checks run or started
+        """
+        renders = self.collect_renders() + self.start_renders()
+        jobs = SRIJob.claim(self.owner,
+                            max_jobs or self.batch_size,
+                            self.lease_seconds,
+                            self.stages)
+        batch = [job for job in jobs if job.stage in self.BATCH_STAGES]
+        others = [job for job in jobs if job.stage not in self.BATCH_STAGES]
+        if batch:
+            for job, result in zip(batch, SRIJob.run_batch(batch)):
+                self.count(job, result)
+        if self.lotes and others:
+            results = SRIJob.run_lotes(others, self.secuenciales)
+            for job, result in zip(others, results):
+                self.count(job, result)
+            others = []
+        # The bills to send are signed in a batch,
+        # if it fails every job signs its bill
+        try:
+            prepared = SRIJob.prepare_sends(others, self.secuenciales)
+        except Exception:
+            prepared = {}
+        others = [(job, prepared.get(job.bill_id)) for job in others]
+        if self.pool:
+            self.pool.map(self.run_job_in_thread, others)
+        else:
+            for job, bill in others:
+                self.run_job(job, bill)
+        return (renders + len(jobs) +
+                self.run_annulment_checks(max_jobs or self.batch_size))
+
+    def enqueue_pending(self):
+        """
+        Recovers the submissions interrupted without result
+        and schedules the bills that have no job
+        """
+        Bill.recover_outbound()
+        return SRIJob.enqueue_pending()
+
+    def refresh_certs(self):
+        """
+        Updates which companies the signers have the certificate of,
+        the web only reads it
+        """
+        return Company.refresh_can_sign()
+
+    def run_forever(self, sleep=5, enqueue_interval=600, cert_interval=3600,
+                    report_interval=60, report=None):
+        """
+        Runs jobs until interrupted, looking for bills without job
+        and interrupted submissions every enqueue_interval seconds,
+        and for the certificates every cert_interval seconds
+        """
+        last_enqueue = last_certs = last_report = 0
+        try:
+            while True:
+                if time.time() - last_certs > cert_interval:
+                    self.refresh_certs()
+                    last_certs = time.time()
+                if time.time() - last_enqueue > enqueue_interval:
+                    self.enqueue_pending()
+                    last_enqueue = time.time()
+                if not self.run_once() and not self.wait_renders(sleep):
+                    time.sleep(sleep)
+                if report and time.time() - last_report > report_interval:
+                    report(self.report())
+                    last_report = time.time()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Gives back the secuenciales reserved and not used,
+        and stops the render processes once they finish their RIDEs
+        """
+        if self.secuenciales is not None:
+            self.secuenciales.release()
+        if self.render_pool is not None:
+            self.render_pool.close()
+            self.render_pool.join()
+            self.collect_renders()
+            self.render_pool = None
+
+    def report(self):
+        """
+        Text with the counters, the throughput and the backlog
+        of every stage. The backlog are the due jobs, and how long
+        the oldest one has been waiting
+        """
+        minutes = max(time.time() - self.started, 1) / 60.0
+        backlog = SRIJob.backlog()
+        lines = []
+        with self.lock:
+            for stage, description in SRIJobStage.__OPTIONS__:
+                counters = self.counters[stage]
+                due, oldest = backlog.get(stage, (0, 0))
+                lines.append(
+                    "{}: {} done, {} waiting, {} errors, {:.1f} jobs/min, "
+                    "{} due, oldest {:.0f}s".format(
+                        stage, counters['done'], counters['waiting'],
+                        counters['error'],
+                        sum(counters.values()) / minutes,
+                        due, oldest))
+            counters = self.annulment_counters
+            lines.append(
+                "annulment_check: {} checked, {} annulled, {} errors, {:.1f} checks/min".format(
+                    counters['checked'], counters['annulled'],
+                    counters['error'],
+                    (counters['checked'] + counters['error']) / minutes))
+        return "\n".join(lines)
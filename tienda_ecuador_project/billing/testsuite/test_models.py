@@ -1,3 +1,4 @@
+# * encoding: utf-8 *
 from datetime import datetime
 from itertools import count
 from decimal import Decimal
@@ -22,6 +23,7 @@ from billing import models
 
 from helpers import (add_instance,
                      add_User,
+                     TemporaryArtifactsMixin,
                      TestHelpersMixin)
 
 from sri.models import SRIStatus, AmbienteSRI
@@ -130,7 +132,7 @@ class MakeBaseInstances(inventory.testsuite.test_models.MakeBaseInstances):
             plazo_pago=self.plazo_pago)
 
 
-class MakeBaseInstances(MakeBaseInstances):
+class MakeBaseInstances(TemporaryArtifactsMixin, MakeBaseInstances):
     """
     Some basic instances to help other tests
     """
@@ -308,6 +310,26 @@ class BillItemTests(MakeBaseInstances, TestCase, TestHelpersMixin):
     def test_unit_price(self):
         self.assertEquals(self.bill_item.unit_price, self.bill_item.sku.unit_price)
 
+    def test_snapshot(self):
+        """
+        Changes on the inventory do not affect the existing bill items
+        until they are edited
+        """
+        unit_price = self.bill_item.unit_price
+        self.sku.unit_price = unit_price * 2
+        self.sku.save()
+        self.item.name = "Otro nombre"
+        self.item.save()
+        bill_item = BillItem.objects.get(id=self.bill_item.id)
+        self.assertEquals(bill_item.unit_price, unit_price)
+        self.assertNotEquals(bill_item.name, "Otro nombre")
+        self.assertEquals(bill_item.iva.porcentaje, Decimal(12))
+        self.assertEquals(bill_item.ice.porcentaje, Decimal(50))
+
+        bill_item.save()
+        self.assertEquals(bill_item.unit_price, unit_price * 2)
+        self.assertEquals(bill_item.name, "Otro nombre")
+
 
 class IdentificacionTests(TestCase):
     def setUp(self):
@@ -453,6 +475,122 @@ class BillTest(MakeBaseInstances, TestCase, TestHelpersMixin):
         self.assertEquals(type(self.bill.iva[0]), Decimal)
         self.assertEquals(type(self.bill.iva[12]), Decimal)
 
+    def test_totals_single_pass(self):
+        """
+        All the totals are computed with a single query
+        and memoized on the bill instance
+        """
+        bill = self.get_bill()
+        with self.assertNumQueries(1):
+            bill.subtotal
+            bill.iva
+            bill.total_sin_impuestos
+            bill.total_con_impuestos
+            bill.total_sin_iva
+            bill.total_ice
+            bill.impuestos
+            bill.total
+            for line in bill.totals.lines:
+                line.code
+                line.name
+                line.iva.codigo
+                line.ice.codigo
+        self.assertEquals(bill.total, bill.total_con_impuestos)
+        self.assertEquals(bill.totals.total_descuento, 0)
+
+    def test_totals_invalidated_on_item_change(self):
+        bill = self.get_bill()
+        total = bill.total
+        item = bill.items[0]
+        item.bill = bill
+        item.qty = item.qty * 2
+        item.save()
+        self.assertEquals(bill.total, total * 2)
+
+    def test_stored_totals(self):
+        bill = self.get_bill()
+        self.assertEquals(bill.stored_total, bill.total)
+        self.assertEquals(bill.stored_iva, bill.iva[12])
+        self.assertEquals(bill.stored_ice, bill.total_ice)
+        self.assertEquals(bill.stored_subtotal_12, bill.subtotal[12])
+        self.assertEquals(bill.stored_subtotal_0, bill.subtotal[0])
+        self.assertEquals(bill.stored_total_sin_iva, bill.total_sin_iva)
+
+        item = bill.items[0]
+        item.delete()
+        bill = self.get_bill()
+        self.assertEquals(bill.stored_total, 0)
+
+    def test_stored_totals_frozen(self):
+        bill = self.get_bill()
+        bill.punto_emision = self.punto_emision
+        bill.save()
+        bill.accept()
+        total = bill.stored_total
+        self.sku.unit_price = self.sku.unit_price * 2
+        self.sku.save()
+        bill = self.get_bill()
+        bill.update_stored_totals()
+        self.assertEquals(self.get_bill().stored_total, total)
+
+    def test_stored_totals_command(self):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        models.Bill.objects.filter(id=self.bill.id).update(stored_total=0)
+        out = StringIO()
+        with self.assertRaises(SystemExit):
+            call_command('bill_totals', verify=True, stdout=out)
+        call_command('bill_totals', stdout=out)
+        self.assertEquals(self.get_bill().stored_total, self.bill.total)
+        call_command('bill_totals', verify=True, stdout=out)
+
+    def test_xml_builder(self):
+        """
+        The XML is the one of the template, without the whitespace
+        """
+        from lxml import etree
+        from sri import xml_builder
+        add_instance(BillItem, sku=self.sku, bill=self.bill, qty=3)
+        bill = self.get_bill()
+        bill.punto_emision = self.punto_emision
+        bill.secuencial = 17
+        bill.issued_to = self.customer
+        bill.issued_to.razon_social = u"Ñandú & O'Brien <\"1\">"
+        xml, clave_acceso = bill.gen_unsigned_xml()
+        template_xml, template_clave_acceso = (
+            bill.gen_unsigned_xml_from_template())
+        self.assertEquals(clave_acceso, template_clave_acceso)
+        self.assertIn("<cantidad>3.000000</cantidad>", xml)
+        parser = etree.XMLParser(remove_blank_text=True)
+        self.assertEquals(
+            xml,
+            xml_builder.XML_DECLARATION.encode('utf-8') +
+            etree.tostring(etree.fromstring(template_xml, parser),
+                           method='c14n'))
+
+    def test_xml_artifact(self):
+        """
+        The XML is kept in the artifact store, the row only has its key
+        """
+        from util import artifacts
+        bill = self.get_bill()
+        bill.xml_content = u'<xml>\xf1</xml>'
+        self.assertEquals(bill.xml_size, 13)
+        bill.secret_save()
+        key = Bill.objects.filter(id=bill.id).values_list('xml_content', flat=True)[0]
+        self.assertEquals(key, artifacts.make_key('<xml>\xc3\xb1</xml>'))
+        self.assertEquals(artifacts.get(key), '<xml>\xc3\xb1</xml>')
+        bill = self.get_bill()
+        self.assertEquals(bill.xml_size, 13)
+        self.assertEquals(bill.xml_content, u'<xml>\xf1</xml>')
+        # Lookups by the content, without storing it
+        self.assertTrue(Bill.objects.filter(xml_content=u'<xml>\xf1</xml>').exists())
+        self.assertFalse(Bill.objects.filter(xml_content=u'<other/>').exists())
+        self.assertFalse(artifacts.get_backend().exists(artifacts.make_key('<other/>')))
+        # Updates store it
+        Bill.objects.filter(id=bill.id).update(xml_content=u'<other/>')
+        self.assertEquals(self.get_bill().xml_content, u'<other/>')
+
     def test_clave_acceso_encode(self):
         c = ClaveAcceso()
         c.fecha_emision = (2015, 7, 3)
@@ -595,3 +733,43 @@ class IceTests(TestCase, TestHelpersMixin):
             add_instance(Ice,
                          descripcion="No ICE",
                          codigo="", porcentaje=0))
+
+
+class ReferenceDataTests(MakeBaseInstances, TestCase):
+    def setUp(self):
+        super(ReferenceDataTests, self).setUp()
+        self.plazo_pago_inmediato = add_instance(
+            models.PlazoPago,
+            unidad_tiempo='dias',
+            tiempo=0,
+            descripcion='Inmediato')
+
+    def test_lookups(self):
+        models.reference_data.warm()
+        with self.assertNumQueries(0):
+            self.assertEquals(models.reference_data.formas_pago,
+                              (self.forma_pago,))
+            self.assertEquals(
+                models.reference_data.get_forma_pago(self.forma_pago.id),
+                self.forma_pago)
+            self.assertEquals(
+                models.reference_data.get_plazo_pago(str(self.plazo_pago.id)),
+                self.plazo_pago)
+            self.assertEquals(models.reference_data.plazo_pago_inmediato,
+                              self.plazo_pago_inmediato)
+            self.assertEquals(models.reference_data.plazos_pago_diferidos,
+                              (self.plazo_pago,))
+        with self.assertRaises(models.FormaPago.DoesNotExist):
+            models.reference_data.get_forma_pago(self.forma_pago.id + 100)
+
+    def test_reloaded_on_change(self):
+        models.reference_data.warm()
+        self.plazo_pago.tiempo = 60
+        self.plazo_pago.save()
+        self.assertEquals(
+            models.reference_data.get_plazo_pago(self.plazo_pago.id).tiempo,
+            60)
+        forma_pago = add_instance(models.FormaPago,
+                                  codigo='02', descripcion='cheque')
+        self.assertEquals(
+            models.reference_data.get_forma_pago(forma_pago.id), forma_pago)
@@ -0,0 +1,613 @@
+from datetime import datetime, timedelta
+import json
+import os
+import re
+import shutil
+import tempfile
+import pytz
+import xml.etree.ElementTree as ET
+
+from django.test import TestCase
+
+from billing import models
+from billing.sri_worker import RenderError, SRIWorker, render_ride
+from public_receipts import gen_ride, ride_cache
+from sri import schemas
+from sri.models import SRIStatus
+from util import signature
+from util.testsuite.test_sri_sender_mock import (
+    GenericObject,
+    MockAutorizarComprobante,
+    MockAutorizarLote,
+    MockEnviarComprobante,
+    gen_respuesta_autorizacion_comprobante_valido,
+    gen_respuesta_autorizacion_lote,
+    gen_respuesta_autorizacion_no_hay_comprobantes,
+    gen_respuesta_solicitud_invalid_xml,
+    gen_respuesta_solicitud_ok)
+
+from test_models import MakeBaseInstances
+
+
+def now():
+    return datetime.now(tz=pytz.timezone('America/Guayaquil'))
+
+
+class InlineRenderPool(object):
+    """
+    Render pool that renders in the test process, where the test
+    database is, when get is called on a ready result.
+    The results are ready once finished is set
+    """
+    def __init__(self):
+        self.finished = False
+        self.started = []
+
+    def apply_async(self, func, args):
+        self.started.append(args)
+        pool = self
+
+        class Result(object):
+            def ready(self):
+                return pool.finished
+
+            def wait(self, timeout=None):
+                pass
+
+            def get(self):
+                return func(*args)
+        return Result()
+
+    def close(self):
+        self.finished = True
+
+    def join(self):
+        pass
+
+
+class SRIJobTests(MakeBaseInstances, TestCase):
+    def setUp(self):
+        super(SRIJobTests, self).setUp()
+        self.bill.punto_emision = self.punto_emision
+        self.bill.ambiente_sri = self.punto_emision.ambiente_sri
+        self.bill.save()
+
+    def set_status(self, status):
+        bill = models.Bill.objects.get(id=self.bill.id)
+        bill.clave_acceso = '1234512345'
+        bill.xml_content = '<xml></xml>'
+        bill.status = status
+        bill.secret_save()
+
+    def test_enqueued_on_accept(self):
+        bill = models.Bill.objects.get(id=self.bill.id)
+        bill.accept()
+        job = models.SRIJob.objects.get(bill=bill)
+        self.assertEquals(job.stage, models.SRIJobStage.options.send)
+
+    def test_enqueue_pending(self):
+        self.set_status(SRIStatus.options.Sent)
+        self.assertEquals(models.SRIJob.enqueue_pending(), 1)
+        self.assertEquals(models.SRIJob.enqueue_pending(), 0)
+        job = models.SRIJob.objects.get(bill=self.bill)
+        self.assertEquals(job.stage, models.SRIJobStage.options.authorize)
+
+    def test_claim(self):
+        models.SRIJob.enqueue(self.bill.id, models.SRIJobStage.options.send)
+        jobs = models.SRIJob.claim('worker1', 10)
+        self.assertEquals(len(jobs), 1)
+        self.assertEquals(jobs[0].lease_owner, 'worker1')
+        # Already leased
+        self.assertEquals(models.SRIJob.claim('worker2', 10), [])
+        # Lease expired
+        models.SRIJob.objects.update(lease_expiration=now() - timedelta(seconds=1))
+        self.assertEquals(len(models.SRIJob.claim('worker2', 10)), 1)
+
+    def test_enqueued_while_running(self):
+        self.set_status(SRIStatus.options.Accepted)
+        models.SRIJob.enqueue(self.bill.id, models.SRIJobStage.options.render)
+        job, = models.SRIJob.claim('worker1', 10)
+        # Annulled while the RIDE of the accepted bill is rendered
+        models.SRIJob.enqueue(self.bill.id, models.SRIJobStage.options.render)
+        self.assertEquals(job.run(sri_result=True), 'done')
+        job, = models.SRIJob.claim('worker1', 10)
+        self.assertEquals(job.run(sri_result=True), 'done')
+        self.assertFalse(models.SRIJob.objects.exists())
+
+    def test_not_due(self):
+        models.SRIJob.enqueue(self.bill.id, models.SRIJobStage.options.send,
+                              delay=60)
+        self.assertEquals(models.SRIJob.claim('worker1', 10), [])
+
+    def test_authorize(self):
+        self.set_status(SRIStatus.options.Sent)
+        models.SRIJob.enqueue(self.bill.id, models.SRIJobStage.options.authorize)
+        worker = SRIWorker(owner='worker1')
+        response = gen_respuesta_autorizacion_comprobante_valido(
+            '1234512345', '<xml></xml>', fecha_autorizacion=now())
+        with MockAutorizarComprobante(response):
+            self.assertEquals(worker.run_once(), 1)
+        bill = models.Bill.objects.get(id=self.bill.id)
+        self.assertEquals(bill.status, SRIStatus.options.Accepted)
+        # The RIDE is rendered next
+        job = models.SRIJob.objects.get()
+        self.assertEquals(job.stage, models.SRIJobStage.options.render)
+        self.assertTrue(bill.next_annulment_check_at > now())
+        self.assertEquals(worker.counters['authorize']['done'], 1)
+        # The response of the SRI is kept
+        autorizacion = ET.fromstring(bill.authorization_xml.encode('utf-8'))
+        self.assertEquals(autorizacion.find('estado').text, 'AUTORIZADO')
+        self.assertEquals(autorizacion.find('numeroAutorizacion').text,
+                          bill.numero_autorizacion)
+        self.assertEquals(autorizacion.find('comprobante').text, '<xml></xml>')
+        self.assertEquals(bill.authorization_xml_size,
+                          len(bill.authorization_xml.encode('utf-8')))
+
+    def test_rejected_messages(self):
+        self.set_status(SRIStatus.options.Sent)
+        mensaje = GenericObject()
+        mensaje.tipo = 'ERROR'
+        mensaje.identificador = '43'
+        mensaje.mensaje = 'CLAVE ACCESO REGISTRADA'
+        autorizacion = GenericObject()
+        autorizacion.estado = 'RECHAZADA'
+        autorizacion.fechaAutorizacion = now()
+        autorizacion.mensajes = GenericObject()
+        autorizacion.mensajes.mensaje = [mensaje]
+        bill = models.Bill.objects.get(id=self.bill.id)
+        self.assertFalse(bill.apply_autorizaciones([autorizacion]))
+        self.assertEquals(bill.status, SRIStatus.options.Rejected)
+        self.assertEquals(json.loads(bill.issues),
+                          [{'tipo': 'ERROR', 'identificador': '43',
+                            'mensaje': 'CLAVE ACCESO REGISTRADA',
+                            'informacionAdicional': None}])
+
+    def test_render(self):
+        self.set_status(SRIStatus.options.Accepted)
+        models.SRIJob.enqueue(self.bill.id, models.SRIJobStage.options.render)
+        orig_cache_dir = ride_cache.cache_dir
+        orig_gen_bill_ride = gen_ride.gen_bill_ride
+        ride_cache.cache_dir = tempfile.mkdtemp()
+        gen_ride.gen_bill_ride = lambda ob: 'PDF'
+        try:
+            # Left to the workers with a render pool
+            self.assertEquals(SRIWorker(owner='web').run_once(), 0)
+            worker = SRIWorker(owner='worker1')
+            worker.render_processes = 1
+            worker.render_pool = InlineRenderPool()
+            self.assertIn("render: 0 done, 0 waiting, 0 errors, 0.0 jobs/min, 1 due",
+                          worker.report())
+            # Started, the worker goes on while it is rendered
+            self.assertEquals(worker.run_once(), 1)
+            self.assertEquals(worker.render_pool.started, [(self.bill.id,)])
+            self.assertEquals(worker.run_once(), 0)
+            self.assertTrue(models.SRIJob.objects.get().lease_owner)
+            self.assertEquals(worker.counters['render']['done'], 0)
+            # Finished by the next run
+            worker.render_pool.finished = True
+            self.assertEquals(worker.run_once(), 1)
+            self.assertEquals(worker.rendering, [])
+            self.assertEquals(os.listdir(ride_cache.cache_dir),
+                              [os.path.basename(ride_cache.get_path(
+                                  models.Bill.objects.get(id=self.bill.id)))])
+            self.assertIs(render_ride(self.bill.id), True)
+        finally:
+            shutil.rmtree(ride_cache.cache_dir)
+            ride_cache.cache_dir = orig_cache_dir
+            gen_ride.gen_bill_ride = orig_gen_bill_ride
+        self.assertFalse(models.SRIJob.objects.exists())
+        self.assertEquals(worker.counters['render']['done'], 1)
+        self.assertIsInstance(render_ride(0), RenderError)
+
+    def test_authorize_waiting(self):
+        self.set_status(SRIStatus.options.Sent)
+        models.SRIJob.enqueue(self.bill.id, models.SRIJobStage.options.authorize)
+        worker = SRIWorker(owner='worker1')
+        response = gen_respuesta_autorizacion_no_hay_comprobantes('1234512345')
+        with MockAutorizarComprobante(response):
+            worker.run_once()
+            # Rescheduled, not run again
+            self.assertEquals(worker.run_once(), 0)
+        job = models.SRIJob.objects.get(bill=self.bill)
+        self.assertEquals(job.attempts, 1)
+        self.assertEquals(job.lease_owner, '')
+        self.assertTrue(job.next_run > now())
+        self.assertEquals(worker.counters['authorize']['waiting'], 1)
+
+    def add_bill(self, clave_acceso, status, **kwargs):
+        bill = models.Bill.objects.get(id=self.bill.id)
+        bill.id = bill.pk = None
+        bill.clave_acceso = clave_acceso
+        bill.xml_content = '<xml></xml>'
+        bill.status = status
+        for k, v in kwargs.iteritems():
+            setattr(bill, k, v)
+        bill.secret_save()
+        return bill
+
+    def test_authorize_batch(self):
+        bills = [self.add_bill(clave, SRIStatus.options.Sent)
+                 for clave in ['111', '222', '333']]
+        for bill in bills:
+            models.SRIJob.enqueue(bill.id, models.SRIJobStage.options.authorize)
+        worker = SRIWorker(owner='worker1')
+        response = gen_respuesta_autorizacion_comprobante_valido(
+            '111', '<xml></xml>', fecha_autorizacion=now())
+        with MockAutorizarComprobante(response):
+            self.assertEquals(worker.run_once(max_jobs=10), 3)
+        for bill in bills:
+            bill = models.Bill.objects.get(id=bill.id)
+            self.assertEquals(bill.status, SRIStatus.options.Accepted)
+            self.assertTrue(bill.sri_last_check)
+            self.assertTrue(bill.next_annulment_check_at)
+        self.assertEquals(worker.counters['authorize']['done'], 3)
+
+    def test_recover_outbound(self):
+        old = now() - timedelta(hours=1)
+        received = self.add_bill('111', SRIStatus.options.ReadyToSend,
+                                 outbound_at=old)
+        recent = self.add_bill('222', SRIStatus.options.ReadyToSend,
+                               outbound_at=now())
+        response = gen_respuesta_autorizacion_comprobante_valido(
+            '111', '<xml></xml>', fecha_autorizacion=now())
+        with MockAutorizarComprobante(response):
+            self.assertEquals(models.Bill.recover_outbound(),
+                              {received.id: True})
+        bill = models.Bill.objects.get(id=received.id)
+        self.assertEquals(bill.status, SRIStatus.options.Sent)
+        self.assertIsNone(bill.outbound_at)
+        self.assertTrue(models.Bill.objects.get(id=recent.id).outbound_at)
+
+        # Not received, submitted again
+        lost = self.add_bill('333', SRIStatus.options.ReadyToSend,
+                             outbound_at=old, secuencial=7)
+        response = gen_respuesta_autorizacion_no_hay_comprobantes('333')
+        with MockAutorizarComprobante(response):
+            self.assertEquals(models.Bill.recover_outbound(),
+                              {lost.id: False})
+        bill = models.Bill.objects.get(id=lost.id)
+        self.assertEquals(bill.status, SRIStatus.options.ReadyToSend)
+        self.assertIsNone(bill.outbound_at)
+        self.assertEquals(bill.secuencial, 7)
+
+    def test_annulment_check_batch(self):
+        bills = [self.add_bill(clave, SRIStatus.options.Accepted,
+                               fecha_autorizacion=now() - timedelta(days=1),
+                               next_annulment_check_at=now())
+                 for clave in ['111', '222']]
+        worker = SRIWorker(owner='worker1')
+        response = gen_respuesta_autorizacion_no_hay_comprobantes('111')
+        with MockAutorizarComprobante(response):
+            self.assertEquals(worker.run_once(), 2)
+        for bill in bills:
+            bill = models.Bill.objects.get(id=bill.id)
+            self.assertEquals(bill.status, SRIStatus.options.Annulled)
+            self.assertIsNone(bill.next_annulment_check_at)
+        self.assertEquals(worker.annulment_counters['annulled'], 2)
+        # The RIDEs are rendered again
+        self.assertEquals(
+            models.SRIJob.objects.filter(
+                stage=models.SRIJobStage.options.render).count(), 2)
+        self.assertIn("annulment_check: 2 checked, 2 annulled", worker.report())
+
+    def test_annulment_check_not_annulled(self):
+        bill = self.add_bill('111', SRIStatus.options.Accepted,
+                             fecha_autorizacion=now() - timedelta(days=2),
+                             next_annulment_check_at=now())
+        worker = SRIWorker(owner='worker1')
+        response = gen_respuesta_autorizacion_comprobante_valido(
+            '111', '<xml></xml>', fecha_autorizacion=bill.fecha_autorizacion)
+        with MockAutorizarComprobante(response):
+            self.assertEquals(worker.run_once(), 1)
+            # Not due again
+            self.assertEquals(worker.run_once(), 0)
+        bill = models.Bill.objects.get(id=bill.id)
+        self.assertEquals(bill.status, SRIStatus.options.Accepted)
+        # Checked again after half its age
+        self.assertTrue(now() + timedelta(hours=23) <
+                        bill.next_annulment_check_at <
+                        now() + timedelta(hours=25))
+
+    def test_annulment_check_expired(self):
+        # Due just before its window closed
+        expired = self.add_bill(
+            '111', SRIStatus.options.Accepted,
+            fecha_autorizacion=now() - timedelta(days=15, seconds=1),
+            next_annulment_check_at=now() - timedelta(seconds=2))
+        bill = self.add_bill('222', SRIStatus.options.Accepted,
+                             fecha_autorizacion=now() - timedelta(days=2),
+                             next_annulment_check_at=now())
+        worker = SRIWorker(owner='worker1')
+        response = gen_respuesta_autorizacion_comprobante_valido(
+            '222', '<xml></xml>', fecha_autorizacion=bill.fecha_autorizacion)
+        with MockAutorizarComprobante(response) as request:
+            self.assertEquals(worker.run_once(), 1)
+            res = models.Bill.check_many_if_annulled_in_SRI([expired, bill])
+        self.assertEquals(request.request_args['clave_acceso'], '222')
+        self.assertIsNone(
+            models.Bill.objects.get(id=expired.id).next_annulment_check_at)
+        self.assertEquals(worker.annulment_counters['checked'], 1)
+        # Failing to check a bill does not stop the others
+        self.assertIsInstance(res[expired.id], AssertionError)
+        self.assertFalse(res[bill.id])
+
+    def test_annulment_check_schedule(self):
+        fecha_autorizacion = now()
+        schedule = list(models.Bill.get_annulment_check_schedule(
+            fecha_autorizacion))
+        self.assertTrue(len(schedule) < 20)
+        delays = [b - a for a, b in zip(schedule, schedule[1:])]
+        self.assertEquals(delays, sorted(delays))
+        self.assertEquals(
+            schedule[-1],
+            fecha_autorizacion + timedelta(days=15) - timedelta(hours=1))
+
+    def test_annulment_check_stats(self):
+        self.add_bill('111', SRIStatus.options.Accepted,
+                      fecha_autorizacion=now(),
+                      next_annulment_check_at=now() + timedelta(hours=1))
+        stats = models.Bill.annulment_check_stats()
+        self.assertEquals(stats['comprobantes'], 1)
+        self.assertEquals(stats['hourly_checks'], 24)
+        self.assertTrue(0 < stats['checks'] < 10)
+        self.assertEquals(stats['saved'],
+                          stats['hourly_checks'] - stats['checks'])
+
+    def test_error(self):
+        self.set_status(SRIStatus.options.Sent)
+        models.SRIJob.enqueue(self.bill.id, models.SRIJobStage.options.authorize)
+        worker = SRIWorker(owner='worker1')
+        with MockAutorizarComprobante(None):
+            worker.run_once()
+        job = models.SRIJob.objects.get(bill=self.bill)
+        self.assertEquals(job.attempts, 1)
+        self.assertIn("Traceback", job.last_error)
+        self.assertEquals(worker.counters['authorize']['error'], 1)
+        self.assertIn("authorize: 0 done, 0 waiting, 1 errors", worker.report())
+
+
+def fake_sign_batch(items, timeout=None):
+    return [xml for ruc, company_id, xml in items]
+
+
+with open(os.path.join(os.path.dirname(schemas.schema_dir),
+                       'xml', '1.1.0', 'factura.xml')) as f:
+    sample_factura = f.read()
+
+
+def fake_gen_unsigned_xml(bill, codigo=None):
+    """
+    The sample factura, with the secuencial as clave de acceso
+    """
+    clave_acceso = "{:049d}".format(bill.secuencial)
+    xml = re.sub("<claveAcceso>[0-9]*</claveAcceso>",
+                 "<claveAcceso>{}</claveAcceso>".format(clave_acceso),
+                 sample_factura)
+    return xml, clave_acceso
+
+
+class LoteTests(MakeBaseInstances, TestCase):
+    def setUp(self):
+        super(LoteTests, self).setUp()
+        self.orig_gen_unsigned_xml = models.Bill.gen_unsigned_xml
+        self.orig_sign = signature.sign
+        self.orig_sign_batch = signature.sign_batch
+        # There is no signer in the tests
+        models.Bill.gen_unsigned_xml = fake_gen_unsigned_xml
+        signature.sign = lambda ruc, company_id, xml: xml
+        signature.sign_batch = fake_sign_batch
+        self.bills = []
+        for i in range(3):
+            bill = models.Bill.objects.get(id=self.bill.id)
+            if i:
+                bill.id = bill.pk = None
+            bill.punto_emision = self.punto_emision
+            bill.ambiente_sri = self.punto_emision.ambiente_sri
+            bill.status = SRIStatus.options.ReadyToSend
+            bill.secret_save()
+            self.bills.append(bill)
+        self.siguiente = self.punto_emision.siguiente_secuencial
+
+    def tearDown(self):
+        models.Bill.gen_unsigned_xml = self.orig_gen_unsigned_xml
+        signature.sign = self.orig_sign
+        signature.sign_batch = self.orig_sign_batch
+        super(LoteTests, self).tearDown()
+
+    def get_bills(self):
+        return [models.Bill.objects.get(id=bill.id) for bill in self.bills]
+
+    def test_send_and_authorize(self):
+        for bill in self.bills:
+            models.SRIJob.enqueue(bill.id, models.SRIJobStage.options.send)
+        worker = SRIWorker(owner='worker1', lotes=True, batch_size=10)
+        with MockEnviarComprobante(gen_respuesta_solicitud_ok()) as request:
+            self.assertEquals(worker.run_once(), 3)
+        self.assertIn('<lote version="1.0.0">', request.request_args['xml_data'])
+
+        bills = self.get_bills()
+        self.assertEquals([b.status for b in bills],
+                          [SRIStatus.options.Sent] * 3)
+        self.assertEquals([b.secuencial for b in bills],
+                          range(self.siguiente, self.siguiente + 3))
+        self.assertTrue(bills[0].clave_acceso_lote)
+        self.assertEquals([b.outbound_at for b in bills], [None] * 3)
+        self.assertEquals(len(set(b.clave_acceso_lote for b in bills)), 1)
+        punto_emision = models.PuntoEmision.objects.get(id=self.punto_emision.id)
+        self.assertEquals(punto_emision.siguiente_secuencial, self.siguiente + 3)
+
+        # Two of them are authorized
+        response = gen_respuesta_autorizacion_lote(
+            bills[0].clave_acceso_lote,
+            [bills[0].xml_content, bills[2].xml_content],
+            fecha_autorizacion=now())
+        with MockAutorizarLote(response) as request:
+            self.assertEquals(worker.run_once(), 3)
+        self.assertEquals(request.request_args['clave_acceso'],
+                          bills[0].clave_acceso_lote)
+        self.assertEquals([b.status for b in self.get_bills()],
+                          [SRIStatus.options.Accepted,
+                           SRIStatus.options.Sent,
+                           SRIStatus.options.Accepted])
+        self.assertEquals(worker.counters['authorize']['done'], 2)
+        self.assertEquals(worker.counters['authorize']['waiting'], 1)
+
+    def test_returned(self):
+        returned_clave = "{:049d}".format(self.siguiente + 1)
+        response = gen_respuesta_solicitud_invalid_xml(returned_clave)
+        with MockEnviarComprobante(response):
+            res = models.Bill.send_lotes_to_SRI(self.bills)
+        self.assertEquals(res, {self.bills[1].id: False})
+        self.assertEquals([b.status for b in self.get_bills()],
+                          [SRIStatus.options.ReadyToSend,
+                           SRIStatus.options.Rejected,
+                           SRIStatus.options.ReadyToSend])
+        # The others keep their secuenciales,
+        # the one of the returned bill is given back
+        bills = self.get_bills()
+        self.assertEquals([b.secuencial for b in bills],
+                          [self.siguiente, 0, self.siguiente + 2])
+        punto_emision = models.PuntoEmision.objects.get(id=self.punto_emision.id)
+        self.assertEquals(punto_emision.siguiente_secuencial, self.siguiente + 3)
+        self.assertEquals(punto_emision.allocate_secuenciales(),
+                          [self.siguiente + 1])
+
+        with MockEnviarComprobante(gen_respuesta_solicitud_ok()):
+            res = models.Bill.send_lotes_to_SRI([bills[0], bills[2]])
+        self.assertEquals(res, {bills[0].id: True, bills[2].id: True})
+        self.assertEquals([b.secuencial for b in self.get_bills()],
+                          [self.siguiente, 0, self.siguiente + 2])
+
+    def test_legal_number(self):
+        with MockEnviarComprobante(gen_respuesta_solicitud_ok()):
+            models.Bill.send_lotes_to_SRI(self.bills)
+        bill = self.get_bills()[1]
+        number = u"{}-{}-{:09d}".format(
+            self.punto_emision.establecimiento.codigo,
+            self.punto_emision.codigo, self.siguiente + 1)
+        self.assertEquals(bill.legal_number, number)
+        self.assertEquals(bill.legal_secuencial,
+                          u"{:09d}".format(self.siguiente + 1))
+        # The XML is not parsed
+        bill.xml_content = '<broken'
+        self.assertEquals(bill.get_bill_number(), number)
+        self.assertEquals(
+            models.Bill.objects.get(legal_number=number).id, bill.id)
+
+    def test_sign_error(self):
+        def sign_batch(items, timeout=None):
+            signed = fake_sign_batch(items)
+            signed[1] = signature.SignError("error")
+            return signed
+        signature.sign_batch = sign_batch
+        with MockEnviarComprobante(gen_respuesta_solicitud_ok()):
+            res = models.Bill.send_lotes_to_SRI(self.bills)
+        # Left out of the lote
+        self.assertEquals(res, {self.bills[0].id: True, self.bills[2].id: True})
+        bill = self.get_bills()[1]
+        self.assertEquals(bill.status, SRIStatus.options.ReadyToSend)
+        self.assertEquals(bill.secuencial, self.siguiente + 1)
+
+    def test_invalid_xml(self):
+        invalid_id = self.bills[1].id
+
+        def gen_unsigned_xml(bill, codigo=None):
+            xml, clave_acceso = fake_gen_unsigned_xml(bill, codigo)
+            if bill.id == invalid_id:
+                xml = xml.replace("<ruc>", "<RUC>").replace("</ruc>", "</RUC>")
+            return xml, clave_acceso
+        models.Bill.gen_unsigned_xml = gen_unsigned_xml
+        with MockEnviarComprobante(gen_respuesta_solicitud_ok()) as request:
+            res = models.Bill.send_lotes_to_SRI(self.bills)
+        self.assertEquals(res, {self.bills[0].id: True,
+                                self.bills[1].id: False,
+                                self.bills[2].id: True})
+        self.assertEquals(request.request_args['xml_data'].count("<factura"), 2)
+        bill = self.get_bills()[1]
+        self.assertEquals(bill.status, SRIStatus.options.Rejected)
+        self.assertEquals(json.loads(bill.issues)[0]['identificador'],
+                          schemas.ESTRUCTURA_XML)
+        # Its secuencial is not lost
+        self.assertEquals(bill.secuencial, 0)
+        punto_emision = models.PuntoEmision.objects.get(id=self.punto_emision.id)
+        self.assertEquals(punto_emision.allocate_secuenciales(),
+                          [self.siguiente + 1])
+
+        # Sent alone, it does not reach the SRI
+        bill.status = SRIStatus.options.ReadyToSend
+        bill.clave_acceso = ''
+        bill.secret_save()
+        with MockEnviarComprobante(gen_respuesta_solicitud_ok()) as request:
+            self.assertFalse(bill.send_to_SRI())
+        self.assertEquals(request.request_args, {})
+        self.assertEquals(self.get_bills()[1].status,
+                          SRIStatus.options.Rejected)
+
+    def test_send_signed_in_batch(self):
+        for bill in self.bills:
+            models.SRIJob.enqueue(bill.id, models.SRIJobStage.options.send)
+
+        def sign(ruc, company_id, xml):
+            raise AssertionError("Signed one by one")
+        signature.sign = sign
+        worker = SRIWorker(owner='worker1', batch_size=10)
+        with MockEnviarComprobante(gen_respuesta_solicitud_ok()):
+            self.assertEquals(worker.run_once(), 3)
+        self.assertEquals(worker.counters['send']['done'], 3)
+        self.assertEquals([b.status for b in self.get_bills()],
+                          [SRIStatus.options.Sent] * 3)
+
+    def test_send_already_authorized(self):
+        # The responses to their submissions were lost
+        bills = self.get_bills()[:2]
+        for i, bill in enumerate(bills):
+            bill.clave_acceso = "{:049d}".format(self.siguiente + i)
+            bill.xml_content = '<xml></xml>'
+            bill.secuencial = self.siguiente + i
+            bill.secret_save()
+        response = gen_respuesta_autorizacion_comprobante_valido(
+            '1234512345', '<xml></xml>', fecha_autorizacion=now())
+        for lotes in (False, True):
+            for bill in bills:
+                bill.status = SRIStatus.options.ReadyToSend
+                bill.secret_save()
+                models.SRIJob.enqueue(bill.id, models.SRIJobStage.options.send)
+            worker = SRIWorker(owner='worker1', lotes=lotes, batch_size=10)
+            # They are not submitted again
+            with MockAutorizarComprobante(response):
+                self.assertEquals(worker.run_once(), 2)
+            self.assertEquals(worker.counters['send']['done'], 2)
+            self.assertEquals([b.status for b in self.get_bills()[:2]],
+                              [SRIStatus.options.Sent] * 2)
+            self.assertEquals([b.secuencial for b in self.get_bills()[:2]],
+                              [self.siguiente, self.siguiente + 1])
+            models.SRIJob.objects.all().delete()
+
+    def test_secuencial_block(self):
+        for bill in self.bills:
+            models.SRIJob.enqueue(bill.id, models.SRIJobStage.options.send)
+        worker = SRIWorker(owner='worker1', batch_size=10, secuencial_block=5)
+        with MockEnviarComprobante(gen_respuesta_solicitud_ok()):
+            self.assertEquals(worker.run_once(), 3)
+        self.assertEquals(sorted(b.secuencial for b in self.get_bills()),
+                          range(self.siguiente, self.siguiente + 3))
+        punto_emision = models.PuntoEmision.objects.get(id=self.punto_emision.id)
+        self.assertEquals(punto_emision.siguiente_secuencial, self.siguiente + 5)
+        # The numbers not used are given back
+        worker.close()
+        self.assertEquals(punto_emision.allocate_secuenciales(2),
+                          [self.siguiente + 3, self.siguiente + 4])
+
+    def test_split(self):
+        models.Bill.LOTE_MAX_COMPROBANTES = 2
+        try:
+            with MockEnviarComprobante(gen_respuesta_solicitud_ok()):
+                res = models.Bill.send_lotes_to_SRI(self.bills)
+        finally:
+            del models.Bill.LOTE_MAX_COMPROBANTES
+        # The last one is alone, it is not sent in a lote
+        self.assertEquals(res, {self.bills[0].id: True, self.bills[1].id: True})
+        bills = self.get_bills()
+        self.assertEquals(bills[2].status, SRIStatus.options.ReadyToSend)
+        punto_emision = models.PuntoEmision.objects.get(id=self.punto_emision.id)
+        self.assertEquals(punto_emision.siguiente_secuencial, self.siguiente + 2)
@@ -8,6 +8,7 @@ from django.test import TestCase, Client
 from django.core.urlresolvers import reverse
 
 from billing import models
+from billing.sri_worker import SRIWorker
 import company_accounts.models
 import accounts_receivable.models
 
@@ -876,6 +877,76 @@ class BillTests(LoggedInTests, MakeBaseInstances, TestHelpersMixin, TestCase):
         self.assertEquals(payment.porcentaje, 100)
         self.assertEquals(payment.bill, self.bill)
 
+    def set_emitting(self, status, **kwargs):
+        licence = self.company.licence
+        licence.next_licence = 'professional'
+        licence.approve(date.today() + timedelta(days=30))
+        models.Bill.objects.filter(id=self.bill.id).update(
+            status=status, clave_acceso='1234512345', **kwargs)
+
+    def post_emit(self, url_name):
+        return self.c.post(reverse(url_name, args=(self.bill.id,)))
+
+    def test_bill_emit_send_queued(self):
+        self.set_emitting(SRIStatus.options.ReadyToSend)
+        # The SRI is not called from the web
+        with MockEnviarComprobante(gen_respuesta_solicitud_ok()) as request:
+            r = self.post_emit('bill_emit_send_to_sri')
+        self.assertEquals(request.request_args, {})
+        self.assertEquals(json.loads(r.content),
+                          {'success': False, 'waiting': True,
+                           'msg': "En cola para enviar"})
+        job = models.SRIJob.objects.get(bill=self.bill)
+        self.assertEquals(job.stage, models.SRIJobStage.options.send)
+        # Done by the worker
+        self.set_emitting(SRIStatus.options.Sent)
+        self.assertTrue(
+            json.loads(self.post_emit('bill_emit_send_to_sri').content)['success'])
+        self.set_emitting(SRIStatus.options.Rejected)
+        self.assertEquals(
+            json.loads(self.post_emit('bill_emit_send_to_sri').content),
+            {'success': False, 'msg': "Factura rechazada"})
+
+    def test_bill_emit_validate_queued(self):
+        self.set_emitting(SRIStatus.options.Sent)
+        with MockAutorizarComprobante(None) as request:
+            r = self.post_emit('bill_emit_validate')
+        self.assertEquals(request.request_args, {})
+        self.assertTrue(json.loads(r.content)['waiting'])
+        job = models.SRIJob.objects.get(bill=self.bill)
+        self.assertEquals(job.stage, models.SRIJobStage.options.authorize)
+        self.set_emitting(SRIStatus.options.Accepted)
+        self.assertTrue(
+            json.loads(self.post_emit('bill_emit_validate').content)['success'])
+
+    def test_bill_emit_check_annulled(self):
+        self.set_emitting(SRIStatus.options.Accepted,
+                          next_annulment_check_at=get_date() + timedelta(days=1))
+        with MockAutorizarComprobante(None) as request:
+            r = self.post_emit('bill_emit_check_annulled')
+        self.assertEquals(request.request_args, {})
+        self.assertEquals(r.status_code, 202)
+        # Due for the worker
+        self.assertTrue(models.Bill.objects.get(id=self.bill.id)
+                        .next_annulment_check_at <= get_date() + timedelta(seconds=1))
+
+    def test_bill_emit_general_progress(self):
+        # Bills without job are scheduled by the worker, not by the view
+        self.set_emitting(SRIStatus.options.ReadyToSend)
+        models.SRIJob.objects.all().delete()
+        r = Client().get(reverse('bill_emit_progress'))
+        self.assertContains(r, "Ok, 0 jobs due")
+        self.assertFalse(models.SRIJob.objects.exists())
+        # The jobs are reported, and left to the worker
+        models.SRIJob.enqueue(self.bill.id, models.SRIJobStage.options.send)
+        with MockEnviarComprobante(None) as request:
+            r = Client().get(reverse('bill_emit_progress'))
+        self.assertEquals(request.request_args, {})
+        self.assertContains(r, "Ok, 1 jobs due")
+        self.assertContains(r, "send: 1 due")
+        self.assertEquals(models.Bill.objects.get(id=self.bill.id).status,
+                          SRIStatus.options.ReadyToSend)
+
 
 class BillItemTests(LoggedInWithCompanyTests):
     """
@@ -1481,15 +1552,15 @@ class EmitirFacturaTests(LoggedInWithCompanyTests):
         bill = self.get_bill_from_db()
         self.assertEquals(bill.status, SRIStatus.options.ReadyToSend)
 
-        # Progreso
+        # Progreso, by manage.py sri_worker
         for i in range(3):
-            c = Client()  # unauthenticated
             enviar_response = gen_respuesta_solicitud_ok()
             autorizar_response = gen_respuesta_autorizacion_comprobante_valido(
                 self.bill.clave_acceso,
                 self.bill.xml_content)
             with MockSRISender(enviar_response, autorizar_response) as request:
-                res = Client().get(reverse('bill_emit_progress'))
+                SRIWorker(owner='worker', render_processes=0).run_once()
+            res = Client().get(reverse('bill_emit_progress'))  # unauthenticated
             self.assertContains(res, "Ok")
 
         bill = self.get_bill_from_db()
@@ -14,16 +14,17 @@ from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.core.urlresolvers import reverse
 from django.http import JsonResponse, HttpResponse
 from django.forms.models import model_to_dict
+from django.utils.functional import cached_property
 
 
 from billing import models
 from billing import forms
-from company_accounts.models import (CompanyUser,
-                                     Company,
-                                     Establecimiento,
-                                     PuntoEmision)
+from billing.models import SRIJob, SRIJobStage
+from company_accounts.models import CompanyUser, Company
 from company_accounts.licence_helpers import licence_required
-from company_accounts.views import CompanySelected
+from company_accounts.views import (CompanySelected,
+                                    EstablecimientoSelected,
+                                    PuntoEmisionSelected)
 import inventory.models
 
 from util import signature
@@ -54,48 +55,6 @@ def index(request):
     return render(request, "billing/index.html", param_dict)
 
 
-class EstablecimientoSelected(CompanySelected):
-    @property
-    def establecimiento(self):
-        return get_object_or_404(
-            Establecimiento,
-            id=self.establecimiento_id)
-
-    @property
-    def establecimiento_id(self):
-        return self.kwargs['establecimiento_id']
-
-    @property
-    def company_id(self):
-        return self.establecimiento.company.id
-
-    def get_context_data(self, **kwargs):
-        context = super(EstablecimientoSelected, self).get_context_data(**kwargs)
-        context['establecimiento'] = self.establecimiento
-        return context
-
-
-class PuntoEmisionSelected(EstablecimientoSelected):
-    @property
-    def punto_emision(self):
-        return get_object_or_404(
-            PuntoEmision,
-            id=self.punto_emision_id)
-
-    @property
-    def punto_emision_id(self):
-        return self.kwargs["punto_emision_id"]
-
-    @property
-    def establecimiento_id(self):
-        return self.punto_emision.establecimiento.id
-
-    def get_context_data(self, **kwargs):
-        context = super(PuntoEmisionSelected, self).get_context_data(**kwargs)
-        context['punto_emision'] = self.punto_emision
-        return context
-
-
 class JSONResponseMixin(object):
     """
     A mixin that can be used to render a JSON response.
@@ -192,8 +151,7 @@ class ItemUpdateView(ItemView, CompanySelected, UpdateView):
     def get_form(self, *args, **kwargs):
         form = super(ItemUpdateView, self).get_form(*args, **kwargs)
         item = models.Item.objects.get(pk=self.kwargs['pk'])
-        form.fields['iva'].initial = item.iva
-        form.fields['ice'].initial = item.ice
+        form.fields['iva'].initial, form.fields['ice'].initial = item.iva_ice
         return form
 
     def form_valid(self, form):
@@ -271,26 +229,42 @@ class BillView(object):
                 .filter(punto_emision__establecimiento__company=self.company)
                 .filter(**self.queryset_filters))
 
+    @cached_property
+    def selected_bill(self):
+        """
+        The bill in the URL, with its punto de emision,
+        establecimiento and company
+        """
+        return get_object_or_404(
+            self.model.objects.select_related(
+                'punto_emision__establecimiento__company'),
+            id=self.kwargs['pk'])
+
     @property
     def punto_emision_id(self):
-        return self.model.objects.get(id=self.kwargs['pk']).punto_emision.id
+        return self.selected_bill.punto_emision_id
 
     @property
     def company_id(self):
-        return self.model.objects.get(id=self.kwargs['pk']).company.id
+        return self.selected_bill.company_id
+
+    def get_selected_punto_emision(self):
+        return self.selected_bill.punto_emision
 
 
 class BillSelected(PuntoEmisionSelected):
     model = models.BillItem
     context_object_name = 'item'
 
-    @property
+    @cached_property
     def bill(self):
         """
         Attribute that returns the current bill
         """
-        return get_object_or_404(models.Bill,
-                                 id=self.bill_id)
+        return get_object_or_404(
+            models.Bill.objects.select_related(
+                'punto_emision__establecimiento__company'),
+            id=self.bill_id)
 
     @property
     def bill_id(self):
@@ -298,7 +272,10 @@ class BillSelected(PuntoEmisionSelected):
 
     @property
     def punto_emision_id(self):
-        return self.bill.punto_emision.id
+        return self.bill.punto_emision_id
+
+    def get_selected_punto_emision(self):
+        return self.bill.punto_emision
 
     def get_context_data(self, **kwargs):
         """
@@ -323,9 +300,9 @@ class BillItemView(object):
     def get_queryset(self):
         return self.model.objects.filter(bill=self.bill)
 
-    @property
+    @cached_property
     def bill_id(self):
-        return self.model.objects.get(id=self.kwargs['pk']).bill.id
+        return get_object_or_404(self.model, id=self.kwargs['pk']).bill_id
 
 
 class BillCompanyListView(CompanySelected,
@@ -392,12 +369,13 @@ class BillPaymentView(BillView,
 
     def get_context_data(self, **kwargs):
         context = super(BillPaymentView, self).get_context_data(**kwargs)
-        context['payment_kinds'] = models.FormaPago.objects.all()
+        plazos_pago_diferidos = models.reference_data.plazos_pago_diferidos
+        context['payment_kinds'] = models.reference_data.formas_pago
         context['deferred'] = {}
-        context['deferred']['payment_terms'] = models.PlazoPago.objects.exclude(tiempo=0)
+        context['deferred']['payment_terms'] = plazos_pago_diferidos
         context['dues'] = {}
         context['dues']['payment_number_terms'] = range(2, 10)
-        context['dues']['payment_terms'] = models.PlazoPago.objects.exclude(tiempo=0)
+        context['dues']['payment_terms'] = plazos_pago_diferidos
         return context
 
     def post(self, request, pk):
@@ -408,19 +386,19 @@ class BillPaymentView(BillView,
             payment.delete()
 
         # Add new payment terms
-        payment_method = models.FormaPago.objects.get(
-            id=request.POST['payment_method'])
+        payment_method = models.reference_data.get_forma_pago(
+            request.POST['payment_method'])
 
         if request.POST['payment_mode'] == 'immediate':
-            installment = models.PlazoPago.objects.get(tiempo=0)
+            installment = models.reference_data.plazo_pago_inmediato
             models.Pago(porcentaje=Decimal(100),
                         forma_pago=payment_method,
                         plazo_pago=installment,
                         bill=bill).save()
             return redirect("bill_detail", bill.id)
         elif request.POST['payment_mode'] == 'deferred':
-            installment = models.PlazoPago.objects.get(
-                pk=request.POST['payment_time_to_pay'])
+            installment = models.reference_data.get_plazo_pago(
+                request.POST['payment_time_to_pay'])
             models.Pago(porcentaje=Decimal(100),
                         forma_pago=payment_method,
                         plazo_pago=installment,
@@ -595,7 +573,8 @@ class BillEmitAcceptView(BillView, PuntoEmisionSelected, DetailView):
 @licence_required('basic', 'professional', 'enterprise')
 class BillEmitSendToSRIView(BillView, PuntoEmisionSelected, DetailView):
     """
-    Sends an 'a enviar' bill to SRI
+    Queues an 'a enviar' bill to be sent to SRI, and reports how it goes.
+    The SRI jobs send it, see billing.sri_worker
     """
     template_name_suffix = '_disabled'
 
@@ -604,104 +583,80 @@ class BillEmitSendToSRIView(BillView, PuntoEmisionSelected, DetailView):
         if bill.status in [SRIStatus.options.Sent,
                            SRIStatus.options.Accepted,
                            SRIStatus.options.Annulled]:
-            return util.json_utils.success("Ya enviado")
+            return util.json_utils.success("Enviado")
+        if bill.status == SRIStatus.options.Rejected:
+            return util.json_utils.failure("Factura rechazada")
         if bill.status != SRIStatus.options.ReadyToSend:
             return HttpResponse("Bill status is not 'a enviar'",
                                 status=412, reason='Precondition Failed')
 
-        send_res = bill.send_to_SRI()
-        if send_res:
-            return util.json_utils.success("Enviado")
-        else:
-            return util.json_utils.failure("Factura rechazada")
+        SRIJob.enqueue(bill.id, SRIJobStage.options.send)
+        return util.json_utils.not_yet("En cola para enviar")
 
 
 @licence_required('basic', 'professional', 'enterprise')
 class BillEmitValidateView(BillView, PuntoEmisionSelected, DetailView):
     """
-    Sends an 'a enviar' bill to SRI
+    Queues a sent bill to be validated in SRI, and reports how it goes.
+    The SRI jobs validate it, see billing.sri_worker
     """
     template_name_suffix = '_disabled'
 
     def post(self, request, pk):
         bill = self.get_object()
         if bill.status in [SRIStatus.options.Accepted, SRIStatus.options.Annulled]:
-            return util.json_utils.success("Ya Validado")
-        if bill.status in [SRIStatus.options.NotSent]:
-            return util.json_utils.failure("Ya Rechazado")
-        if bill.status != SRIStatus.options.Sent:
-            return HttpResponse("Bill status is not 'sent'",
-                                status=412, reason='Precondition Failed')
-
-        res = bill.validate_in_SRI()
-        if res:
             return util.json_utils.success("Aceptado")
-        elif bill.status == SRIStatus.options.NotSent:
+        if bill.status in [SRIStatus.options.NotSent, SRIStatus.options.Rejected]:
             return util.json_utils.failure("Rechazado")
-        elif bill.status == SRIStatus.options.Sent:
-            return HttpResponse(u"Aún no procesada", status=412, reason='Precondition Failed')
+        if bill.status == SRIStatus.options.ReadyToSend:
+            # The send job queues the validation
+            return util.json_utils.not_yet("Enviando")
+
+        SRIJob.enqueue(bill.id, SRIJobStage.options.authorize)
+        return util.json_utils.not_yet(u"Aún no procesada")
 
 
 @licence_required('basic', 'professional', 'enterprise')
 class BillEmitCheckAnnulledView(BillView, PuntoEmisionSelected, DetailView):
     """
-    Checks if the bill has been annulled
+    Brings forward the annulment check of the bill.
+    The SRI worker checks it, see billing.sri_worker
     """
     template_name_suffix = '_disabled'
 
     def post(self, request, pk):
         bill = self.get_object()
+        if bill.status == SRIStatus.options.Annulled:
+            return HttpResponse("Anulled")
         if bill.status != SRIStatus.options.Accepted:
             return HttpResponse("Bill status is not 'Accepted'",
                                 status=412, reason='Precondition Failed')
-
-        res = bill.check_if_annulled_in_SRI()
-        if res:
-            return HttpResponse("Anulled")
-        else:
+        if not bill.next_annulment_check_at:
+            # It can not be annulled any more
             return HttpResponse("Not annulled")
 
+        current = datetime.now(tz=pytz.timezone('America/Guayaquil'))
+        (models.Bill.objects.filter(id=bill.id,
+                                    status=SRIStatus.options.Accepted,
+                                    next_annulment_check_at__gt=current)
+                            .update(next_annulment_check_at=current))
+        return HttpResponse("Checking", status=202)
+
 
 class BillEmitGeneralProgressView(View):
     """
-    Progresses bill statuses
+    Reports the due jobs of the SRI queue.
+    The bills are progressed by manage.py sri_worker
     """
     def get(self, request):
-        max_bills_to_process = 3
-        left_slots = self.send_bills_to_SRI(max_bills_to_process)
-        left_slots = self.validate_bills_in_SRI(left_slots)
-        left_slots = self.check_if_annulled_in_SRI(left_slots)
-        return HttpResponse("Ok, {} slots left".format(left_slots))
-
-    def send_bills_to_SRI(self, num_bills):
-        if num_bills == 0:
-            return 0
-        bills_to_send = models.Bill.objects.filter(status=SRIStatus.options.ReadyToSend)[:num_bills]
-        for bill in bills_to_send:
-            bill.send_to_SRI()
-        return num_bills - len(bills_to_send)
-
-    def validate_bills_in_SRI(self, num_bills):
-        if num_bills == 0:
-            return 0
-        bills_to_validate = models.Bill.objects.filter(status=SRIStatus.options.Sent)[:num_bills]
-        for bill in bills_to_validate:
-            bill.validate_in_SRI()
-        return num_bills - len(bills_to_validate)
-
-    def check_if_annulled_in_SRI(self, num_bills):
-        if num_bills == 0:
-            return 0
-        now = datetime.now(tz=pytz.timezone('America/Guayaquil'))
-        accepted_bills = (models.Bill.objects
-                          .filter(status=SRIStatus.options.Accepted)
-                          .filter(fecha_autorizacion__gte=now-timedelta(days=15)))
-        unchecked_bills = accepted_bills.filter(sri_last_check=None)
-        not_too_checked = accepted_bills.filter(sri_last_check__lte=now-timedelta(hours=1))
-        to_check = (unchecked_bills | not_too_checked).order_by("?")[:num_bills]
-        for bill in to_check:
-            bill.check_if_annulled_in_SRI()
-        return num_bills - len(to_check)
+        backlog = SRIJob.backlog()
+        lines = ["Ok, {} jobs due".format(
+            sum(due for due, oldest in backlog.values()))]
+        for stage, description in SRIJobStage.__OPTIONS__:
+            if stage in backlog:
+                lines.append("{}: {} due, oldest {:.0f}s".format(
+                    stage, *backlog[stage]))
+        return HttpResponse("\n".join(lines), content_type="text/plain")
 
 
 @licence_required('basic', 'professional', 'enterprise')
@@ -9,7 +9,8 @@ def valid_licence(user, valid_licences):
     a licence in valid_licences
     """
     cu = get_object_or_404(models.CompanyUser, user=user)
-    return cu.company.licence.effective_licence in valid_licences
+    status = models.CompanyStatus.get(cu.company_id)
+    return status.effective_licence in valid_licences
 
 
 class licence_required(object):
@@ -42,8 +43,8 @@ class LicenceControlMixin(object):
 
     def get_context_data(self, **kwargs):
         context = super(LicenceControlMixin, self).get_context_data(**kwargs)
-        cu = get_object_or_404(models.CompanyUser, user=self.request.user, company=self.company)
-        effective_licence = cu.company.licence.effective_licence
+        # self.company already checked the CompanyUser
+        effective_licence = self.company.status.effective_licence
         licence_data = {
             'demo': effective_licence == "demo",
             'basic': effective_licence in ['basic', 'professional', 'enterprise'],
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('company_accounts', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SecuencialGap',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ambiente_sri', models.CharField(choices=[(b'pruebas', b'Pruebas'), (b'produccion', b'Producci\xc3\xb3n')], max_length=20)),
+                ('secuencial', models.IntegerField()),
+                ('punto_emision', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='company_accounts.PuntoEmision')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='secuencialgap',
+            unique_together=set([('punto_emision', 'ambiente_sri', 'secuencial')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('company_accounts', '0002_secuencialgap'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='has_cert',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,9 +1,12 @@
 # * encoding: utf-8 *
 from datetime import date, timedelta, datetime
 import json
+import threading
 import pytz
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.core.files.storage import FileSystemStorage
@@ -82,6 +85,14 @@ class Licence(models.Model):
         self.expiration = new_date
         self.save()
 
+    def save(self, **kwargs):
+        # New licences have no company yet
+        adding = self._state.adding
+        super(Licence, self).save(**kwargs)
+        if not adding:
+            for company_id in Company.objects.filter(licence=self).values_list('id', flat=True):
+                CompanyStatus.invalidate(company_id)
+
     def get_history(self):
         return LicenceHistory.objects.filter(licence=self)
 
@@ -125,6 +136,54 @@ class Issue(object):
             self.__unicode__().encode("ascii", "replace"))
 
 
+class CompanyStatus(object):
+    """
+    Snapshot of the licence and open issues of a company,
+    read from the database only.
+    Kept in the cache for STATUS_TTL seconds, and invalidated when
+    the licence or the issues change
+    """
+    STATUS_TTL = 5 * 60
+
+    def __init__(self, company):
+        licence = company.licence
+        self.company_id = company.id
+        self.licence = licence.licence
+        self.next_licence = licence.next_licence
+        self.expired = licence.expired
+        self.effective_licence = licence.effective_licence
+        self.days_to_expiration = licence.days_to_expiration
+        self.open_issues = list(
+            CompanyIssue.objects
+                        .filter(company_id=company.id)
+                        .exclude(fixed=True)
+                        .order_by('id')
+                        .values_list('id', 'issue'))
+
+    @staticmethod
+    def status_key(company_id):
+        return "company_status_{}".format(company_id)
+
+    @classmethod
+    def get(cls, company):
+        """
+        Returns the status of a Company or company id
+        """
+        company_id = getattr(company, 'id', company)
+        key = cls.status_key(company_id)
+        status = cache.get(key)
+        if status is None:
+            if not isinstance(company, Company):
+                company = Company.objects.select_related('licence').get(id=company_id)
+            status = cls(company)
+            cache.set(key, status, cls.STATUS_TTL)
+        return status
+
+    @classmethod
+    def invalidate(cls, company_id):
+        cache.delete(cls.status_key(company_id))
+
+
 def logo_path_generator(instance, filename):
     ext = filename.split(".")[-1]
     return 'static/company_logos/{id}_{ruc}.{ext}'.format(
@@ -149,6 +208,9 @@ class Company(models.Model):
         storage=OverwritingStorage())
     cert = models.CharField(max_length=20000, blank=True)
     key = models.CharField(max_length=100, blank=True)
+    # The signers have the certificate. Kept by add_cert, del_cert
+    # and manage.py sri_worker, the requests never ask the signers
+    has_cert = models.BooleanField(default=False)
 
     def __unicode__(self):
         return self.razon_social
@@ -157,12 +219,51 @@ class Company(models.Model):
         return reverse("company_accounts:company_profile",
                        kwargs={'pk': self.pk})
 
+    def save(self, **kwargs):
+        super(Company, self).save(**kwargs)
+        CompanyStatus.invalidate(self.id)
+
+    @property
+    def status(self):
+        return CompanyStatus.get(self)
+
     @property
     def can_sign(self):
-        try:
-            return signature.has_cert(self.ruc, self.id)
-        except signature.Timeout:
-            return False
+        return self.has_cert
+
+    @staticmethod
+    def set_can_sign(company_id, can_sign):
+        Company.objects.filter(id=company_id).update(has_cert=can_sign)
+
+    @classmethod
+    def refresh_can_sign(cls):
+        """
+        Asks the signers for the certificate of every company.
+        Returns the number of companies that changed
+        """
+        changed = 0
+        companies = cls.objects.values_list('id', 'ruc', 'has_cert')
+        for company_id, ruc, has_cert in companies:
+            try:
+                can_sign = signature.has_cert(ruc, company_id)
+            except signature.Timeout:
+                continue
+            if can_sign != has_cert:
+                cls.set_can_sign(company_id, can_sign)
+                changed += 1
+        return changed
+
+    def add_cert(self, cert_data, cert_key):
+        res = signature.add_cert(self.ruc, self.id, cert_data, cert_key)
+        self.set_can_sign(self.id, True)
+        self.has_cert = True
+        return res
+
+    def del_cert(self):
+        res = signature.del_cert(self.ruc, self.id)
+        self.set_can_sign(self.id, False)
+        self.has_cert = False
+        return res
 
     @property
     def establecimientos(self):
@@ -178,21 +279,22 @@ class Company(models.Model):
         """
         Makes a list of issues in a given company to be shown
         """
+        status = self.status
         res = []
-        if self.licence.licence == 'demo' and self.licence.next_licence == 'demo':
+        if status.licence == 'demo' and status.next_licence == 'demo':
             res.append(
                 Issue('warning',
                       u'DSSTI Facturas está en modo Demo',
                       reverse('company_accounts:company_profile_select_plan',
                               kwargs={'pk': self.id}),
                       u'Seleccionar Plan'))
-        elif self.licence.expired:
+        elif status.expired:
             res.append(
                 Issue('danger',
                       u'La licencia de DSSTI Facturas ha caducado',
                       reverse('company_accounts:company_profile',
                               kwargs={'pk': self.id})))
-        elif self.licence.days_to_expiration < 10:
+        elif status.days_to_expiration < 10:
             res.append(
                 Issue('warning',
                       u'Quedan pocos días para que caduque la licencia de DSSTI Facturas',
@@ -206,12 +308,12 @@ class Company(models.Model):
                               kwargs={'pk': self.id}),
                       u"Subir Certificado")
             )
-        for issue in CompanyIssue.objects.filter(company=self).exclude(fixed=True):
+        for issue_id, issue_text in status.open_issues:
             res.append(
                 Issue('danger',
-                      issue.issue,
+                      issue_text,
                       reverse('company_accounts:fix_issue',
-                              kwargs={'pk': issue.id}),
+                              kwargs={'pk': issue_id}),
                       u"Confirmar que ha sido arreglado")
             )
         
@@ -244,6 +346,10 @@ class CompanyIssue(models.Model):
     issue = models.CharField(max_length=500)
     fixed = models.BooleanField(default=False)
 
+    def save(self, **kwargs):
+        super(CompanyIssue, self).save(**kwargs)
+        CompanyStatus.invalidate(self.company_id)
+
 
 class Establecimiento(models.Model):
     """
@@ -300,6 +406,97 @@ class PuntoEmision(models.Model):
         return reverse("company_accounts:punto_emision_detail",
                        kwargs={'pk': self.pk})
 
+    def allocate_secuenciales(self, count=1, ambiente=None):
+        """
+        Takes count secuenciales of the ambiente (by default,
+        the one of the punto de emision), reusing the released ones first.
+        Runs in its own short transaction, call it outside
+        any other transaction so the row is not locked for long.
+        Returns the list of numbers
+        """
+        ambiente = ambiente or self.ambiente_sri
+        field = 'siguiente_secuencial_' + ambiente
+        with transaction.atomic():
+            # Locks the counter until the end of the transaction
+            siguiente = (PuntoEmision.objects.select_for_update()
+                                     .filter(id=self.id)
+                                     .values_list(field, flat=True)[0])
+            # Gaps above the counter were left behind by a manual change
+            gaps = list(SecuencialGap.objects
+                                     .filter(punto_emision=self,
+                                             ambiente_sri=ambiente,
+                                             secuencial__lt=siguiente)
+                                     .order_by('secuencial')
+                                     .values_list('id', 'secuencial')[:count])
+            SecuencialGap.objects.filter(
+                id__in=[gap_id for gap_id, secuencial in gaps]).delete()
+            numbers = [secuencial for gap_id, secuencial in gaps]
+            new = count - len(numbers)
+            if new:
+                (PuntoEmision.objects.filter(id=self.id)
+                                     .update(**{field: F(field) + new}))
+                numbers.extend(range(siguiente, siguiente + new))
+        setattr(self, field, siguiente + new)
+        return numbers
+
+    def release_secuenciales(self, numbers, ambiente=None):
+        """
+        Gives back secuenciales taken and not used,
+        they are taken again before new ones
+        """
+        ambiente = ambiente or self.ambiente_sri
+        SecuencialGap.objects.bulk_create([
+            SecuencialGap(punto_emision_id=self.id,
+                          ambiente_sri=ambiente,
+                          secuencial=secuencial)
+            for secuencial in numbers])
+
+
+class SecuencialGap(models.Model):
+    """
+    Secuencial of a punto de emision that was taken and not used,
+    like the ones of the comprobantes returned by the SRI
+    """
+    punto_emision = models.ForeignKey(PuntoEmision)
+    ambiente_sri = models.CharField(
+        max_length=20,
+        choices=ambiente_sri_OPTIONS)
+    secuencial = models.IntegerField()
+
+    class Meta:
+        unique_together = (('punto_emision', 'ambiente_sri', 'secuencial'),)
+
+
+class SecuencialReservation(object):
+    """
+    Blocks of secuenciales reserved by a worker, the comprobantes
+    take them without touching the punto de emision.
+    The numbers not used are given back with release().
+    Numbers reserved by a worker that dies are left as holes
+    """
+    def __init__(self, block_size=10):
+        self.block_size = block_size
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def take(self, punto_emision, ambiente=None):
+        ambiente = ambiente or punto_emision.ambiente_sri
+        key = (punto_emision.id, ambiente)
+        with self.lock:
+            block = self.blocks.get(key)
+            if not block:
+                block = punto_emision.allocate_secuenciales(self.block_size,
+                                                            ambiente)
+                self.blocks[key] = block
+            return block.pop(0)
+
+    def release(self):
+        with self.lock:
+            for (punto_emision_id, ambiente), numbers in self.blocks.items():
+                PuntoEmision(id=punto_emision_id).release_secuenciales(
+                    numbers, ambiente)
+            self.blocks = {}
+
 
 class BannedCompany(models.Model):
     """
@@ -153,3 +153,107 @@ class LicenceTests(MakeBaseInstances, TestHelpersMixin):
         self.assertEquals(licence.days_to_expiration, 0)
         self.assertTrue(licence.expired)
         self.assertEquals(str(licence), "Licencia Caducada")
+
+
+class CompanyStatusTests(MakeBaseInstances, TestCase):
+    def test_cached(self):
+        self.company.issues
+        with self.assertNumQueries(0):
+            self.company.issues
+            self.assertFalse(self.company.can_sign)
+            self.assertEquals(self.company.status.effective_licence, 'demo')
+
+    def test_invalidated_on_approve(self):
+        self.assertEquals(self.company.status.effective_licence, 'demo')
+        licence = self.company.licence
+        licence.next_licence = 'professional'
+        licence.approve(date.today() + timedelta(days=30))
+        self.assertEquals(self.company.status.effective_licence,
+                          'professional')
+        self.assertEquals(self.company.status.days_to_expiration, 30)
+
+    def test_invalidated_on_issue(self):
+        self.assertEquals(self.company.status.open_issues, [])
+        self.company.add_db_issue(u"Error del SRI")
+        self.assertEquals(len(self.company.status.open_issues), 1)
+        self.assertIn(u"Error del SRI",
+                      [i.message for i in self.company.issues])
+
+    def test_cert(self):
+        self.assertTrue(any('cert' in i.url for i in self.company.issues))
+        models.Company.set_can_sign(self.company.id, True)
+        company = models.Company.objects.get(id=self.company.id)
+        self.assertTrue(company.can_sign)
+        self.assertFalse(any('cert' in i.url for i in company.issues))
+
+    def test_signer_not_asked(self):
+        def has_cert(ruc, company_id):
+            raise AssertionError("The signer was asked")
+        orig_has_cert = models.signature.has_cert
+        models.signature.has_cert = has_cert
+        try:
+            models.CompanyStatus.invalidate(self.company.id)
+            self.assertEquals(self.company.status.effective_licence, 'demo')
+            self.assertFalse(self.company.can_sign)
+            self.assertTrue(any('cert' in i.url for i in self.company.issues))
+        finally:
+            models.signature.has_cert = orig_has_cert
+
+    def test_refresh_can_sign(self):
+        answers = {self.company.id: True}
+
+        def has_cert(ruc, company_id):
+            answer = answers.get(company_id, False)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+        orig_has_cert = models.signature.has_cert
+        models.signature.has_cert = has_cert
+        try:
+            self.assertEquals(models.Company.refresh_can_sign(), 1)
+            self.assertTrue(
+                models.Company.objects.get(id=self.company.id).can_sign)
+            self.assertEquals(models.Company.refresh_can_sign(), 0)
+            # Kept when the signers do not answer
+            answers[self.company.id] = models.signature.Timeout()
+            self.assertEquals(models.Company.refresh_can_sign(), 0)
+            self.assertTrue(
+                models.Company.objects.get(id=self.company.id).can_sign)
+            answers[self.company.id] = False
+            self.assertEquals(models.Company.refresh_can_sign(), 1)
+            self.assertFalse(
+                models.Company.objects.get(id=self.company.id).can_sign)
+        finally:
+            models.signature.has_cert = orig_has_cert
+
+
+class SecuencialTests(MakeBaseInstances, TestCase):
+    def get_punto_emision(self):
+        return models.PuntoEmision.objects.get(id=self.punto_emision.id)
+
+    def test_allocate(self):
+        self.assertEquals(self.punto_emision.allocate_secuenciales(), [1])
+        self.assertEquals(self.punto_emision.allocate_secuenciales(3),
+                          [2, 3, 4])
+        self.assertEquals(self.get_punto_emision().siguiente_secuencial, 5)
+        self.assertEquals(
+            self.punto_emision.allocate_secuenciales(1, 'produccion'), [1])
+
+    def test_gaps(self):
+        self.punto_emision.allocate_secuenciales(5)
+        self.punto_emision.release_secuenciales([4, 2])
+        self.assertEquals(self.punto_emision.allocate_secuenciales(3),
+                          [2, 4, 6])
+        self.assertEquals(models.SecuencialGap.objects.count(), 0)
+        # Gaps above the counter are not used
+        self.punto_emision.release_secuenciales([20])
+        self.assertEquals(self.punto_emision.allocate_secuenciales(), [7])
+
+    def test_reservation(self):
+        reservation = models.SecuencialReservation(block_size=3)
+        self.assertEquals([reservation.take(self.punto_emision)
+                           for i in range(4)], [1, 2, 3, 4])
+        self.assertEquals(self.get_punto_emision().siguiente_secuencial, 7)
+        reservation.release()
+        self.assertEquals(self.punto_emision.allocate_secuenciales(3),
+                          [5, 6, 7])
@@ -3,8 +3,9 @@ from datetime import datetime, date, timedelta
 import pytz
 import json
 
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory
 from django.core.urlresolvers import reverse
+from django.http import Http404
 from django.http.response import HttpResponseRedirect
 
 from company_accounts import models, views
@@ -477,6 +478,44 @@ class GenericObjectCRUDTest(object):
             "The list view shows objects from a different company")
 
 
+class SelectedObjectsTests(MakeBaseInstances, TestCase):
+    """
+    The selected company, establecimiento and punto de emision
+    are loaded once per view
+    """
+    def make_view(self, cls, user=None, **kwargs):
+        view = cls()
+        view.request = RequestFactory().get('/')
+        view.request.user = user or self.user
+        view.kwargs = kwargs
+        return view
+
+    def test_punto_emision_selected(self):
+        view = self.make_view(views.PuntoEmisionSelected,
+                              punto_emision_id=str(self.punto_emision.id))
+        # punto de emision with its chain, and the CompanyUser check
+        with self.assertNumQueries(2):
+            for i in range(3):
+                self.assertEquals(view.punto_emision, self.punto_emision)
+                self.assertEquals(view.establecimiento, self.establecimiento)
+                self.assertEquals(view.company, self.company)
+
+    def test_establecimiento_selected(self):
+        view = self.make_view(views.EstablecimientoSelected,
+                              establecimiento_id=str(self.establecimiento.id))
+        with self.assertNumQueries(2):
+            for i in range(3):
+                self.assertEquals(view.establecimiento, self.establecimiento)
+                self.assertEquals(view.company, self.company)
+
+    def test_not_company_user(self):
+        user = add_User(username="pepe", password='pepe_pw')
+        view = self.make_view(views.PuntoEmisionSelected, user=user,
+                              punto_emision_id=str(self.punto_emision.id))
+        with self.assertRaises(Http404):
+            view.company
+
+
 class LicenceTests(TestCase):
     """
     Logged in user that is associated with a company
@@ -9,11 +9,11 @@ from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView, UpdateView, FormView
 from django.core.urlresolvers import reverse
 from django.db.models import Count
+from django.utils.functional import cached_property
 
 import models
 import forms
 from licence_helpers import LicenceControlMixin
-from util import signature
 from sri.models import AmbienteSRI
 
 import tienda_ecuador_project.forms
@@ -98,19 +98,28 @@ def company_create(request):
 class CompanySelected(object):
     """
     Class that offers the self.company attribute.
-    The attribute checks that the company exists, or 404
+    The attribute checks that the company exists, or 404.
+    The company and the objects selected by the subclasses
+    are loaded once per request and memoized on the view
     """
     @classmethod
     def as_view(cls, **initkwargs):
         view = super(CompanySelected, cls).as_view(**initkwargs)
         return login_required(view)
 
-    @property
+    @cached_property
     def company(self):
+        company = self.get_selected_company()
         # Ensure there is a corresponding CompanyUser, or 404
         get_object_or_404(
             models.CompanyUser,
-            user_id=self.request.user.id, company_id=self.company_id)
+            user_id=self.request.user.id, company_id=company.id)
+        return company
+
+    def get_selected_company(self):
+        """
+        Overridable method to load the current company
+        """
         return get_object_or_404(models.Company, id=self.company_id)
 
     @property
@@ -129,7 +138,7 @@ class CompanySelected(object):
         context['support_form'] = support_contact_form
         return context
 
-    @property
+    @cached_property
     def single_punto_emision(self):
         """
         Returns a PuntoEmision object if it's the only one
@@ -143,11 +152,24 @@ class CompanySelected(object):
             return None
 
 
+def same_id(a, b):
+    """
+    Compares ids that may come from the URL as strings
+    """
+    return unicode(a) == unicode(b)
+
+
 class EstablecimientoSelected(CompanySelected):
-    @property
+    @cached_property
     def establecimiento(self):
+        return self.get_selected_establecimiento()
+
+    def get_selected_establecimiento(self):
+        """
+        Overridable method to load the current establecimiento
+        """
         return get_object_or_404(
-            models.Establecimiento,
+            models.Establecimiento.objects.select_related('company'),
             id=self.establecimiento_id)
 
     @property
@@ -156,7 +178,13 @@ class EstablecimientoSelected(CompanySelected):
 
     @property
     def company_id(self):
-        return self.establecimiento.company.id
+        return self.establecimiento.company_id
+
+    def get_selected_company(self):
+        establecimiento = self.establecimiento
+        if same_id(establecimiento.company_id, self.company_id):
+            return establecimiento.company
+        return super(EstablecimientoSelected, self).get_selected_company()
 
     def get_context_data(self, **kwargs):
         context = super(EstablecimientoSelected, self).get_context_data(**kwargs)
@@ -165,10 +193,17 @@ class EstablecimientoSelected(CompanySelected):
 
 
 class PuntoEmisionSelected(EstablecimientoSelected):
-    @property
+    @cached_property
     def punto_emision(self):
+        return self.get_selected_punto_emision()
+
+    def get_selected_punto_emision(self):
+        """
+        Overridable method to load the current punto de emision
+        """
         return get_object_or_404(
-            models.PuntoEmision,
+            models.PuntoEmision.objects.select_related(
+                'establecimiento__company'),
             id=self.punto_emision_id)
 
     @property
@@ -177,7 +212,13 @@ class PuntoEmisionSelected(EstablecimientoSelected):
 
     @property
     def establecimiento_id(self):
-        return self.punto_emision.establecimiento.id
+        return self.punto_emision.establecimiento_id
+
+    def get_selected_establecimiento(self):
+        punto_emision = self.punto_emision
+        if same_id(punto_emision.establecimiento_id, self.establecimiento_id):
+            return punto_emision.establecimiento
+        return super(PuntoEmisionSelected, self).get_selected_establecimiento()
 
     def get_context_data(self, **kwargs):
         context = super(PuntoEmisionSelected, self).get_context_data(**kwargs)
@@ -267,7 +308,7 @@ class CompanyUploadCertView(CompanyView, CompanySelected, FormView):
     def form_valid(self, form):
         cert_key = form.cleaned_data['cert_key']
         cert_data = form.cleaned_data['cert_data']
-        signature.add_cert(self.company.ruc, self.company.id, cert_data, cert_key)
+        self.company.add_cert(cert_data, cert_key)
         return super(CompanyUploadCertView, self).form_valid(form)
 
 
@@ -5,7 +5,7 @@ from django.db import models
 from django.core.urlresolvers import reverse
 
 import company_accounts.models
-from sri.models import Tax, Iva, Ice
+from sri.models import Tax, Iva, Ice, tax_catalog
 
 from util.enum import Enum
 import purchases.models
@@ -54,29 +54,34 @@ class Item(models.Model):
     @property
     def taxes(self):
         """
-        Returns the properly typed tax items
+        Returns the properly typed tax items.
+        Use prefetch_related('tax_items') to avoid one query per access
         """
-        def typecast(v):
-            for t in [Iva, Ice]:
-                try:
-                    return t.objects.get(id=v.id)
-                except t.DoesNotExist:
-                    pass
-        return map(typecast, self.tax_items.all())
+        return [tax_catalog.get(tax.id) for tax in self.tax_items.all()]
+
+    def get_tax(self, cls, taxes=None):
+        for i in self.taxes if taxes is None else taxes:
+            if type(i) == cls:
+                return i
 
     @property
     def ice(self):
-        for i in self.taxes:
-            if type(i) == Ice:
-                return i
+        return self.get_tax(Ice)
 
     @property
     def iva(self):
-        for i in self.taxes:
-            if type(i) == Iva:
-                return i
-        else:
+        return self.iva_ice[0]
+
+    @property
+    def iva_ice(self):
+        """
+        Returns the IVA and the ICE, fetching the tax items once
+        """
+        taxes = self.taxes
+        iva = self.get_tax(Iva, taxes)
+        if iva is None:
             raise Exception("Error: No IVA")
+        return iva, self.get_tax(Ice, taxes)
 
     @property
     def increment_qty(self):
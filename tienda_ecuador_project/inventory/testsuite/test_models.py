@@ -102,6 +102,21 @@ class ItemTests(MakeBaseInstances, TestCase, TestHelpersMixin):
         """
         self.assertEquals(str(self.item), "12345 - Test Item")
 
+    def test_taxes(self):
+        """
+        iva e ice se obtienen del m2m precargado y del catalogo de impuestos
+        """
+        item = models.Item.objects.prefetch_related('tax_items').get(
+            id=self.item.id)
+        self.item.iva
+        with self.assertNumQueries(0):
+            self.assertEquals(item.iva, self.iva)
+            self.assertEquals(item.ice, self.ice)
+        # Without prefetching, both with a single query
+        item = models.Item.objects.get(id=self.item.id)
+        with self.assertNumQueries(1):
+            self.assertEquals(item.iva_ice, (self.iva, self.ice))
+
 
 class SKUTests(MakeBaseInstances, TestCase, TestHelpersMixin):
     """
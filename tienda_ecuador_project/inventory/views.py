@@ -120,8 +120,7 @@ class ItemUpdateView(ItemView, CompanySelected, UpdateView):
     def get_form(self, *args, **kwargs):
         form = super(ItemUpdateView, self).get_form(*args, **kwargs)
         item = models.Item.objects.get(pk=self.kwargs['pk'])
-        form.fields['iva'].initial = item.iva
-        form.fields['ice'].initial = item.ice
+        form.fields['iva'].initial, form.fields['ice'].initial = item.iva_ice
         return form
 
     def form_valid(self, form):
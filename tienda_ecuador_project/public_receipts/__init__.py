@@ -0,0 +1 @@
+default_app_config = 'public_receipts.apps.PublicReceiptsConfig'
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class PublicReceiptsConfig(AppConfig):
+    name = 'public_receipts'
+
+    def ready(self):
+        from public_receipts import ride_cache
+        # Refuse to start without the directory of the cache
+        ride_cache.get_cache_dir()
@@ -0,0 +1,128 @@
+"""
+Code 128 barcodes, drawn as vector bars on the reportlab canvas
+"""
+from reportlab.platypus import Flowable
+
+# Widths of the bars and spaces of every symbol value, in modules
+PATTERNS = (
+    '212222', '222122', '222221', '121223', '121322', '131222', '122213', '122312',
+    '132212', '221213', '221312', '231212', '112232', '122132', '122231', '113222',
+    '123122', '123221', '223211', '221132', '221231', '213212', '223112', '312131',
+    '311222', '321122', '321221', '312212', '322112', '322211', '212123', '212321',
+    '232121', '111323', '131123', '131321', '112313', '132113', '132311', '211313',
+    '231113', '231311', '112133', '112331', '132131', '113123', '113321', '133121',
+    '313121', '211331', '231131', '213113', '213311', '213131', '311123', '311321',
+    '331121', '312113', '312311', '332111', '314111', '221411', '431111', '111224',
+    '111422', '121124', '121421', '141122', '141221', '112214', '112412', '122114',
+    '122411', '142112', '142211', '241211', '221114', '413111', '241112', '134111',
+    '111242', '121142', '121241', '114212', '124112', '124211', '411212', '421112',
+    '421211', '212141', '214121', '412121', '111143', '111341', '131141', '114113',
+    '114311', '411113', '411311', '113141', '114131', '311141', '411131', '211412',
+    '211214', '211232', '2331112',
+)
+
+CODE_C = 99
+CODE_B = 100
+START_B = 104
+START_C = 105
+STOP = 106
+
+
+def get_bars(pattern):
+    """
+    (offset, width) of the bars of a pattern, and its width
+    """
+    bars = []
+    x = 0
+    for i, width in enumerate(pattern):
+        width = int(width)
+        if i % 2 == 0:
+            bars.append((x, width))
+        x += width
+    return tuple(bars), x
+
+# (bars, width) of every symbol value
+SYMBOLS = tuple(get_bars(pattern) for pattern in PATTERNS)
+
+
+def count_digits(data, start):
+    end = start
+    while end < len(data) and data[end].isdigit():
+        end += 1
+    return end - start
+
+
+def encode(data):
+    """
+    Symbol values of data, with the start, the check symbol and the stop.
+    The runs of 4 or more digits are encoded in code set C,
+    in pairs, and the rest in code set B
+    """
+    if not data:
+        raise ValueError("No data for the barcode")
+    values = []
+    code = None
+    i = 0
+    while i < len(data):
+        digits = count_digits(data, i)
+        if code == CODE_C:
+            if digits >= 2:
+                values.append(int(data[i:i + 2]))
+                i += 2
+                continue
+            values.append(CODE_B)
+            code = CODE_B
+        elif digits >= 4:
+            values.append(START_C if code is None else CODE_C)
+            code = CODE_C
+            continue
+        elif code is None:
+            values.append(START_B)
+            code = CODE_B
+        value = ord(data[i]) - 32
+        if not 0 <= value < 96:
+            raise ValueError(u"Not in Code 128: {!r}".format(data[i]))
+        values.append(value)
+        i += 1
+    check = values[0]
+    for position, value in enumerate(values[1:], 1):
+        check += position * value
+    values.append(check % 103)
+    values.append(STOP)
+    return values
+
+
+def get_barcode_bars(data):
+    """
+    (offset, width) of the bars of the barcode of data,
+    and its width, in modules
+    """
+    bars = []
+    x = 0
+    for value in encode(data):
+        symbol_bars, symbol_width = SYMBOLS[value]
+        bars.extend((x + offset, width) for offset, width in symbol_bars)
+        x += symbol_width
+    return bars, x
+
+
+class Code128(Flowable):
+    """
+    Barcode of data, stretched to width x height points,
+    without quiet zones
+    """
+    def __init__(self, data, width, height):
+        Flowable.__init__(self)
+        self.bars, self.modules = get_barcode_bars(data)
+        self.width = width
+        self.height = height
+
+    def wrap(self, availWidth, availHeight):
+        return self.width, self.height
+
+    def draw(self):
+        scale = float(self.width) / self.modules
+        path = self.canv.beginPath()
+        for x, width in self.bars:
+            path.rect(x * scale, 0, width * scale, self.height)
+        self.canv.drawPath(path, stroke=0, fill=1)
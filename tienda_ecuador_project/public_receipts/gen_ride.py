@@ -2,10 +2,6 @@
 import pytz
 from io import BytesIO
 from contextlib import contextmanager
-import StringIO
-import xml.etree.ElementTree as ET
-
-from elaphe.code128 import Code128
 
 from django.templatetags import l10n
 
@@ -16,11 +12,16 @@ from reportlab.platypus import Paragraph, Frame, Table, Image  # , Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib import colors, utils
 
+from public_receipts import barcode
 from sri.models import SRIStatus, AmbienteSRI
 from util.templatetags.decimal_format import money_2d, decimals
 
 tz = pytz.timezone('America/Guayaquil')
 
+# Changed with the layout of the RIDEs,
+# the RIDEs cached by ride_cache for other versions are not used
+RIDE_VERSION = 2
+
 
 def gen_bill_ride(ob):
     print "Generating PDF"
@@ -127,38 +128,9 @@ def get_warning(ob):
     return res
 
 
-def make_barcode(data):
-    """
-    Makes a GS1-128 barcode as an image
-    @param data: the data to put in the barcode
-    @return: file-like object with a png as content
-    """
-    out = StringIO.StringIO()
-    image = Code128().render(data, scale=2, margin=0)
-    for i in range(image.size[0] - 1, 0, -1):
-        pix = image.getpixel((i, 0))
-        if pix[0] == 0:
-            image = image.crop((0, 0, i+1, image.size[1]))
-            break
-    image.save(out, "png")
-    out.seek(0)
-    return out
-
-
-def get_bill_number_from_tree(tree):
-    return u"{}-{}-{}".format(tree.find("./infoTributaria/estab").text,
-                              tree.find("./infoTributaria/ptoEmi").text,
-                              tree.find("./infoTributaria/secuencial").text)
-
-
 def gen_bill_ride_stuff(ob):
     buffer_ = BytesIO()
 
-    try:
-        tree = ET.fromstring(ob.xml_content.encode('utf8'))
-    except ET.ParseError:
-        tree = None
-
     pagesize = A4
     margin = inch, inch, inch, inch
 
@@ -264,15 +236,15 @@ def gen_bill_ride_stuff(ob):
             subtipo = None
             if ob.status == SRIStatus.options.Accepted:
                 tipo = "FACTURA"
-                number = get_bill_number_from_tree(tree)
+                number = ob.get_bill_number()
             elif ob.status == SRIStatus.options.Annulled:
                 tipo = "FACTURA ANULADA"
                 subtipo = "SIN VALIDEZ TRIBUTARIA"
-                number = get_bill_number_from_tree(tree)
+                number = ob.get_bill_number()
             elif ob.status == SRIStatus.options.Sent:
                 tipo = "FACTURA ANULADA"
                 subtipo = "PENDIENTE DE AUTORIZACIÓN"
-                number = get_bill_number_from_tree(tree)
+                number = ob.get_bill_number()
             else:
                 tipo = "PROFORMA"
                 subtipo = "SIN VALIDEZ TRIBUTARIA"
@@ -288,7 +260,7 @@ def gen_bill_ride_stuff(ob):
                                        mediumheader))
                 story.append(Paragraph(ob.clave_acceso,
                                        small))
-                story.append(Image(make_barcode(ob.clave_acceso), width=c.width(1), height=c.height(0.1)))
+                story.append(barcode.Code128(ob.clave_acceso, c.width(1), c.height(0.1)))
             if ob.numero_autorizacion:
                 story.append(Paragraph(u"Autorización",
                                        mediumheader))
@@ -325,11 +297,11 @@ def gen_bill_ride_stuff(ob):
                    (u'Total',            c.width(0.1))]
         data, widths = zip(*headers)
         data = [data]
-        for item in ob.items:
+        for item in ob.totals.lines:
             linea = [
                 item.code,
                 '',
-                str(decimals(item.qty, item.sku.batch.item.decimales_qty)),
+                str(decimals(item.qty, item.decimales_qty)),
                 item.name,
                 str(decimals(item.unit_price, 4)),
                 str(decimals(item.discount, 2)),
@@ -353,12 +325,13 @@ def gen_bill_ride_stuff(ob):
             extrainfo_table.hAlign = 'LEFT'
             add_items([extrainfo_table])
         with c.section(col_mid_point, 0, 1, 1, margin=(0, 0, 0, 0)):
+            totals = ob.totals
             data = [
-                ["Subtotal IVA 12%", money_2d(ob.subtotal[12])],
-                ["Subtotal IVA 0%", money_2d(ob.subtotal[0])],
-                ["IVA 12%", money_2d(ob.iva[12])],
-                ['ICE', money_2d(ob.total_ice)],
-                ["Total a Pagar", money_2d(ob.total)],
+                ["Subtotal IVA 12%", money_2d(totals.subtotal[12])],
+                ["Subtotal IVA 0%", money_2d(totals.subtotal[0])],
+                ["IVA 12%", money_2d(totals.iva[12])],
+                ['ICE', money_2d(totals.total_ice)],
+                ["Total a Pagar", money_2d(totals.total)],
             ]
             totals_table = Table(data,
                                  style=[('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
@@ -0,0 +1,151 @@
+"""
+Cache of the RIDEs on disk. Once sent to the SRI a comprobante
+can not be modified, so its RIDE only changes with its status.
+The RIDEs are kept by clave de acceso, status and RIDE_VERSION,
+and the least recently used ones are removed when the cache
+takes more than MAX_SIZE bytes. The cache is swept after each
+process writes SWEEP_BYTES bytes, so it can take a few SWEEP_BYTES more
+"""
+import errno
+import os
+import tempfile
+from io import BytesIO
+
+from public_receipts import gen_ride
+from sri.models import SRIStatus
+from util.data_dirs import get_data_dir
+
+# Directory of the cache, the setting RIDE_CACHE_DIR when it is None
+cache_dir = None
+
+MAX_SIZE = 256 * 1024 * 1024
+SWEEP_BYTES = 16 * 1024 * 1024
+
+# Bytes written by this process since the last sweep
+_written = 0
+
+# The comprobantes in the other status can still be modified
+CACHED_STATUS = [
+    SRIStatus.options.Sent,
+    SRIStatus.options.Accepted,
+    SRIStatus.options.Annulled,
+]
+
+
+def get_cache_dir():
+    """
+    Raises ImproperlyConfigured when RIDE_CACHE_DIR
+    is not set or is not usable
+    """
+    return cache_dir or get_data_dir('RIDE_CACHE_DIR')
+
+
+def get_path(ob):
+    return make_path(ob.clave_acceso, ob.status)
+
+
+def make_path(clave_acceso, status):
+    return os.path.join(get_cache_dir(), '{}_{}_{}.pdf'.format(
+        clave_acceso, status, gen_ride.RIDE_VERSION))
+
+
+def is_cached(ob):
+    return bool(ob.clave_acceso) and ob.status in CACHED_STATUS
+
+
+def open_cached(ob):
+    """
+    File with the cached RIDE of ob, None when it is not there
+    """
+    path = get_path(ob)
+    try:
+        f = open(path, 'rb')
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    try:
+        # Recently used
+        os.utime(path, None)
+    except OSError:
+        pass
+    return f
+
+
+def get_ride(ob):
+    """
+    The RIDE of ob, from the cache when it is there
+    """
+    if not is_cached(ob):
+        return gen_ride.gen_bill_ride(ob)
+    f = open_cached(ob)
+    if f is not None:
+        with f:
+            return f.read()
+    pdf = gen_ride.gen_bill_ride(ob)
+    store(ob.clave_acceso, get_path(ob), pdf)
+    return pdf
+
+
+def open_ride(ob):
+    """
+    File with the RIDE of ob. The RIDEs pre-rendered by
+    manage.py sri_worker are streamed from the cache,
+    the others are rendered
+    """
+    f = open_cached(ob) if is_cached(ob) else None
+    return f or BytesIO(get_ride(ob))
+
+
+def store(clave_acceso, path, pdf):
+    """
+    Adds a RIDE, replacing the ones of the comprobante in other status
+    """
+    global _written
+    fd, tmp_path = tempfile.mkstemp(dir=get_cache_dir(), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    for status in CACHED_STATUS:
+        other = make_path(clave_acceso, status)
+        if other != path:
+            try:
+                os.remove(other)
+            except OSError:
+                pass
+    _written += len(pdf)
+    if _written >= SWEEP_BYTES:
+        _written = 0
+        sweep()
+
+
+def sweep(max_size=None):
+    """
+    Removes the least recently used RIDEs over max_size bytes
+    """
+    max_size = MAX_SIZE if max_size is None else max_size
+    entries = []
+    directory = get_cache_dir()
+    for name in os.listdir(directory):
+        if not name.endswith('.pdf'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Removed by another process
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
\ No newline at end of file
@@ -0,0 +1,70 @@
+from io import BytesIO
+
+from django.test import TestCase
+from reportlab.lib.units import inch
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import Frame
+
+from public_receipts import barcode
+
+
+def decode(bars, width):
+    """
+    Reads the data back from the bars, as a scanner would
+    """
+    modules = [0] * width
+    for x, w in bars:
+        modules[x:x + w] = [1] * w
+    runs = []
+    for module in modules:
+        if runs and runs[-1][0] == module:
+            runs[-1][1] += 1
+        else:
+            runs.append([module, 1])
+    widths = ''.join(str(w) for module, w in runs)
+    values = [barcode.PATTERNS.index(widths[i:i + 6])
+              for i in range(0, len(widths) - 7, 6)]
+    assert widths[-7:] == barcode.PATTERNS[barcode.STOP]
+    check = values[0] + sum(i * v for i, v in enumerate(values[1:-1], 1))
+    assert check % 103 == values[-1]
+    data = ''
+    code = values[0]
+    for value in values[1:-1]:
+        if value in (barcode.CODE_B, barcode.CODE_C):
+            code = value
+        elif code in (barcode.CODE_C, barcode.START_C):
+            data += '%02d' % value
+        else:
+            data += chr(value + 32)
+    return data
+
+
+class BarcodeTests(TestCase):
+    def test_clave_acceso(self):
+        clave_acceso = '2209201501170439497000120021000000146680001466819'
+        values = barcode.encode(clave_acceso)
+        # 24 pairs of digits in code set C, the last one in B
+        self.assertEquals(values[0], barcode.START_C)
+        self.assertEquals(values[-4:-2], [barcode.CODE_B, ord('9') - 32])
+        bars, width = barcode.get_barcode_bars(clave_acceso)
+        self.assertEquals(width, 11 * 28 + 13)
+        self.assertEquals(decode(bars, width), clave_acceso)
+
+    def test_mixed(self):
+        for data in ['ABC 12345x', '1', '12', 'x1234', '001-002-000000123']:
+            bars, width = barcode.get_barcode_bars(data)
+            self.assertEquals(decode(bars, width), data)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            barcode.encode('')
+        with self.assertRaises(ValueError):
+            barcode.encode(u'\xf1')
+
+    def test_draw(self):
+        out = BytesIO()
+        canvas = Canvas(out)
+        flowable = barcode.Code128('1234', 3 * inch, inch)
+        Frame(0, 0, 4 * inch, 2 * inch).addFromList([flowable], canvas)
+        canvas.save()
+        self.assertTrue(out.getvalue().startswith('%PDF'))
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from public_receipts import gen_ride, ride_cache
+from sri.models import SRIStatus
+
+
+class Comprobante(object):
+    def __init__(self, clave_acceso, status):
+        self.clave_acceso = clave_acceso
+        self.status = status
+
+
+class RideCacheTests(TestCase):
+    def setUp(self):
+        self.orig_cache_dir = ride_cache.cache_dir
+        self.orig_gen_bill_ride = gen_ride.gen_bill_ride
+        ride_cache.cache_dir = tempfile.mkdtemp()
+        self.rendered = []
+
+        def gen_bill_ride(ob):
+            self.rendered.append((ob.clave_acceso, ob.status))
+            return 'PDF {} {}'.format(ob.clave_acceso, ob.status)
+        gen_ride.gen_bill_ride = gen_bill_ride
+
+    def tearDown(self):
+        shutil.rmtree(ride_cache.cache_dir)
+        ride_cache.cache_dir = self.orig_cache_dir
+        gen_ride.gen_bill_ride = self.orig_gen_bill_ride
+
+    def test_cached(self):
+        ob = Comprobante('111', SRIStatus.options.Accepted)
+        self.assertEquals(ride_cache.get_ride(ob), 'PDF 111 Accepted')
+        self.assertEquals(ride_cache.get_ride(ob), 'PDF 111 Accepted')
+        self.assertEquals(self.rendered, [('111', 'Accepted')])
+
+    def test_not_cached(self):
+        ob = Comprobante('', SRIStatus.options.NotSent)
+        ride_cache.get_ride(ob)
+        ride_cache.get_ride(ob)
+        self.assertEquals(len(self.rendered), 2)
+        self.assertEquals(os.listdir(ride_cache.cache_dir), [])
+
+    def test_status_change(self):
+        ob = Comprobante('111', SRIStatus.options.Accepted)
+        ride_cache.get_ride(ob)
+        ob.status = SRIStatus.options.Annulled
+        self.assertEquals(ride_cache.get_ride(ob), 'PDF 111 Annulled')
+        self.assertEquals(os.listdir(ride_cache.cache_dir),
+                          [os.path.basename(ride_cache.get_path(ob))])
+
+    def test_version_change(self):
+        ob = Comprobante('111', SRIStatus.options.Accepted)
+        ride_cache.get_ride(ob)
+        gen_ride.RIDE_VERSION += 1
+        try:
+            ride_cache.get_ride(ob)
+        finally:
+            gen_ride.RIDE_VERSION -= 1
+        self.assertEquals(len(self.rendered), 2)
+
+    def test_lru(self):
+        orig_max_size = ride_cache.MAX_SIZE
+        orig_sweep_bytes = ride_cache.SWEEP_BYTES
+        # Room for two RIDEs, swept on every write
+        ride_cache.MAX_SIZE = 2 * len('PDF 111 Accepted')
+        ride_cache.SWEEP_BYTES = 1
+        try:
+            comprobantes = [Comprobante(clave, SRIStatus.options.Accepted)
+                            for clave in ['111', '222', '333']]
+            for i, ob in enumerate(comprobantes[:2]):
+                ride_cache.get_ride(ob)
+                os.utime(ride_cache.get_path(ob), (1000 + i, 1000 + i))
+            # 111 used after 222
+            ride_cache.get_ride(comprobantes[0])
+            ride_cache.get_ride(comprobantes[2])
+        finally:
+            ride_cache.MAX_SIZE = orig_max_size
+            ride_cache.SWEEP_BYTES = orig_sweep_bytes
+        self.assertEquals(sorted(os.listdir(ride_cache.cache_dir)),
+                          [os.path.basename(ride_cache.get_path(ob))
+                           for ob in [comprobantes[0], comprobantes[2]]])
+
+    def test_sweep_interval(self):
+        orig_max_size = ride_cache.MAX_SIZE
+        orig_sweep_bytes = ride_cache.SWEEP_BYTES
+        orig_written = ride_cache._written
+        ride_cache.MAX_SIZE = len('PDF 111 Accepted')
+        # Swept every three RIDEs
+        ride_cache.SWEEP_BYTES = 3 * len('PDF 111 Accepted')
+        ride_cache._written = 0
+        try:
+            for clave in ['111', '222']:
+                ride_cache.get_ride(Comprobante(clave, SRIStatus.options.Accepted))
+            self.assertEquals(len(os.listdir(ride_cache.cache_dir)), 2)
+            ride_cache.get_ride(Comprobante('333', SRIStatus.options.Accepted))
+            self.assertEquals(len(os.listdir(ride_cache.cache_dir)), 1)
+        finally:
+            ride_cache.MAX_SIZE = orig_max_size
+            ride_cache.SWEEP_BYTES = orig_sweep_bytes
+            ride_cache._written = orig_written
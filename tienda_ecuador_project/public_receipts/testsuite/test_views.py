@@ -8,9 +8,12 @@ from django.test import TestCase, Client
 from django.core.urlresolvers import reverse
 
 import billing.models
+from util import artifacts
 import billing.testsuite.test_models
 
-from util.testsuite.helpers import add_instance, TestHelpersMixin
+from util.testsuite.helpers import (add_instance,
+                                    TemporaryArtifactsMixin,
+                                    TestHelpersMixin)
 
 
 def get_date():
@@ -23,11 +26,12 @@ def fix_keys(keys):
     return [k for k in keys if k not in bad_keys]
 
 
-class ReceiptViewTests(TestCase, TestHelpersMixin):
+class ReceiptViewTests(TemporaryArtifactsMixin, TestCase, TestHelpersMixin):
     """
     Tests that check that the models have all the required fields
     """
     def setUp(self):
+        super(ReceiptViewTests, self).setUp()
         self.company = add_instance(
             billing.models.Company,
             **billing.testsuite.test_models.base_data['Company'])
@@ -88,4 +92,19 @@ class ReceiptViewTests(TestCase, TestHelpersMixin):
         c = Client()
         r = c.get(
             reverse("public-receipts:receipt_view_xml", args=(clave_acceso,)))
-        self.assertEquals(r.content, self.bill.xml_content)
+        self.assertEquals(''.join(r.streaming_content), self.bill.xml_content)
+        self.assertEquals(r['Content-Disposition'],
+                          'attachment; filename={}.xml'.format(self.bill.number))
+
+    def test_receipt_get_xml_accel_redirect(self):
+        clave_acceso = '4545454545'
+        key = self.bill._meta.get_field('xml_content').key(self.bill)
+        artifacts.accel_redirect = '/protected/artifacts/'
+        try:
+            r = Client().get(
+                reverse("public-receipts:receipt_view_xml", args=(clave_acceso,)))
+        finally:
+            artifacts.accel_redirect = None
+        self.assertEquals(r.content, '')
+        self.assertEquals(r['X-Accel-Redirect'],
+                          '/protected/artifacts/{}/{}/{}'.format(key[:2], key[2:4], key))
@@ -3,9 +3,10 @@ import pytz
 from django.shortcuts import render, redirect
 from django.views.generic import View
 from django.views.generic import TemplateView
-from django.http import HttpResponse
+from django.http import FileResponse
 
 import billing.models
+from public_receipts import ride_cache
 
 tz = pytz.timezone('America/Guayaquil')
 
@@ -66,9 +67,9 @@ class ReceiptXMLView(PublicReceiptView, View):
         data = self.get_receipt_data(clave)
         if data:
             ob = data['object']
-            response = HttpResponse(ob.xml_content, content_type='text/xml; charset=utf-8')
-            response['Content-Disposition'] = 'attachment; filename={}.xml'.format(ob.number)
-            return response
+            field = ob._meta.get_field('xml_content')
+            return field.serve(ob, 'text/xml; charset=utf-8',
+                               '{}.xml'.format(ob.number))
         else:
             return render(request,
                           'public_receipts/not_found.html',
@@ -84,12 +85,9 @@ class ReceiptRIDEView(PublicReceiptView, View):
         data = self.get_receipt_data(clave)
         if data:
             ob = data['object']
-            response = HttpResponse(content_type='application/pdf')
+            response = FileResponse(ride_cache.open_ride(ob),
+                                    content_type='application/pdf')
             response['Content-Disposition'] = 'attachment; filename="{}.pdf"'.format(ob.number)
-            import gen_ride
-            reload(gen_ride)
-            pdf = gen_ride.gen_bill_ride(ob)
-            response.write(pdf)
             return response
         else:
             return render(request,
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import util.artifacts
+from util import artifacts
+
+
+def check_artifact_dir(apps, schema_editor):
+    """
+    The documents are moved out of the database,
+    only to a directory that outlives the deploys
+    """
+    artifacts.get_artifact_dir()
+
+
+def move_xml_to_store(apps, schema_editor):
+    """
+    Moves the XML of the purchases to the artifact store,
+    the column is left with its key
+    """
+    Purchase = apps.get_model('purchases', 'Purchase')
+    purchases = (Purchase.objects.exclude(xml_content='')
+                                 .only('id', 'xml_content')
+                                 .order_by('id'))
+    for purchase in purchases.iterator():
+        data = purchase.xml_content.encode('utf-8')
+        Purchase.objects.filter(id=purchase.id).update(
+            xml_content=artifacts.put(data), xml_size=len(data))
+
+
+def load_xml_from_store(apps, schema_editor):
+    Purchase = apps.get_model('purchases', 'Purchase')
+    purchases = (Purchase.objects.exclude(xml_content='')
+                                 .only('id', 'xml_content')
+                                 .order_by('id'))
+    for purchase in purchases.iterator():
+        Purchase.objects.filter(id=purchase.id).update(
+            xml_content=artifacts.get(purchase.xml_content).decode('utf-8'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('purchases', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_artifact_dir, check_artifact_dir),
+        migrations.AddField(
+            model_name='purchase',
+            name='xml_size',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(move_xml_to_store, load_xml_from_store),
+        migrations.AlterField(
+            model_name='purchase',
+            name='xml_content',
+            field=util.artifacts.ArtifactField(blank=True, default='', editable=False, max_length=64, size_field='xml_size'),
+        ),
+    ]
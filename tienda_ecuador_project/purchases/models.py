@@ -8,7 +8,7 @@ from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.core.files.storage import FileSystemStorage
 
-from util import signature
+from util import artifacts, signature
 from stakeholders import models as stakeholders
 import inventory.models
 
@@ -19,8 +19,10 @@ class Purchase(models.Model):
     """
     date = models.DateField(
         default=date.today)
-    xml_content = models.TextField(
-        )
+    xml_content = artifacts.ArtifactField(
+        size_field='xml_size')
+    xml_size = models.IntegerField(
+        default=0)
     seller = models.ForeignKey(
         stakeholders.Seller)
     closed = models.BooleanField(
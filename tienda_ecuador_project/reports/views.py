@@ -6,6 +6,8 @@ from calendar import LocaleHTMLCalendar, monthrange
 from datetime import date
 from itertools import groupby
 
+from django.db.models import Sum
+from django.db.models.query import QuerySet
 from django.views.generic.list import ListView
 from django.views.generic.detail import DetailView
 from django.core.urlresolvers import reverse
@@ -249,7 +251,12 @@ class BillDateListReport(DateListReport):
         return res
 
     def get_total(self, items):
-        return sum([i.total_sin_iva for i in items], Decimal(0))
+        if isinstance(items, QuerySet):
+            totals = items.aggregate(total=Sum('stored_total'),
+                                     iva=Sum('stored_iva'))
+            return ((totals['total'] or Decimal(0)) -
+                    (totals['iva'] or Decimal(0)))
+        return sum([i.stored_total_sin_iva for i in items], Decimal(0))
 
     def format_text(self, item_list):
         if len(item_list) == 1:
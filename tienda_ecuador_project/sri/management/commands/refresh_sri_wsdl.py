@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from util import sri_sender
+
+
+class Command(BaseCommand):
+    help = "Downloads the SRI WSDLs into the local copy used by sri_sender"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--entorno', choices=sorted(sri_sender.urls), default=None,
+            help="Only refresh the WSDLs of this entorno")
+
+    def handle(self, *args, **options):
+        entornos = sorted(sri_sender.urls)
+        if options['entorno']:
+            entornos = [options['entorno']]
+        for entorno in entornos:
+            for service in sorted(sri_sender.urls[entorno]):
+                for path in sri_sender.refresh_wsdl(entorno, service):
+                    self.stdout.write("{} {}: {}".format(
+                        entorno, service, path))
@@ -1,14 +1,18 @@
 # * encoding: utf-8 *
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import json
+import re
 import pytz
 from decimal import Decimal
 
 from django.db import models
+from django.db.models import Case, Q, When, Value
 from django.core.exceptions import ValidationError
 from django.db import transaction
 
-from util import sri_sender
+from sri import schemas, xml_builder
+from util import artifacts, signature, sri_sender
 from util.enum import Enum
 
 
@@ -19,6 +23,14 @@ class Tax(models.Model):
     valor_fijo = models.DecimalField(
         decimal_places=2, max_digits=6, default=Decimal('0.00'))
 
+    def save(self, **kwargs):
+        super(Tax, self).save(**kwargs)
+        tax_catalog.invalidate()
+
+    def delete(self, **kwargs):
+        super(Tax, self).delete(**kwargs)
+        tax_catalog.invalidate()
+
 
 class Iva(Tax):
     """
@@ -39,6 +51,46 @@ class Ice(Tax):
         return u"{:.0f}% - {}".format(self.porcentaje, self.descripcion)
 
 
+class TaxCatalog(object):
+    """
+    In-memory catalog of the taxes, keyed by Tax id.
+    Holds the concrete Iva or Ice instance of every tax, loaded in one query.
+    Loaded once per process and cleared whenever a tax is saved or deleted.
+    The instances are shared, so they must not be modified
+    """
+    def __init__(self):
+        self._taxes = None
+
+    def load(self):
+        taxes = {}
+        for tax in Tax.objects.select_related('iva', 'ice'):
+            for cls in [Iva, Ice]:
+                try:
+                    tax = getattr(tax, cls.__name__.lower())
+                    break
+                except cls.DoesNotExist:
+                    pass
+            taxes[tax.id] = tax
+        self._taxes = taxes
+        return taxes
+
+    def invalidate(self):
+        self._taxes = None
+
+    def get(self, tax_id):
+        """
+        Returns the Iva, Ice or plain Tax for the given Tax id, or None
+        """
+        taxes = self._taxes
+        if taxes is None or tax_id not in taxes:
+            # Taxes loaded from fixtures do not go through Tax.save
+            taxes = self.load()
+        return taxes.get(tax_id)
+
+
+tax_catalog = TaxCatalog()
+
+
 SRIStatus = Enum(
     "SRIStatus",
     (   # Invalido o no enviado
@@ -70,6 +122,52 @@ AmbienteSRI = Enum(
 )
 
 
+class InvalidComprobante(Exception):
+    """
+    The comprobante does not match its XSD, it was not sent
+    """
+    def __init__(self, messages):
+        super(InvalidComprobante, self).__init__(messages)
+        self.messages = messages
+
+
+def convert_sri_messages(messages):
+    def convert_msg(msg):
+        converted = {}
+        for key in ['tipo', 'identificador',
+                    'mensaje', 'informacionAdicional']:
+            converted[key] = getattr(msg, key, None)
+        return converted
+    return [convert_msg(msg) for msg in messages]
+
+
+def gen_lote_xml(clave_acceso_lote, ruc, comprobantes_xml):
+    """
+    XML of a lote masivo with the signed comprobantes
+    """
+    def to_str(xml):
+        if isinstance(xml, unicode):
+            return xml.encode('utf-8')
+        return xml
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<lote version="1.0.0">',
+        '<claveAcceso>{}</claveAcceso>'.format(clave_acceso_lote),
+        '<ruc>{}</ruc>'.format(ruc),
+        '<comprobantes>',
+    ]
+    for xml in comprobantes_xml:
+        parts.append('<comprobante><![CDATA[{}]]></comprobante>'.format(
+            to_str(xml)))
+    parts.append('</comprobantes>')
+    parts.append('</lote>')
+    return '\n'.join(parts)
+
+
+# Clave de acceso of the comprobantes in the lote authorization responses
+_clave_acceso_re = re.compile(r'<claveAcceso>\s*(\d+)\s*</claveAcceso>')
+
+
 class ComprobanteSRIMixin(models.Model):
     """
     Mixin that checks if the bill can be modified before saving it
@@ -77,16 +175,48 @@ class ComprobanteSRIMixin(models.Model):
     class Meta:
         abstract = True
 
-    xml_content = models.TextField(blank=True)
+    # Comprobantes can be annulled up to 15 days after authorization.
+    # They are checked often at first, and less as they get older:
+    # the delay is ANNULMENT_CHECK_BACKOFF times their age
+    ANNULMENT_CHECK_DAYS = 15
+    ANNULMENT_CHECK_MIN_DELAY = timedelta(hours=1)
+    ANNULMENT_CHECK_BACKOFF = 0.5
+
+    # Identificador of the SRI message when the clave de acceso
+    # was already received, its secuencial is not given back
+    CLAVE_ACCESO_REGISTRADA = '43'
+
+    # Outbound comprobantes without result after this time
+    # are checked in the SRI by recover_outbound
+    OUTBOUND_TIMEOUT = timedelta(minutes=10)
+
+    # Limits of the lotes masivos
+    LOTE_MAX_SIZE = 500 * 1024
+    LOTE_MAX_COMPROBANTES = 50
+
+    # The signed comprobante, and the response of the SRI
+    # when it is authorized, in the artifact store
+    xml_content = artifacts.ArtifactField(size_field='xml_size')
+    xml_size = models.IntegerField(default=0)
+    authorization_xml = artifacts.ArtifactField(
+        size_field='authorization_xml_size')
+    authorization_xml_size = models.IntegerField(default=0)
 
     clave_acceso = models.CharField(
         max_length=50, blank=True, default='')
+    # Clave de acceso of the lote masivo the comprobante was sent in
+    clave_acceso_lote = models.CharField(
+        max_length=50, blank=True, default='')
     numero_autorizacion = models.CharField(
         max_length=50, blank=True, default='')
     fecha_autorizacion = models.DateTimeField(
         null=True, blank=True)
     issues = models.TextField(
         default='', blank=True)
+    # Set when the signed comprobante is saved to be submitted,
+    # cleared when the result of the submission is recorded
+    outbound_at = models.DateTimeField(
+        null=True, blank=True, db_index=True)
 
     ambiente_sri = models.CharField(
         max_length=20,
@@ -99,6 +229,9 @@ class ComprobanteSRIMixin(models.Model):
 
     sri_last_check = models.DateTimeField(
         null=True, blank=True)
+    # Due queue of the annulment checks, only set while they are needed
+    next_annulment_check_at = models.DateTimeField(
+        null=True, blank=True, db_index=True)
 
     @property
     def can_be_modified(self):
@@ -162,9 +295,11 @@ class ComprobanteSRIMixin(models.Model):
         assert self.ambiente_sri in [AmbienteSRI.options.pruebas,
                                      AmbienteSRI.options.produccion]
         self.status = SRIStatus.options.ReadyToSend
+        # A new secuencial is taken when sending it
+        self.secuencial = 0
         self.save()
 
-    def send_to_SRI(self):
+    def send_to_SRI(self, secuenciales=None, prepared=False):
         """
         Sends a bill to SRI
         Requires:
@@ -176,29 +311,31 @@ class ComprobanteSRIMixin(models.Model):
         After:
             status = Sent or NotSent
             maybe Issues
+        Runs in short steps, without a transaction open
+        during the requests:
+            the secuencial is taken and the signed XML saved as outbound
+            the comprobante is submitted
+            the result is recorded
+        recover_outbound takes care of the comprobantes
+        whose result was never recorded.
+        secuenciales is a SecuencialReservation of a worker.
+        prepared is True when prepare_many_for_SRI just prepared it,
+        only for comprobantes that had no clave de acceso
         """
         assert self.status == SRIStatus.options.ReadyToSend
         assert self.ambiente_sri in [AmbienteSRI.options.pruebas,
                                      AmbienteSRI.options.produccion]
         assert self.punto_emision
 
-        def convert_messages(messages):
-            def convert_msg(msg):
-                converted = {}
-                for key in ['tipo', 'identificador',
-                            'mensaje', 'informacionAdicional']:
-                    converted[key] = getattr(msg, key, None)
-                return converted
-            return [convert_msg(msg) for msg in messages]
-
         # Check it has not been sent and accepted
-        if self.clave_acceso:
+        if self.clave_acceso and not prepared:
             autorizar_comprobante_result = sri_sender.autorizar_comprobante(
                 self.clave_acceso, entorno=self.ambiente_sri)
             if int(autorizar_comprobante_result.numeroComprobantes) > 0:
                 for autorizacion in autorizar_comprobante_result.autorizaciones.autorizacion:
                     if autorizacion.estado == 'AUTORIZADO':
                         self.status = SRIStatus.options.Sent
+                        self.outbound_at = None
                         self.secret_save()
                         return True
                     elif autorizacion.estado == 'RECHAZADA':
@@ -206,45 +343,292 @@ class ComprobanteSRIMixin(models.Model):
                     else:  # Not processed yet
                         return False
 
-        with transaction.atomic():
-            punto_emision = self.punto_emision
-
-            self.ambiente_sri = punto_emision.ambiente_sri
-            self.secuencial = {
-                'pruebas': punto_emision.siguiente_secuencial_pruebas,
-                'produccion': punto_emision.siguiente_secuencial_produccion,
-            }[self.ambiente_sri]
+        if not prepared:
+            try:
+                self.prepare_for_SRI(self.take_secuencial(secuenciales))
+            except InvalidComprobante:
+                return False
+
+        enviar_comprobante_result = sri_sender.enviar_comprobante(
+            self.xml_content, entorno=self.ambiente_sri)
+        self.outbound_at = None
+        if enviar_comprobante_result.estado == 'RECIBIDA':
+            self.status = SRIStatus.options.Sent
             self.secret_save()
+            res = True
+        else:
+            enviar_msgs = (enviar_comprobante_result.comprobantes
+                           .comprobante[0].mensajes.mensaje)
+            with transaction.atomic():
+                self.set_returned(convert_sri_messages(enviar_msgs))
+                self.secret_save()
+            res = False
+        assert self.status in [SRIStatus.options.Sent,
+                               SRIStatus.options.Rejected]
+        return res
 
-            # Generate and sign XML
-            xml_data, clave_acceso = self.gen_xml()
+    def take_secuencial(self, secuenciales=None):
+        """
+        Secuencial of the comprobante in the ambiente of its punto
+        de emision. It is taken once, in its own short transaction,
+        and kept until the SRI returns the comprobante,
+        so a retry after a failure sends the same number.
+        secuenciales is a SecuencialReservation of a worker
+        """
+        punto_emision = self.punto_emision
+        ambiente = punto_emision.ambiente_sri
+        if self.secuencial and self.ambiente_sri == ambiente:
+            return self.secuencial
+        if self.secuencial:
+            # The punto de emision changed of ambiente
+            self.release_secuencial()
+        if secuenciales is not None:
+            secuencial = secuenciales.take(punto_emision, ambiente)
+        else:
+            secuencial, = punto_emision.allocate_secuenciales(1, ambiente)
+        self.ambiente_sri = ambiente
+        self.secuencial = secuencial
+        (type(self).objects.filter(id=self.id)
+                           .update(ambiente_sri=ambiente,
+                                   secuencial=secuencial))
+        return secuencial
+
+    def set_legal_number(self):
+        """
+        Keeps the establecimiento, punto de emision and secuencial
+        of the XML, and the number formed with them,
+        so the XML is not parsed to show the number
+        """
+        self.legal_estab = self.punto_emision.establecimiento.codigo
+        self.legal_pto_emi = self.punto_emision.codigo
+        self.legal_secuencial = u'{:09d}'.format(self.secuencial)
+        self.legal_number = u'{}-{}-{}'.format(
+            self.legal_estab, self.legal_pto_emi, self.legal_secuencial)
 
-            self.xml_content = xml_data
-            self.clave_acceso = clave_acceso
-            self.issues = ''
-            self.secret_save()
+    def release_secuencial(self):
+        """
+        Gives the secuencial back to the punto de emision
+        """
+        self.punto_emision.release_secuenciales([self.secuencial],
+                                                self.ambiente_sri)
+        self.secuencial = 0
 
-            enviar_comprobante_result = sri_sender.enviar_comprobante(
-                self.xml_content, entorno=self.ambiente_sri)
-            if enviar_comprobante_result.estado == 'RECIBIDA':
-                punto_emision = self.punto_emision
-                if self.ambiente_sri == AmbienteSRI.options.pruebas:
-                    punto_emision.siguiente_secuencial_pruebas += 1
-                else:
-                    punto_emision.siguiente_secuencial_produccion += 1
-                punto_emision.save()
-                self.status = SRIStatus.options.Sent
+    def set_returned(self, messages):
+        """
+        The SRI returned the comprobante with messages,
+        it is Rejected and its secuencial is given back,
+        unless the SRI already had that clave de acceso
+        """
+        self.issues = json.dumps(messages)
+        self.status = SRIStatus.options.Rejected
+        if not any(msg['identificador'] == self.CLAVE_ACCESO_REGISTRADA
+                   for msg in messages):
+            self.release_secuencial()
+
+    def prepare_for_SRI(self, secuencial, signed=None):
+        """
+        Generates the signed XML and the clave de acceso
+        with the secuencial, and saves them as outbound.
+        signed is the (signed XML, clave de acceso) when they were
+        already generated.
+        If the XML does not match its XSD the comprobante is returned,
+        as the SRI would do, and InvalidComprobante is raised
+        """
+        self.ambiente_sri = self.punto_emision.ambiente_sri
+        self.secuencial = secuencial
+
+        # Generate and sign XML
+        xml_data, clave_acceso = signed or self.gen_xml()
+
+        self.xml_content = xml_data
+        self.clave_acceso = clave_acceso
+        self.clave_acceso_lote = ''
+        self.issues = ''
+        self.set_legal_number()
+        messages = schemas.validate(xml_data)
+        if messages:
+            self.outbound_at = None
+            with transaction.atomic():
+                self.set_returned(messages)
                 self.secret_save()
-                res = True
+            raise InvalidComprobante(messages)
+        self.outbound_at = datetime.now(tz=pytz.timezone('America/Guayaquil'))
+        self.secret_save()
+
+    @classmethod
+    def prepare_many_for_SRI(cls, comprobantes, secuenciales=None):
+        """
+        prepare_for_SRI for many comprobantes,
+        signing all of them with a single signature.sign_batch.
+        Returns {id: exception} for the ones not prepared
+        """
+        errors = {}
+        unsigned = []
+        for comprobante in comprobantes:
+            try:
+                secuencial = comprobante.take_secuencial(secuenciales)
+                comprobante.ambiente_sri = comprobante.punto_emision.ambiente_sri
+                comprobante.secuencial = secuencial
+                xml_content, clave_acceso = comprobante.gen_unsigned_xml()
+            except Exception as e:
+                errors[comprobante.id] = e
+                continue
+            unsigned.append((comprobante, xml_content, clave_acceso))
+        signed = signature.sign_batch([
+            (comprobante.company.ruc, comprobante.company.id, xml_content)
+            for comprobante, xml_content, clave_acceso in unsigned])
+        for (comprobante, xml_content, clave_acceso), signed_xml in zip(
+                unsigned, signed):
+            if isinstance(signed_xml, Exception):
+                errors[comprobante.id] = signed_xml
+                continue
+            try:
+                comprobante.prepare_for_SRI(comprobante.secuencial,
+                                            (signed_xml, clave_acceso))
+            except InvalidComprobante as e:
+                errors[comprobante.id] = e
+        return errors
+
+    @classmethod
+    def send_lotes_to_SRI(cls, comprobantes, secuenciales=None):
+        """
+        Sends ReadyToSend comprobantes in lotes masivos, one lote
+        per company and ambiente, split when the limits are reached.
+        The comprobantes alone in their group are not sent.
+        Returns {id: True if sent, False if rejected}.
+        The comprobantes not in the result are still ReadyToSend
+        """
+        groups = OrderedDict()
+        for comprobante in comprobantes:
+            assert comprobante.status == SRIStatus.options.ReadyToSend
+            assert comprobante.punto_emision
+            key = (comprobante.company_id,
+                   comprobante.punto_emision.ambiente_sri)
+            groups.setdefault(key, []).append(comprobante)
+
+        res = {}
+        for group in groups.values():
+            while len(group) > 1:
+                sent, group = cls.send_lote_to_SRI(group, secuenciales)
+                res.update(sent)
+        return res
+
+    @classmethod
+    def send_lote_to_SRI(cls, comprobantes, secuenciales=None):
+        """
+        Sends the first comprobantes that fit in a lote.
+        All of them must be of the same company and ambiente.
+        Returns ({id: True if sent, False if rejected},
+                 comprobantes left to send)
+        When the lote is returned nothing is left to send,
+        the comprobantes without messages keep their secuenciales
+        for the next time.
+        The comprobantes that could not be signed are left out,
+        to be sent one by one, the ones not matching their XSD
+        are returned without sending them
+        """
+        candidates = comprobantes[:cls.LOTE_MAX_COMPROBANTES]
+        errors = cls.prepare_many_for_SRI(candidates, secuenciales)
+        res = {id: False for id, error in errors.iteritems()
+               if isinstance(error, InvalidComprobante)}
+        lote = []
+        remaining = []
+        size = 0
+        for comprobante in candidates:
+            if comprobante.id in errors:
+                continue
+            xml_size = len(comprobante.xml_content)
+            if remaining or (lote and size + xml_size > cls.LOTE_MAX_SIZE):
+                # Keeps its secuencial for the next lote
+                comprobante.outbound_at = None
+                comprobante.secret_save()
+                remaining.append(comprobante)
+                continue
+            size += xml_size
+            lote.append(comprobante)
+        remaining.extend(comprobantes[cls.LOTE_MAX_COMPROBANTES:])
+        if not lote:
+            return res, remaining
+
+        first = lote[0]
+        clave_acceso_lote = cls.gen_clave_acceso_lote(lote)
+        lote_xml = gen_lote_xml(
+            clave_acceso_lote, first.company.ruc,
+            [comprobante.xml_content for comprobante in lote])
+        enviar_lote_result = sri_sender.enviar_lote(
+            lote_xml, entorno=first.ambiente_sri)
+
+        with transaction.atomic():
+            for comprobante in lote:
+                comprobante.outbound_at = None
+            if enviar_lote_result.estado == 'RECIBIDA':
+                for comprobante in lote:
+                    comprobante.clave_acceso_lote = clave_acceso_lote
+                    comprobante.status = SRIStatus.options.Sent
+                    comprobante.secret_save()
+                    res[comprobante.id] = True
             else:
-                enviar_msgs = (enviar_comprobante_result.comprobantes
-                               .comprobante[0].mensajes.mensaje)
-                self.issues = json.dumps(convert_messages(enviar_msgs))
-                self.status = SRIStatus.options.Rejected
-                self.secret_save()
-                res = False
-        assert self.status in [SRIStatus.options.Sent,
-                               SRIStatus.options.Rejected]
+                messages = {}
+                returned = getattr(enviar_lote_result.comprobantes,
+                                   'comprobante', [])
+                for returned_comprobante in returned:
+                    messages[returned_comprobante.claveAcceso] = (
+                        convert_sri_messages(
+                            returned_comprobante.mensajes.mensaje))
+                for comprobante in lote:
+                    # Errors of the lote apply to all its comprobantes
+                    comprobante_messages = messages.get(
+                        comprobante.clave_acceso,
+                        messages.get(clave_acceso_lote))
+                    if comprobante_messages is not None:
+                        comprobante.set_returned(comprobante_messages)
+                        res[comprobante.id] = False
+                    comprobante.secret_save()
+                remaining = []
+        return res, remaining
+
+    @classmethod
+    def recover_outbound(cls, older_than=None):
+        """
+        Checks in the SRI the outbound comprobantes whose result
+        was never recorded, like when the process died during the request.
+        The ones the SRI received are Sent, the others are left
+        to be submitted again, with the same secuencial.
+        Returns {id: True if Sent, False if to be submitted again}
+        """
+        limit = (datetime.now(tz=pytz.timezone('America/Guayaquil')) -
+                 (older_than or cls.OUTBOUND_TIMEOUT))
+        by_ambiente = OrderedDict()
+        for comprobante in cls.objects.filter(
+                status=SRIStatus.options.ReadyToSend,
+                outbound_at__lt=limit):
+            by_ambiente.setdefault(comprobante.ambiente_sri, []).append(
+                comprobante)
+
+        res = {}
+        for ambiente, comprobantes in by_ambiente.iteritems():
+            results = sri_sender.autorizar_comprobantes(
+                [comprobante.clave_acceso for comprobante in comprobantes],
+                entorno=ambiente)
+            for comprobante in comprobantes:
+                result = results[comprobante.clave_acceso]
+                if isinstance(result, Exception):
+                    continue
+                received = (
+                    int(result.numeroComprobantes) > 0 and
+                    any(autorizacion.estado != 'RECHAZADA'
+                        for autorizacion in result.autorizaciones.autorizacion))
+                if received:
+                    status = SRIStatus.options.Sent
+                else:
+                    status = SRIStatus.options.ReadyToSend
+                # Unless the submission finished meanwhile
+                updated = (cls.objects.filter(id=comprobante.id,
+                                              status=comprobante.status,
+                                              outbound_at=comprobante.outbound_at)
+                                      .update(status=status, outbound_at=None))
+                if updated:
+                    res[comprobante.id] = received
         return res
 
     def validate_in_SRI(self):
@@ -274,20 +658,33 @@ class ComprobanteSRIMixin(models.Model):
         assert self.ambiente_sri in [AmbienteSRI.options.pruebas,
                                      AmbienteSRI.options.produccion]
 
-        def convert_messages(messages):
-            def convert_msg(msg):
-                converted = {}
-                for key in ['tipo', 'identificador',
-                            'mensaje', 'informacionAdicional']:
-                    converted[key] = getattr(msg, key, None)
-            return map(convert_msg, messages)
-
         autorizar_comprobante_result = sri_sender.autorizar_comprobante(
             self.clave_acceso, entorno=self.ambiente_sri)
+        res = self.apply_authorization(autorizar_comprobante_result)
+        self.secret_save()
+        self.authorization_applied()
+        return res
 
+    def apply_authorization(self, autorizar_comprobante_result):
+        """
+        Updates the comprobante with the response of autorizar_comprobante,
+        without saving it
+        """
         if int(autorizar_comprobante_result.numeroComprobantes) > 0:
+            autorizaciones = autorizar_comprobante_result.autorizaciones.autorizacion
+        else:
+            autorizaciones = []
+        return self.apply_autorizaciones(autorizaciones)
+
+    def apply_autorizaciones(self, autorizaciones):
+        """
+        Updates the comprobante with its autorizaciones,
+        from autorizar_comprobante or autorizar_lote, without saving it
+        """
+        res = False
+        if autorizaciones:
             already_authorised = False
-            for autorizacion in autorizar_comprobante_result.autorizaciones.autorizacion:
+            for autorizacion in autorizaciones:
                 # This should not happen, but it happened
                 # The same bill was submitted twice, with same everything but randoms from signature
                 # It was approved both times
@@ -296,37 +693,41 @@ class ComprobanteSRIMixin(models.Model):
                         self.company.add_db_issue("""
 El comprobante con clave de acceso {clave_acceso} ha sido enviado y aprobado dos veces, con
 códigos de autorización {cod_1} y {cod_2}. Se recomienda anular el segundo."""
-                            .format(clave_acceso=autorizar_comprobante_result.claveAccesoConsultada,
+                            .format(clave_acceso=self.clave_acceso,
                                     cod_1=self.numero_autorizacion,
                                     cod_2=autorizacion.numeroAutorizacion))
                     else:
                         self.fecha_autorizacion = autorizacion.fechaAutorizacion
                         self.numero_autorizacion = autorizacion.numeroAutorizacion
+                        self.authorization_xml = xml_builder.autorizacion(
+                            autorizacion)
                         if autorizacion.mensajes:
                             self.issues = json.dumps(
-                                convert_messages(autorizacion.mensajes.mensaje))
+                                convert_sri_messages(autorizacion.mensajes.mensaje))
                         self.status = SRIStatus.options.Accepted
-                        self.secret_save()
                         res = True
                         already_authorised = True
                 elif autorizacion.estado == 'RECHAZADA':
                     self.fecha_autorizacion = autorizacion.fechaAutorizacion
                     self.issues = json.dumps(
-                        convert_messages(autorizacion.mensajes.mensaje))
+                        convert_sri_messages(autorizacion.mensajes.mensaje))
                     self.status = SRIStatus.options.Rejected
-                    self.secret_save()
                     res = False
                 else:  # Aun no procesado??
                     # FIXME: log
                     res = False
-        else:
-            res = False
 
         self.sri_last_check = datetime.now(
             tz=pytz.timezone('America/Guayaquil'))
+        if self.status == SRIStatus.options.Accepted:
+            self.next_annulment_check_at = self.get_next_annulment_check(
+                self.fecha_autorizacion, self.sri_last_check)
+        return res
 
-        self.secret_save()
-
+    def authorization_applied(self):
+        """
+        Called once the response of the SRI has been saved
+        """
         if self.status == SRIStatus.options.Sent:
             # Nothing changed
             pass
@@ -338,17 +739,186 @@ códigos de autorización {cod_1} y {cod_2}. Se recomienda anular el segundo."""
             assert self.issues
         else:
             assert False  # This should not happen
+
+    @classmethod
+    def autorizar_many(cls, comprobantes):
+        """
+        Queries the SRI concurrently for the comprobantes.
+        Returns {clave_acceso: result}, see sri_sender.autorizar_comprobantes
+        """
+        claves_by_ambiente = {}
+        for comprobante in comprobantes:
+            claves_by_ambiente.setdefault(
+                comprobante.ambiente_sri, []).append(comprobante.clave_acceso)
+        results = {}
+        for ambiente, claves in claves_by_ambiente.iteritems():
+            results.update(sri_sender.autorizar_comprobantes(
+                claves, entorno=ambiente))
+        return results
+
+    @classmethod
+    def autorizar_lotes(cls, comprobantes):
+        """
+        Queries the SRI once for each lote of the comprobantes.
+        Returns {clave_acceso: list of autorizaciones of the comprobante},
+        or the exception raised when querying its lote
+        """
+        lotes = OrderedDict()
+        for comprobante in comprobantes:
+            key = (comprobante.clave_acceso_lote, comprobante.ambiente_sri)
+            lotes.setdefault(key, []).append(comprobante.clave_acceso)
+        results = {}
+        for (clave_acceso_lote, ambiente), claves in lotes.iteritems():
+            try:
+                result = sri_sender.autorizar_lote(clave_acceso_lote,
+                                                   entorno=ambiente)
+                autorizaciones = {clave: [] for clave in claves}
+                if int(result.numeroComprobantesLote) > 0:
+                    for autorizacion in result.autorizaciones.autorizacion:
+                        match = _clave_acceso_re.search(autorizacion.comprobante)
+                        if match and match.group(1) in autorizaciones:
+                            autorizaciones[match.group(1)].append(autorizacion)
+                results.update(autorizaciones)
+            except Exception as e:
+                results.update(dict.fromkeys(claves, e))
+        return results
+
+    @classmethod
+    def validate_many_in_SRI(cls, comprobantes):
+        """
+        validate_in_SRI for many comprobantes, querying the SRI concurrently.
+        The comprobantes that are still being processed are updated
+        with a single query.
+        Returns {id: result of validate_in_SRI},
+        or the exception if the response could not be applied
+        """
+        for comprobante in comprobantes:
+            assert comprobante.clave_acceso
+            assert comprobante.status == SRIStatus.options.Sent
+        in_lote = [c for c in comprobantes if c.clave_acceso_lote]
+        results = cls.autorizar_many(
+            [c for c in comprobantes if not c.clave_acceso_lote])
+        results.update(cls.autorizar_lotes(in_lote))
+
+        res = {}
+        pending_ids = []
+        with transaction.atomic():
+            for comprobante in comprobantes:
+                try:
+                    result = results[comprobante.clave_acceso]
+                    if isinstance(result, Exception):
+                        raise result
+                    if comprobante.clave_acceso_lote:
+                        res[comprobante.id] = comprobante.apply_autorizaciones(result)
+                    else:
+                        res[comprobante.id] = comprobante.apply_authorization(result)
+                except Exception as e:
+                    res[comprobante.id] = e
+                    continue
+                if comprobante.status == SRIStatus.options.Sent:
+                    pending_ids.append(comprobante.id)
+                else:
+                    comprobante.secret_save()
+                    comprobante.authorization_applied()
+            if pending_ids:
+                cls.objects.filter(id__in=pending_ids).update(
+                    sri_last_check=datetime.now(
+                        tz=pytz.timezone('America/Guayaquil')))
         return res
 
+    @classmethod
+    def get_next_annulment_check(cls, fecha_autorizacion, checked_at):
+        """
+        When to check again a comprobante authorized at fecha_autorizacion
+        and checked at checked_at. None if there is no need to check it again
+        """
+        tz = pytz.timezone('America/Guayaquil')
+        if fecha_autorizacion.tzinfo is None:
+            fecha_autorizacion = tz.localize(fecha_autorizacion)
+        last_check = (fecha_autorizacion
+                      + timedelta(days=cls.ANNULMENT_CHECK_DAYS)
+                      - cls.ANNULMENT_CHECK_MIN_DELAY)
+        if checked_at >= last_check:
+            return None
+        age = checked_at - fecha_autorizacion
+        delay = max(cls.ANNULMENT_CHECK_MIN_DELAY,
+                    timedelta(seconds=age.total_seconds() * cls.ANNULMENT_CHECK_BACKOFF))
+        return min(checked_at + delay, last_check)
+
+    @classmethod
+    def get_annulment_check_schedule(cls, fecha_autorizacion, start=None):
+        """
+        Times of the annulment checks of a comprobante, from start
+        """
+        when = start or cls.get_next_annulment_check(fecha_autorizacion,
+                                                     fecha_autorizacion)
+        while when:
+            yield when
+            when = cls.get_next_annulment_check(fecha_autorizacion, when)
+
     def check_if_annulled_worthy(self):
         if self.status != SRIStatus.options.Accepted:
             return False
-        if datetime.now(tz=pytz.timezone('America/Guayaquil')) - self.fecha_autorizacion < timedelta(days=15):
-            if not self.sri_last_check:
-                return True
-            elif datetime.now(tz=pytz.timezone('America/Guayaquil')) - self.sri_last_check > timedelta(hours=1):
-                return True
-        return False
+        if not self.next_annulment_check_at:
+            return False
+        return self.next_annulment_check_at <= datetime.now(
+            tz=pytz.timezone('America/Guayaquil'))
+
+    @classmethod
+    def claim_annulment_checks(cls, max_comprobantes, lease_seconds=300):
+        """
+        Takes up to max_comprobantes due for an annulment check.
+        They are not due again until lease_seconds later,
+        so other workers do not take them meanwhile.
+        The ones that can not be annulled any more,
+        because their window closed or they are not Accepted,
+        are not checked again
+        """
+        current = datetime.now(tz=pytz.timezone('America/Guayaquil'))
+        window_start = current - timedelta(days=cls.ANNULMENT_CHECK_DAYS)
+        due = cls.objects.filter(next_annulment_check_at__lte=current)
+        with transaction.atomic():
+            (due.filter(Q(fecha_autorizacion__isnull=True) |
+                        Q(fecha_autorizacion__lte=window_start) |
+                        ~Q(status=SRIStatus.options.Accepted))
+                .update(next_annulment_check_at=None))
+            ids = list(due.select_for_update()
+                          .order_by('next_annulment_check_at')
+                          .values_list('id', flat=True)[:max_comprobantes])
+            (cls.objects.filter(id__in=ids)
+                        .update(next_annulment_check_at=current + timedelta(seconds=lease_seconds)))
+        return list(cls.objects.filter(id__in=ids))
+
+    @classmethod
+    def annulment_check_stats(cls, when=None):
+        """
+        Annulment checks to run in the day starting at when,
+        and the ones that checking every hour would need
+        """
+        when = when or datetime.now(tz=pytz.timezone('America/Guayaquil'))
+        end = when + timedelta(days=1)
+        pending = (cls.objects
+                      .filter(next_annulment_check_at__isnull=False)
+                      .values_list('fecha_autorizacion',
+                                   'next_annulment_check_at'))
+        checks = 0
+        hourly_checks = 0
+        for fecha_autorizacion, next_check in pending:
+            window_end = min(
+                fecha_autorizacion + timedelta(days=cls.ANNULMENT_CHECK_DAYS),
+                end)
+            hourly_checks += max(
+                0, int((window_end - max(when, fecha_autorizacion)).total_seconds() // 3600))
+            for check in cls.get_annulment_check_schedule(fecha_autorizacion, next_check):
+                if check >= end:
+                    break
+                checks += 1
+        return {
+            'comprobantes': len(pending),
+            'checks': checks,
+            'hourly_checks': hourly_checks,
+            'saved': hourly_checks - checks,
+        }
 
     def check_if_annulled_in_SRI(self):
         """
@@ -365,22 +935,86 @@ códigos de autorización {cod_1} y {cod_2}. Se recomienda anular el segundo."""
                 status = Annulled
             sri_last_check is set to now
         """
+        self.check_annullable()
+        autorizar_comprobante_result = sri_sender.autorizar_comprobante(
+            self.clave_acceso, entorno=self.ambiente_sri)
+        res = self.apply_annulment_check(autorizar_comprobante_result)
+        self.secret_save()
+        return res
+
+    def check_annullable(self):
         assert self.clave_acceso
         assert self.status == SRIStatus.options.Accepted
         assert self.ambiente_sri in [AmbienteSRI.options.pruebas,
                                      AmbienteSRI.options.produccion]
-        assert datetime.now(tz=pytz.timezone('America/Guayaquil')) - self.fecha_autorizacion < timedelta(days=15)
-
-        autorizar_comprobante_result = sri_sender.autorizar_comprobante(
-            self.clave_acceso, entorno=self.ambiente_sri)
+        assert datetime.now(tz=pytz.timezone('America/Guayaquil')) - self.fecha_autorizacion < timedelta(days=self.ANNULMENT_CHECK_DAYS)
 
-        if int(autorizar_comprobante_result.numeroComprobantes) == 1:
-            # All right
-            res = False
-        elif int(autorizar_comprobante_result.numeroComprobantes) == 0:
+    def apply_annulment_check(self, autorizar_comprobante_result):
+        """
+        Updates the comprobante with the response of autorizar_comprobante,
+        without saving it
+        """
+        self.sri_last_check = datetime.now(tz=pytz.timezone('America/Guayaquil'))
+        if int(autorizar_comprobante_result.numeroComprobantes) == 0:
             self.status = SRIStatus.options.Annulled
+            self.next_annulment_check_at = None
             res = True
+        else:
+            # All right
+            self.next_annulment_check_at = self.get_next_annulment_check(
+                self.fecha_autorizacion, self.sri_last_check)
+            res = False
+        return res
 
-        self.sri_last_check = datetime.now(tz=pytz.timezone('America/Guayaquil'))
-        self.secret_save()
+    @classmethod
+    def check_many_if_annulled_in_SRI(cls, comprobantes):
+        """
+        check_if_annulled_in_SRI for many comprobantes,
+        querying the SRI concurrently and saving with two queries.
+        The next checks are scheduled with get_next_annulment_check.
+        Returns {id: result of check_if_annulled_in_SRI},
+        or the exception if the comprobante can not be checked
+        or the response could not be applied
+        """
+        res = {}
+        annullable = []
+        for comprobante in comprobantes:
+            try:
+                comprobante.check_annullable()
+            except Exception as e:
+                res[comprobante.id] = e
+            else:
+                annullable.append(comprobante)
+        comprobantes = annullable
+        results = cls.autorizar_many(comprobantes)
+
+        for comprobante in comprobantes:
+            try:
+                result = results[comprobante.clave_acceso]
+                if isinstance(result, Exception):
+                    raise result
+                res[comprobante.id] = comprobante.apply_annulment_check(result)
+            except Exception as e:
+                res[comprobante.id] = e
+        checked = [c for c in comprobantes
+                   if not isinstance(res[c.id], Exception)]
+        last_check = datetime.now(tz=pytz.timezone('America/Guayaquil'))
+        with transaction.atomic():
+            annulled_ids = [c.id for c in checked if res[c.id]]
+            if annulled_ids:
+                cls.objects.filter(id__in=annulled_ids).update(
+                    status=SRIStatus.options.Annulled,
+                    sri_last_check=last_check,
+                    next_annulment_check_at=None)
+            unchanged = [c for c in checked if not res[c.id]]
+            if unchanged:
+                next_checks = [
+                    When(id=c.id, then=Value(c.next_annulment_check_at,
+                                             output_field=models.DateTimeField()))
+                    for c in unchanged]
+                cls.objects.filter(id__in=[c.id for c in unchanged]).update(
+                    sri_last_check=last_check,
+                    next_annulment_check_at=Case(
+                        *next_checks,
+                        output_field=models.DateTimeField()))
         return res
@@ -0,0 +1,102 @@
+# * encoding: utf-8 *
+"""
+Validation of the comprobantes against the XSDs of the SRI,
+before sending them
+"""
+import os
+import threading
+
+from lxml import etree
+
+from util import signature
+
+# Official XSDs, by version
+schema_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'comprobantes_electronicos', 'xsd')
+
+# (root element, version attribute) -> XSD in schema_dir
+SCHEMAS = {
+    ('factura', '1.0.0'): os.path.join('1.0.0', 'factura_v1.0.0.xsd'),
+    ('factura', '1.1.0'): os.path.join('1.1.0', 'factura_v1.1.0.xsd'),
+    ('notaCredito', '1.0.0'): os.path.join('1.0.0', 'notaCredito_v1.0.0.xsd'),
+    ('notaCredito', '1.1.0'): os.path.join('1.1.0', 'notaCredito_v1.1.0.xsd'),
+    ('notaDebito', '1.0.0'): os.path.join('1.0.0', 'notaDebito_v1.0.0.xsd'),
+    ('guiaRemision', '1.0.0'): os.path.join('1.0.0', 'guiaRemision_v1.0.0.xsd'),
+    ('guiaRemision', '1.1.0'): os.path.join('1.1.0', 'guiaRemision_v1.1.0.xsd'),
+    ('comprobanteRetencion', '1.0.0'): os.path.join(
+        '1.0.0', 'comprobanteRetencion_v1.0.0.xsd'),
+}
+
+# All the versions import the same XML signature schema
+XMLDSIG_SCHEMA = os.path.join('1.1.0', 'xmldsig-core-schema.xsd')
+
+# Error of the SRI for the comprobantes not matching their XSD
+ESTRUCTURA_XML = '35'
+
+# Schema errors reported for a comprobante
+MAX_MESSAGES = 10
+
+
+class XMLDSigResolver(etree.Resolver):
+    def resolve(self, url, pubid, context):
+        if url.endswith('xmldsig-core-schema.xsd'):
+            return self.resolve_filename(
+                os.path.join(schema_dir, XMLDSIG_SCHEMA), context)
+
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def get_schema(key):
+    """
+    Compiled schema of (root element, version), with the lock
+    to use it. They are compiled once per process
+    """
+    schema = _schemas.get(key)
+    if schema is None:
+        with _schemas_lock:
+            schema = _schemas.get(key)
+            if schema is None:
+                parser = etree.XMLParser()
+                parser.resolvers.add(XMLDSigResolver())
+                tree = etree.parse(os.path.join(schema_dir, SCHEMAS[key]),
+                                   parser)
+                schema = _schemas[key] = (etree.XMLSchema(tree),
+                                          threading.Lock())
+    return schema
+
+
+def message(informacion_adicional):
+    """
+    Message in the shape of the ones of the SRI
+    """
+    return {
+        'tipo': 'ERROR',
+        'identificador': ESTRUCTURA_XML,
+        'mensaje': 'ARCHIVO NO CUMPLE ESTRUCTURA XML',
+        'informacionAdicional': informacion_adicional,
+    }
+
+
+def validate(xml):
+    """
+    Validates a comprobante against the XSD of its type and version.
+    Returns the list of errors, as SRI messages
+    """
+    try:
+        root = etree.fromstring(signature.to_bytes(xml))
+    except etree.XMLSyntaxError as e:
+        return [message(unicode(e))]
+    key = (root.tag, root.get('version'))
+    if key not in SCHEMAS:
+        return [message(u"No hay esquema para {} version {}".format(*key))]
+    schema, lock = get_schema(key)
+    # The error log is kept in the schema
+    with lock:
+        if schema.validate(root):
+            return []
+        errors = list(schema.error_log)
+    return [message(u"Linea {}: {}".format(error.line, error.message))
+            for error in errors[:MAX_MESSAGES]]
@@ -56,3 +56,37 @@ class IceTests(TestCase):
                     valor_fijo=Decimal("0.02"))
         n = models.Ice(**data)
         self.assertTrue(n)
+
+
+class TaxCatalogTests(MakeBaseInstances, TestCase):
+    def test_get(self):
+        models.tax_catalog.invalidate()
+        with self.assertNumQueries(1):
+            self.assertEquals(type(models.tax_catalog.get(self.iva.id)),
+                              models.Iva)
+            self.assertEquals(type(models.tax_catalog.get(self.ice.id)),
+                              models.Ice)
+        with self.assertNumQueries(0):
+            self.assertEquals(models.tax_catalog.get(self.iva.id).porcentaje,
+                              Decimal(12))
+
+    def test_invalidated_on_save(self):
+        models.tax_catalog.get(self.iva.id)
+        self.iva.porcentaje = Decimal(14)
+        self.iva.save()
+        self.assertEquals(models.tax_catalog.get(self.iva.id).porcentaje,
+                          Decimal(14))
+
+
+class LoteXMLTests(TestCase):
+    def test_gen_lote_xml(self):
+        import xml.etree.ElementTree as ET
+        xml = models.gen_lote_xml(
+            '123', '1790016919001',
+            ['<factura>1</factura>', u'<factura>\xf1</factura>'])
+        tree = ET.fromstring(xml)
+        self.assertEquals(tree.find('./claveAcceso').text, '123')
+        self.assertEquals(tree.find('./ruc').text, '1790016919001')
+        self.assertEquals(
+            [c.text for c in tree.findall('./comprobantes/comprobante')],
+            ['<factura>1</factura>', u'<factura>\xf1</factura>'])
@@ -0,0 +1,36 @@
+import os
+
+from django.test import TestCase
+
+from sri import schemas
+
+samples_dir = os.path.join(os.path.dirname(schemas.schema_dir), 'xml', '1.1.0')
+
+
+class SchemaTests(TestCase):
+    def read_sample(self, name):
+        with open(os.path.join(samples_dir, name)) as f:
+            return f.read()
+
+    def test_samples(self):
+        for name in ['factura.xml', 'guiaRemision.xml', 'notaCredito.xml']:
+            self.assertEquals(schemas.validate(self.read_sample(name)), [],
+                              name)
+
+    def test_compiled_once(self):
+        for key in schemas.SCHEMAS:
+            schema = schemas.get_schema(key)
+            self.assertIs(schemas.get_schema(key), schema)
+
+    def test_invalid(self):
+        xml = self.read_sample('factura.xml')
+        messages = schemas.validate(
+            xml.replace("<ruc>", "<RUC>").replace("</ruc>", "</RUC>"))
+        self.assertEquals(len(messages), 1)
+        self.assertEquals(messages[0]['identificador'], '35')
+        self.assertIn("RUC", messages[0]['informacionAdicional'])
+        self.assertEquals(
+            len(schemas.validate(xml.replace('version="1.1.0"',
+                                             'version="9.9.9"'))),
+            1)
+        self.assertEquals(len(schemas.validate(xml[:100])), 1)
@@ -0,0 +1,227 @@
+# * encoding: utf-8 *
+"""
+Writes the XML of the comprobantes directly, without the template engine.
+The output is compact and in canonical form: the same document
+as the templates, without the whitespace between the elements
+"""
+from django.utils import dateformat
+from django.utils.encoding import force_text
+from django.utils.timezone import template_localtime
+
+XML_DECLARATION = u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+
+
+def escape(value):
+    return (force_text(value).replace(u'&', u'&amp;')
+                             .replace(u'<', u'&lt;')
+                             .replace(u'>', u'&gt;')
+                             .replace(u'\r', u'&#xD;'))
+
+
+def escape_attribute(value):
+    return (escape(value).replace(u'"', u'&quot;')
+                         .replace(u'\t', u'&#x9;')
+                         .replace(u'\n', u'&#xA;'))
+
+
+def amount(value):
+    """
+    As the stringformat:'.2f' of the templates
+    """
+    return u'%.2f' % value
+
+
+def quantity(value):
+    return u'%.6f' % value
+
+
+class XMLWriter(object):
+    """
+    Collects the parts of a document, written in order
+    """
+    def __init__(self):
+        self.parts = [XML_DECLARATION]
+
+    def start(self, tag, **attrib):
+        self.parts.append(u'<' + tag)
+        for name, value in sorted(attrib.items()):
+            self.parts.append(u' {}="{}"'.format(name,
+                                                 escape_attribute(value)))
+        self.parts.append(u'>')
+
+    def end(self, tag):
+        self.parts.append(u'</{}>'.format(tag))
+
+    def element(self, tag, text, **attrib):
+        self.start(tag, **attrib)
+        self.parts.append(escape(text))
+        self.end(tag)
+
+    def elements(self, *pairs):
+        """
+        Elements with text, from (tag, text) pairs.
+        The pairs with text None are skipped
+        """
+        parts = self.parts
+        for tag, text in pairs:
+            if text is not None:
+                parts.append(u'<{0}>{1}</{0}>'.format(tag, escape(text)))
+
+    def getvalue(self):
+        return u''.join(self.parts).encode('utf-8')
+
+
+def factura(context):
+    """
+    XML of a factura, from the context of billing/proformabill_xml.html
+    """
+    bill = context['proformabill']
+    company = context['company']
+    establecimiento = context['establecimiento']
+    punto_emision = context['punto_emision']
+    totals = context['totals']
+    info_tributaria = context['info_tributaria']
+    info_factura = context['info_factura']
+
+    w = XMLWriter()
+    w.start('factura', id='comprobante', version='1.1.0')
+    w.start('infoTributaria')
+    w.elements(
+        ('ambiente', info_tributaria['ambiente']),
+        ('tipoEmision', info_tributaria['tipo_emision']),
+        ('razonSocial', company.razon_social),
+        ('nombreComercial', company.nombre_comercial or None),
+        ('ruc', company.ruc),
+        ('claveAcceso', info_tributaria['clave_acceso']),
+        ('codDoc', info_tributaria['cod_doc']),
+        ('estab', establecimiento.codigo),
+        ('ptoEmi', punto_emision.codigo),
+        ('secuencial', u'%09d' % context['secuencial']),
+        ('dirMatriz', company.direccion_matriz),
+    )
+    w.end('infoTributaria')
+
+    w.start('infoFactura')
+    w.elements(
+        ('fechaEmision', dateformat.format(template_localtime(bill.date),
+                                           'd/m/Y')),
+        ('dirEstablecimiento', establecimiento.direccion or None),
+        ('contribuyenteEspecial', company.contribuyente_especial or None),
+        ('obligadoContabilidad',
+         u'SI' if company.obligado_contabilidad else u'NO'),
+        ('tipoIdentificacionComprador',
+         info_factura['tipo_identificacion_comprador']),
+        ('razonSocialComprador', bill.issued_to.razon_social),
+        ('identificacionComprador', bill.issued_to.identificacion),
+        ('totalSinImpuestos', amount(totals.total_sin_impuestos)),
+        ('totalDescuento', amount(info_factura['total_descuento'])),
+    )
+    w.start('totalConImpuestos')
+    for impuesto in totals.impuestos:
+        w.start('totalImpuesto')
+        w.elements(
+            ('codigo', impuesto['codigo']),
+            ('codigoPorcentaje', impuesto['codigo_porcentaje']),
+            ('descuentoAdicional', u'0.00'),
+            ('baseImponible', amount(impuesto['base_imponible'])),
+            ('valor', amount(impuesto['valor'])),
+        )
+        w.end('totalImpuesto')
+    w.end('totalConImpuestos')
+    w.elements(
+        ('propina', amount(info_factura['propina'])),
+        ('importeTotal', amount(totals.total_con_impuestos)),
+        ('moneda', info_factura['moneda']),
+    )
+    w.end('infoFactura')
+
+    w.start('detalles')
+    for item in totals.lines:
+        w.start('detalle')
+        w.elements(
+            ('codigoPrincipal', item.code),
+            ('codigoAuxiliar', getattr(item, 'codigo_auxiliar', None) or None),
+            ('descripcion', item.name),
+            ('unidadMedida', getattr(item, 'unidad_medida', None) or None),
+            ('cantidad', quantity(item.qty)),
+            ('precioUnitario', quantity(item.unit_price)),
+            ('descuento', amount(item.discount)),
+            ('precioTotalSinImpuesto', amount(item.total_sin_impuestos)),
+        )
+        w.start('impuestos')
+        w.start('impuesto')
+        w.elements(
+            ('codigo', u'2'),
+            ('codigoPorcentaje', item.iva.codigo),
+            ('tarifa', amount(item.iva.porcentaje)),
+            ('baseImponible', amount(item.base_imponible_iva)),
+            ('valor', amount(item.valor_iva)),
+        )
+        w.end('impuesto')
+        if item.ice:
+            w.start('impuesto')
+            w.elements(
+                ('codigo', u'3'),
+                ('codigoPorcentaje', item.ice.codigo),
+                ('tarifa', amount(item.ice.porcentaje)),
+                ('baseImponible', amount(item.base_imponible_ice)),
+                ('valor', amount(item.valor_ice)),
+            )
+            w.end('impuesto')
+        w.end('impuestos')
+        w.end('detalle')
+    w.end('detalles')
+
+    retenciones = context.get('retenciones')
+    if retenciones:
+        w.start('retenciones')
+        for retencion in retenciones:
+            w.start('retencion')
+            w.elements(
+                ('codigo', retencion['codigo']),
+                ('codigoPorcentaje', retencion['codigo_porcentaje']),
+                ('tarifa', amount(retencion['tarifa'])),
+                ('valor', amount(retencion['valor'])),
+            )
+            w.end('retencion')
+        w.end('retenciones')
+
+    info_adicional = context.get('info_adicional')
+    if info_adicional:
+        w.start('infoAdicional')
+        for nombre, valor in info_adicional.iteritems():
+            w.element('campoAdicional', valor, nombre=nombre)
+        w.end('infoAdicional')
+    w.end('factura')
+    return w.getvalue()
+
+
+def autorizacion(autorizacion):
+    """
+    XML of an autorizacion of the SRI, as the files it gives
+    with the authorized comprobantes
+    """
+    w = XMLWriter()
+    w.start('autorizacion')
+    fecha = getattr(autorizacion, 'fechaAutorizacion', None)
+    w.elements(
+        ('estado', autorizacion.estado),
+        ('numeroAutorizacion',
+         getattr(autorizacion, 'numeroAutorizacion', None)),
+        ('fechaAutorizacion',
+         dateformat.format(template_localtime(fecha), 'd/m/Y H:i:s')
+         if fecha else None),
+        ('ambiente', getattr(autorizacion, 'ambiente', None)),
+        ('comprobante', getattr(autorizacion, 'comprobante', None)),
+    )
+    w.start('mensajes')
+    mensajes = getattr(autorizacion, 'mensajes', None)
+    for mensaje in (mensajes.mensaje if mensajes else []):
+        w.start('mensaje')
+        w.elements(*[(key, getattr(mensaje, key, None))
+                     for key in ('identificador', 'mensaje',
+                                 'informacionAdicional', 'tipo')])
+        w.end('mensaje')
+    w.end('mensajes')
+    w.end('autorizacion')
+    return w.getvalue()
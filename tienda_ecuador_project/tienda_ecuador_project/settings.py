@@ -176,6 +176,11 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        'signer': {
+            'handlers': ['file'],
+            'level': 'INFO',
+            'propagate': True,
+        },
         'email': {
             'level': 'DEBUG',
             'handlers': ['console'],
@@ -186,6 +191,9 @@ LOGGING = {
 
 SITE_ID = 1
 
+# Data that has to outlive the deploys, they replace the whole BASE_DIR
+DATA_DIR = os.path.join(os.path.expanduser('~'), 'tienda_ecuador_data')
+
 hostname = socket.gethostname()
 if "javier" not in hostname:
     # Production settings
@@ -201,3 +209,14 @@ if "javier" not in hostname:
             },
         }
     }
+    DATA_DIR = '/home/protected/data'
+
+# Signed comprobantes and authorizations of the SRI, see util.artifacts
+ARTIFACT_DIR = os.path.join(DATA_DIR, 'artifacts')
+# Pre-rendered RIDEs, see public_receipts.ride_cache
+RIDE_CACHE_DIR = os.path.join(DATA_DIR, 'ride_cache')
+# Certificates of the companies of the xades signing backend, see util.xades
+CERT_DIR = os.path.join(DATA_DIR, 'certs')
+# Fernet key of the passwords of those certificates,
+# from cryptography.fernet.Fernet.generate_key()
+CERT_PASSWORD_KEY = os.environ.get('CERT_PASSWORD_KEY')
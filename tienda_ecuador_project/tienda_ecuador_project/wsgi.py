@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tienda_ecuador_project.settings")
 
 application = get_wsgi_application()
+
+# Load the reference tables before serving the first request
+from billing.models import reference_data
+reference_data.warm()
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+
+class UtilConfig(AppConfig):
+    name = 'util'
+
+    def ready(self):
+        from util import artifacts, signature
+        # Refuse to start without the directory of the documents
+        artifacts.get_artifact_dir()
+        if signature.backend == 'xades':
+            from util import xades
+            xades.get_cert_dir()
+            xades.get_password_key()
@@ -0,0 +1,287 @@
+"""
+Content addressed store for the XML documents: the signed comprobantes,
+the authorizations of the SRI and the imported purchases.
+The rows only keep the key and the size of their documents,
+the documents are read from the store when they are used
+"""
+import errno
+import hashlib
+import importlib
+import os
+import tempfile
+from StringIO import StringIO
+
+from django.db import models
+from django.db.models import signals
+from django.http import FileResponse, HttpResponse
+
+from util.data_dirs import get_data_dir
+from util.signature import to_bytes
+
+# Directory of the documents of FileSystemBackend,
+# the setting ARTIFACT_DIR when it is None
+artifact_dir = None
+
+# Internal location of the web server with artifact_dir as its root,
+# like '/protected/artifacts/'. When set, the documents are sent
+# by the web server with X-Accel-Redirect, otherwise Django sends
+# the file, with the file_wrapper (sendfile) of the WSGI server
+accel_redirect = None
+
+# Backend of the store, one of BACKENDS
+backend = 'filesystem'
+
+BACKENDS = {
+    'filesystem': 'util.artifacts.FileSystemBackend',
+}
+
+
+class ArtifactNotFound(Exception):
+    """
+    The store does not have a document
+    """
+
+
+def get_artifact_dir():
+    """
+    The directory of the documents, raises ImproperlyConfigured
+    when ARTIFACT_DIR is not set or is not usable
+    """
+    return artifact_dir or get_data_dir('ARTIFACT_DIR')
+
+
+def make_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class Backend(object):
+    """
+    Keeps documents by their key, the sha256 of their content
+    """
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def get(self, key):
+        """
+        Content of the document, raises ArtifactNotFound
+        """
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def open(self, key):
+        """
+        Binary file object with the document
+        """
+        return StringIO(self.get(key))
+
+    def relative_path(self, key):
+        """
+        Path of the document inside artifact_dir,
+        None when the backend keeps it elsewhere
+        """
+        return None
+
+
+class FileSystemBackend(Backend):
+    """
+    Each document in its file, in <directory>/ab/cd/abcd...
+    The files are written to a temporary file and renamed,
+    so they are complete when they appear
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or get_artifact_dir()
+
+    def relative_path(self, key):
+        return os.path.join(key[:2], key[2:4], key)
+
+    def path(self, key):
+        return os.path.join(self.directory, self.relative_path(key))
+
+    def put(self, key, data):
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def open(self, key):
+        try:
+            return open(self.path(key), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise ArtifactNotFound(key)
+            raise
+
+    def get(self, key):
+        with self.open(key) as f:
+            return f.read()
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+
+_backends = {}
+
+
+def get_backend():
+    """
+    The instance of the configured backend
+    """
+    try:
+        return _backends[backend]
+    except KeyError:
+        module_name, class_name = BACKENDS[backend].rsplit('.', 1)
+        klass = getattr(importlib.import_module(module_name), class_name)
+        return _backends.setdefault(backend, klass())
+
+
+def put(data):
+    """
+    Stores data, returns its key
+    """
+    data = to_bytes(data)
+    key = make_key(data)
+    get_backend().put(key, data)
+    return key
+
+
+def get(key):
+    return get_backend().get(key)
+
+
+def serve(key, content_type, filename):
+    """
+    Response with the document as an attachment,
+    without reading it in the process when possible
+    """
+    store = get_backend()
+    relative_path = store.relative_path(key) if key else None
+    if accel_redirect and relative_path:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = accel_redirect + relative_path
+    elif key:
+        response = FileResponse(store.open(key), content_type=content_type)
+    else:
+        response = HttpResponse(content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename={}'.format(filename)
+    return response
+
+
+class ArtifactKey(str):
+    """
+    Key of a document, as read from the database
+    """
+
+
+class Artifact(object):
+    """
+    Key and text of a document, any of them can be unknown yet
+    """
+    def __init__(self, key=None, text=None):
+        self.key = key
+        self.text = text
+
+
+class ArtifactDescriptor(object):
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        artifact = instance.__dict__[self.field.attname]
+        if artifact.text is None:
+            artifact.text = get(artifact.key).decode('utf-8')
+        return artifact.text
+
+    def __set__(self, instance, value):
+        initialized = self.field.attname in instance.__dict__
+        if isinstance(value, ArtifactKey):
+            artifact = Artifact(key=str(value), text=None if value else u'')
+        else:
+            artifact = Artifact(text=value or u'')
+        instance.__dict__[self.field.attname] = artifact
+        if initialized:
+            self.field.update_size(instance)
+
+
+class ArtifactField(models.CharField):
+    """
+    Document kept in the artifact store. The column has its key,
+    and the attribute its text, read the first time it is used.
+    The field size_field is kept with the size of the document in bytes
+    """
+    def __init__(self, size_field=None, **kwargs):
+        kwargs.setdefault('max_length', 64)
+        kwargs.setdefault('blank', True)
+        kwargs.setdefault('default', '')
+        kwargs.setdefault('editable', False)
+        self.size_field = size_field
+        super(ArtifactField, self).__init__(**kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(ArtifactField, self).deconstruct()
+        if self.size_field:
+            kwargs['size_field'] = self.size_field
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, **kwargs):
+        super(ArtifactField, self).contribute_to_class(cls, name, **kwargs)
+        setattr(cls, self.name, ArtifactDescriptor(self))
+        if self.size_field and not cls._meta.abstract:
+            signals.post_init.connect(self.update_size, sender=cls)
+
+    def update_size(self, instance, **kwargs):
+        """
+        Sets size_field when the text of the document is assigned
+        """
+        artifact = instance.__dict__.get(self.attname)
+        if self.size_field and artifact is not None and artifact.key is None:
+            setattr(instance, self.size_field, len(to_bytes(artifact.text)))
+
+    def key(self, instance):
+        """
+        Key of the document of instance, storing it when it is new
+        """
+        artifact = instance.__dict__[self.attname]
+        if artifact.key is None:
+            artifact.key = put(artifact.text) if artifact.text else ''
+        return artifact.key
+
+    def serve(self, instance, content_type, filename):
+        return serve(self.key(instance), content_type, filename)
+
+    def from_db_value(self, value, expression, connection, context):
+        return ArtifactKey(value or '')
+
+    def pre_save(self, model_instance, add):
+        return ArtifactKey(self.key(model_instance))
+
+    def get_prep_value(self, value):
+        if isinstance(value, ArtifactKey):
+            return str(value)
+        if not value:
+            return ''
+        # Text of a document, in lookups
+        return make_key(to_bytes(value))
+
+    def get_db_prep_save(self, value, connection):
+        if value and not isinstance(value, ArtifactKey):
+            # Text of a document, in updates
+            value = ArtifactKey(put(value))
+        return super(ArtifactField, self).get_db_prep_save(value, connection)
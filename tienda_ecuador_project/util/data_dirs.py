@@ -0,0 +1,33 @@
+"""
+Directories of the data that has to outlive the deploys.
+Each deploy replaces the whole code tree (see upload_web in the Makefile),
+so they are taken from the settings and must be outside of it
+"""
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def get_data_dir(name):
+    """
+    The directory of the setting name. Raises ImproperlyConfigured
+    when it is not set, is inside the code tree or can not be written
+    """
+    directory = getattr(settings, name, None)
+    if not directory:
+        raise ImproperlyConfigured('The setting {} is required'.format(name))
+    directory = os.path.realpath(directory)
+    base_dir = os.path.realpath(settings.BASE_DIR)
+    if os.path.join(directory, '').startswith(os.path.join(base_dir, '')):
+        raise ImproperlyConfigured(
+            '{} ({}) is inside the code tree {}, '
+            'it would be removed by the deploys'.format(
+                name, directory, base_dir))
+    if not os.path.isdir(directory):
+        raise ImproperlyConfigured(
+            '{} ({}) does not exist'.format(name, directory))
+    if not os.access(directory, os.W_OK | os.X_OK):
+        raise ImproperlyConfigured(
+            '{} ({}) is not writable'.format(name, directory))
+    return directory
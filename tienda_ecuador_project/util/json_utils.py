@@ -73,5 +73,6 @@ def not_yet(msg):
     return HttpResponse(
         json.dumps({
             'success': False,
+            'waiting': True,
             'msg': msg
         }))
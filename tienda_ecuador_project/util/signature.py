@@ -1,5 +1,13 @@
 import zmq
 import base64
+import importlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+logger = logging.getLogger("signer")
 
 
 class Timeout(Exception):
@@ -7,38 +15,571 @@ class Timeout(Exception):
     Raised when an operation times out
     """
 
-context = zmq.Context()
 
+class SignError(Exception):
+    """
+    The signer could not sign a document
+    """
+
+# Signer instances, the requests are spread between them
+servers = ["tcp://127.0.0.1:5555"]
+
+# Protocol of each server, 'binary' or 'text'.
+# The servers not listed use DEFAULT_PROTOCOL, the one of the
+# deployed signers, so 'binary' is set for the upgraded ones
+DEFAULT_PROTOCOL = 'text'
+protocols = {}
+
+# Seconds a server is skipped after a timeout,
+# it is probed every RETRY_INTERVAL seconds meanwhile
+RETRY_INTERVAL = 5
+
+# Documents per sign_batch request, the requests
+# of a batch are spread between the servers
+SIGN_BATCH_SIZE = 20
+
+
+def to_bytes(data):
+    if isinstance(data, unicode):
+        return data.encode('utf-8')
+    return str(data)
+
+
+class BinaryProtocol(object):
+    """
+    A message is a command frame, a JSON metadata frame
+    and the documents as raw payload frames:
+        sign        {ruc, company_id}     xml
+        sign_batch  {documents: [{ruc, company_id}, ...]}  xml, xml...
+        add_cert    {ruc, company_id}     cert, key
+        del_cert    {ruc, company_id}
+        has_cert    {ruc, company_id}
+        ping        {}
+    The replies have a status frame, a metadata frame and the payloads:
+        signed_xml  {}                    signed xml
+        signed_batch {errors: {index: message}}  signed xml or empty, ...
+        error       {message}
+    """
+    HEALTH_CHECK = ['ping', '{}']
+
+    def encode(self, command, metadata, *payloads):
+        return [command, json.dumps(metadata)] + map(to_bytes, payloads)
+
+    def decode(self, frames):
+        """
+        Returns status, metadata, payloads
+        """
+        metadata = json.loads(frames[1]) if len(frames) > 1 else {}
+        return frames[0], metadata, frames[2:]
+
+    def encode_add_cert(self, ruc, company_id, cert, key):
+        return self.encode('add_cert',
+                           {'ruc': ruc, 'company_id': company_id}, cert, key)
+
+    def decode_add_cert(self, frames, *args):
+        return frames[0]
+
+    def encode_del_cert(self, ruc, company_id):
+        return self.encode('del_cert', {'ruc': ruc, 'company_id': company_id})
+
+    decode_del_cert = decode_add_cert
+
+    def encode_has_cert(self, ruc, company_id):
+        return self.encode('has_cert', {'ruc': ruc, 'company_id': company_id})
+
+    def decode_has_cert(self, frames, *args):
+        return frames[0] == 'true'
+
+    def encode_sign(self, ruc, company_id, xml):
+        return self.encode('sign',
+                           {'ruc': ruc, 'company_id': company_id}, xml)
+
+    def decode_sign(self, frames, *args):
+        status, metadata, payloads = self.decode(frames)
+        if status == 'signed_xml':
+            return payloads[0]
+
+    def encode_sign_batch(self, items):
+        metadata = {'documents': [{'ruc': ruc, 'company_id': company_id}
+                                  for ruc, company_id, xml in items]}
+        return self.encode('sign_batch', metadata,
+                           *[xml for ruc, company_id, xml in items])
+
+    def decode_sign_batch(self, frames, items):
+        status, metadata, payloads = self.decode(frames)
+        if status != 'signed_batch':
+            raise SignError(metadata.get('message', status))
+        errors = metadata.get('errors', {})
+        signed = []
+        for index, payload in enumerate(payloads):
+            if str(index) in errors:
+                signed.append(SignError(errors[str(index)]))
+            else:
+                signed.append(payload)
+        return signed
+
+
+class TextProtocol(object):
+    """
+    Protocol of the older signers: a single frame with a text command,
+    the documents in base64
+    """
+    HEALTH_CHECK = ["has_cert health_check 0"]
+
+    def encode_add_cert(self, ruc, company_id, cert, key):
+        return ["add_cert {} {} {} {}".format(
+            ruc, company_id, base64.b64encode(cert), base64.b64encode(key))]
+
+    def decode_add_cert(self, frames, *args):
+        return frames[0]
+
+    def encode_del_cert(self, ruc, company_id):
+        return ["del_cert {} {}".format(ruc, company_id)]
+
+    decode_del_cert = decode_add_cert
+
+    def encode_has_cert(self, ruc, company_id):
+        return ["has_cert {} {}".format(ruc, company_id)]
+
+    def decode_has_cert(self, frames, *args):
+        return frames[0] == 'true'
+
+    def encode_sign(self, ruc, company_id, xml):
+        return ["sign {} {} {}".format(ruc, company_id,
+                                       base64.b64encode(to_bytes(xml)))]
+
+    def decode_sign(self, frames, *args):
+        parts = frames[0].split()
+        if parts[0] == 'signed_xml':
+            return base64.b64decode(parts[1])
+
+    def encode_sign_batch(self, items):
+        lines = ["sign_batch {}".format(len(items))]
+        for ruc, company_id, xml in items:
+            lines.append("{} {} {}".format(ruc, company_id,
+                                           base64.b64encode(to_bytes(xml))))
+        return ["\n".join(lines)]
+
+    def decode_sign_batch(self, frames, items):
+        """
+        Request: "sign_batch <count>", then a line per document
+                 with "<ruc> <company_id> <base64 xml>"
+        Reply:   "signed_batch", then a line per document with
+                 "signed_xml <base64 xml>" or "error <base64 message>"
+        None if the signer does not know the command
+        """
+        lines = frames[0].split("\n")
+        if lines[0] != 'signed_batch' or len(lines) != len(items) + 1:
+            return None
+        signed = []
+        for line in lines[1:]:
+            status, data = line.split(" ", 1)
+            if status == 'signed_xml':
+                signed.append(base64.b64decode(data))
+            else:
+                signed.append(SignError(base64.b64decode(data)))
+        return signed
+
+
+PROTOCOLS = {
+    'binary': BinaryProtocol(),
+    'text': TextProtocol(),
+}
+
+
+class Client(object):
+    """
+    Connection to the signers, shared by all the threads of a process.
+    An I/O thread owns a DEALER socket per server, kept connected.
+    Each request carries an id in its envelope, echoed by the REP
+    socket of the signer, so many requests can be in flight
+    at once and the replies are matched to them.
+    The threads hand their requests to the I/O thread
+    through an inproc socket of their own.
+    The frames are passed along without copying them.
+    """
+    def __init__(self, endpoints, endpoint_protocols=None):
+        self.pid = os.getpid()
+        self.endpoints = list(endpoints)
+        endpoint_protocols = endpoint_protocols or {}
+        self.protocols = {
+            endpoint: PROTOCOLS[endpoint_protocols.get(endpoint,
+                                                       DEFAULT_PROTOCOL)]
+            for endpoint in self.endpoints}
+        # Servers that answered that they do not know sign_batch
+        self.no_sign_batch = set()
+        self.context = zmq.Context()
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        # request id -> [event, reply]
+        self.pending = {}
+        self.round_robin = itertools.cycle(self.endpoints)
+        # endpoint -> time when it can be used again
+        self.down_until = dict.fromkeys(self.endpoints, 0)
+        self.local = threading.local()
+        self.queue_address = "inproc://signer-{}".format(id(self))
+        self.queue = self.context.socket(zmq.PULL)
+        self.queue.bind(self.queue_address)
+        self.thread = threading.Thread(target=self.run, name="signer-io")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_up(self, endpoint):
+        return self.down_until[endpoint] <= time.time()
+
+    def mark_down(self, endpoint):
+        logger.warning("Signer {} is not answering".format(endpoint))
+        self.down_until[endpoint] = time.time() + RETRY_INTERVAL
 
-def request(cmd, server="tcp://127.0.0.1:5555", timeout=3000):
-    try:
-        socket = context.socket(zmq.REQ)
-        socket.setsockopt(zmq.RCVTIMEO, timeout)
-        socket.connect(server)
-        socket.send(cmd)
-        return socket.recv()
-    except zmq.Again:
-        raise Timeout()
-    finally:
-        socket.setsockopt(zmq.LINGER, 100)
-        socket.close()
+    def mark_up(self, endpoint):
+        if self.down_until[endpoint]:
+            logger.info("Signer {} is back".format(endpoint))
+        self.down_until[endpoint] = 0
+
+    def choose_endpoint(self):
+        """
+        Next server that is up, or the next one if all are down
+        """
+        with self.lock:
+            for i in range(len(self.endpoints)):
+                endpoint = next(self.round_robin)
+                if self.is_up(endpoint):
+                    return endpoint
+            return next(self.round_robin)
+
+    def get_sender(self):
+        sender = getattr(self.local, 'sender', None)
+        if sender is None:
+            sender = self.context.socket(zmq.PUSH)
+            sender.setsockopt(zmq.LINGER, 0)
+            sender.connect(self.queue_address)
+            self.local.sender = sender
+        return sender
+
+    def send(self, frames, endpoint=None):
+        """
+        Sends the frames to endpoint, or to the next server that is up.
+        Returns what wait() needs
+        """
+        endpoint = endpoint or self.choose_endpoint()
+        if endpoint not in self.down_until:
+            raise ValueError("Unknown signer {}".format(endpoint))
+        request_id = str(next(self.ids))
+        slot = [threading.Event(), None]
+        with self.lock:
+            self.pending[request_id] = slot
+        self.get_sender().send_multipart([endpoint, request_id] + frames,
+                                         copy=False)
+        return endpoint, request_id, slot
+
+    def wait(self, sent, deadline):
+        """
+        Waits until deadline for the reply frames of a sent request
+        """
+        endpoint, request_id, slot = sent
+        if not slot[0].wait(max(deadline - time.time(), 0)):
+            with self.lock:
+                self.pending.pop(request_id, None)
+            self.mark_down(endpoint)
+            raise Timeout()
+        return [frame.bytes for frame in slot[1]]
+
+    def request(self, frames, endpoint=None, timeout=3000):
+        """
+        Sends the frames to endpoint, or to the next server that is up,
+        and waits up to timeout milliseconds for the reply frames
+        """
+        sent = self.send(frames, endpoint)
+        return self.wait(sent, time.time() + timeout / 1000.0)
+
+    def call(self, command, args, endpoint=None, timeout=3000):
+        """
+        Runs a command of the protocols, like sign, in endpoint
+        or in the next server that is up
+        """
+        return self.call_many(command, [args], [endpoint], timeout)[0]
+
+    def call_many(self, command, args_list, endpoints=None, timeout=3000):
+        """
+        Runs the command with each of the args at once,
+        spread between the servers.
+        Returns the results in order, with the exception
+        instead of the ones that failed
+        """
+        endpoints = endpoints or [None] * len(args_list)
+        sent = []
+        for args, endpoint in zip(args_list, endpoints):
+            endpoint = endpoint or self.choose_endpoint()
+            protocol = self.protocols[endpoint]
+            frames = getattr(protocol, 'encode_' + command)(*args)
+            sent.append((protocol, self.send(frames, endpoint)))
+        deadline = time.time() + timeout / 1000.0
+        results = []
+        for args, (protocol, request) in zip(args_list, sent):
+            try:
+                frames = self.wait(request, deadline)
+                results.append(
+                    getattr(protocol, 'decode_' + command)(frames, *args))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def deliver(self, request_id, reply):
+        with self.lock:
+            slot = self.pending.pop(request_id, None)
+        if slot is None:
+            # Late reply of a request that timed out
+            return
+        slot[1] = reply
+        slot[0].set()
+
+    def run(self):
+        sockets = {}
+        poller = zmq.Poller()
+        poller.register(self.queue, zmq.POLLIN)
+        for endpoint in self.endpoints:
+            socket = self.context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.connect(endpoint)
+            sockets[socket] = endpoint
+            poller.register(socket, zmq.POLLIN)
+        by_endpoint = {endpoint: socket
+                       for socket, endpoint in sockets.iteritems()}
+        probes = itertools.count()
+        last_probe = 0
+        closed = False
+        while not closed:
+            events = dict(poller.poll(RETRY_INTERVAL * 1000))
+            if self.queue in events:
+                while True:
+                    try:
+                        frames = self.queue.recv_multipart(zmq.NOBLOCK,
+                                                           copy=False)
+                    except zmq.Again:
+                        break
+                    endpoint = frames[0].bytes
+                    if not endpoint:
+                        closed = True
+                        break
+                    try:
+                        by_endpoint[endpoint].send_multipart(
+                            [frames[1], ''] + frames[2:],
+                            zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        # Too many queued, the request times out
+                        pass
+            for socket, endpoint in sockets.iteritems():
+                if socket not in events:
+                    continue
+                while True:
+                    try:
+                        frames = socket.recv_multipart(zmq.NOBLOCK,
+                                                       copy=False)
+                    except zmq.Again:
+                        break
+                    request_id = frames[0].bytes
+                    self.mark_up(endpoint)
+                    if not request_id.startswith('probe'):
+                        # Skips the empty delimiter
+                        self.deliver(request_id, frames[2:])
+            # Health checks of the servers that did not answer
+            if time.time() - last_probe >= RETRY_INTERVAL:
+                last_probe = time.time()
+                for endpoint, socket in by_endpoint.iteritems():
+                    if self.down_until[endpoint]:
+                        try:
+                            socket.send_multipart(
+                                ['probe{}'.format(next(probes)), ''] +
+                                self.protocols[endpoint].HEALTH_CHECK,
+                                zmq.NOBLOCK)
+                        except zmq.Again:
+                            pass
+        for socket in sockets:
+            socket.close()
+        self.queue.close()
+
+    def close(self):
+        self.get_sender().send_multipart(['', ''])
+        self.thread.join()
+        # Closes the sockets of all the threads
+        self.context.destroy(linger=0)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Client of the current process. A forked process,
+    like a gunicorn worker, creates its own context and client
+    """
+    global _client
+    client = _client
+    if client is None or client.pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client.pid != os.getpid():
+                _client = Client(servers, protocols)
+            client = _client
+    return client
+
+
+def broadcast(command, args, timeout=3000):
+    """
+    Runs the command in all the servers, returns their results
+    """
+    client = get_client()
+    results = client.call_many(command, [args] * len(client.endpoints),
+                               client.endpoints, timeout)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+class Backend(object):
+    """
+    Keeps the certificates of the companies and signs their comprobantes.
+    sign returns None when the company has no usable certificate
+    """
+    def add_cert(self, ruc, company_id, cert, key):
+        raise NotImplementedError()
+
+    def del_cert(self, ruc, company_id):
+        raise NotImplementedError()
+
+    def has_cert(self, ruc, company_id):
+        raise NotImplementedError()
+
+    def sign(self, ruc, company_id, xml):
+        raise NotImplementedError()
+
+    def sign_batch(self, items, timeout=30000):
+        """
+        items is a list of (ruc, company_id, xml).
+        Returns, in order, the signed documents, with an exception
+        for the ones that could not be signed
+        """
+        signed = []
+        for ruc, company_id, xml in items:
+            try:
+                result = self.sign(ruc, company_id, xml)
+                if result is None:
+                    result = SignError("Not signed")
+            except Exception as e:
+                result = e
+            signed.append(result)
+        return signed
+
+
+class ZMQBackend(Backend):
+    """
+    Signs in the signer servers, through the client of the process
+    """
+    def add_cert(self, ruc, company_id, cert, key):
+        # Every signer keeps its own certificates
+        return broadcast('add_cert', (ruc, company_id, cert, key))[0]
+
+    def del_cert(self, ruc, company_id):
+        return broadcast('del_cert', (ruc, company_id))[0]
+
+    def has_cert(self, ruc, company_id):
+        return all(broadcast('has_cert', (ruc, company_id)))
+
+    def sign(self, ruc, company_id, xml):
+        res = get_client().call('sign', (ruc, company_id, xml))
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    def sign_batch(self, items, timeout=30000):
+        """
+        Signs in requests of SIGN_BATCH_SIZE documents, spread
+        between the servers. The text signers that do not know
+        the command are remembered, and sign the documents one by one.
+        """
+        client = get_client()
+        chunks = [items[i:i + SIGN_BATCH_SIZE]
+                  for i in range(0, len(items), SIGN_BATCH_SIZE)]
+        endpoints = [client.choose_endpoint() for chunk in chunks]
+        batches = [i for i, endpoint in enumerate(endpoints)
+                   if endpoint not in client.no_sign_batch]
+        results = [None] * len(chunks)
+        replies = client.call_many('sign_batch',
+                                   [(chunks[i],) for i in batches],
+                                   [endpoints[i] for i in batches],
+                                   timeout)
+        for i, reply in zip(batches, replies):
+            if reply is None and endpoints[i] not in client.no_sign_batch:
+                logger.info("The signer {} does not know sign_batch".format(
+                    endpoints[i]))
+                client.no_sign_batch.add(endpoints[i])
+            results[i] = reply
+        # One request per document for the others
+        singles = [i for i, result in enumerate(results) if result is None]
+        args = [item for i in singles for item in chunks[i]]
+        replies = iter(client.call_many(
+            'sign', args,
+            [endpoints[i] for i in singles for item in chunks[i]],
+            timeout))
+        for i in singles:
+            results[i] = [
+                reply if reply is not None else SignError("Not signed")
+                for reply in itertools.islice(replies, len(chunks[i]))]
+        signed = []
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                result = [result] * len(chunk)
+            signed.extend(result)
+        return signed
+
+
+# Backend used by the functions below, a key of BACKENDS
+backend = 'zmq'
+BACKENDS = {
+    'zmq': 'util.signature.ZMQBackend',
+    'xades': 'util.xades.XadesBesBackend',
+}
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend():
+    """
+    Instance of the configured backend, shared by the process
+    """
+    instance = _backends.get(backend)
+    if instance is None:
+        with _backends_lock:
+            instance = _backends.get(backend)
+            if instance is None:
+                module_name, class_name = BACKENDS[backend].rsplit('.', 1)
+                module = importlib.import_module(module_name)
+                instance = _backends[backend] = getattr(module, class_name)()
+    return instance
 
 
 def add_cert(ruc, company_id, cert, key):
-    return request("add_cert {} {} {} {}".format(ruc, company_id, base64.b64encode(cert), base64.b64encode(key)))
+    return get_backend().add_cert(ruc, company_id, cert, key)
 
 
 def del_cert(ruc, company_id):
-    return request("del_cert {} {}".format(ruc, company_id))
+    return get_backend().del_cert(ruc, company_id)
 
 
 def has_cert(ruc, company_id):
-    res = request("has_cert {} {}".format(ruc, company_id))
-    return res == 'true'
+    return get_backend().has_cert(ruc, company_id)
 
 
 def sign(ruc, company_id, xml):
-    res = request("sign {} {} {}".format(ruc, company_id, base64.b64encode(xml)))
-    parts = res.split()
-    if parts[0] == 'signed_xml':
-        return base64.b64decode(parts[1])
+    return get_backend().sign(ruc, company_id, xml)
+
+
+def sign_batch(items, timeout=30000):
+    """
+    Signs many documents, of one or more companies.
+    items is a list of (ruc, company_id, xml).
+    Returns, in order, the signed documents, with a SignError
+    or a Timeout for the ones that could not be signed.
+    """
+    return get_backend().sign_batch(items, timeout)
@@ -1,5 +1,19 @@
 from suds.client import Client
+from suds.transport import Reply, TransportError
+from suds.transport.http import HttpTransport
+from StringIO import StringIO
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import errno
+import httplib
 import logging
+import os
+import re
+import socket
+import threading
+import urllib
+import urllib2
+import urlparse
 logger = logging.getLogger("sri.request")
 
 urls = {
@@ -13,9 +27,273 @@ urls = {
     },
 }
 
+# Maximum number of simultaneous requests to each entorno,
+# shared by all the threads of the process
+max_concurrency = {
+    'pruebas': 4,
+    'produccion': 8,
+}
+_semaphores = {
+    entorno: threading.BoundedSemaphore(n)
+    for entorno, n in max_concurrency.iteritems()
+}
+
+# Local copies of the WSDLs, made with "manage.py refresh_sri_wsdl".
+# The SRI is never asked for them on the way
+wsdl_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'comprobantes_electronicos', 'wsdl')
+
+
+class MissingWSDL(Exception):
+    """
+    There is no local copy of a WSDL
+    """
+
+
+class KeepAliveTransport(HttpTransport):
+    """
+    suds transport that keeps the HTTP connections open
+    between SOAP calls.
+    An instance must not be shared between threads.
+    """
+    def __init__(self, **kwargs):
+        HttpTransport.__init__(self, **kwargs)
+        self.connections = {}
+
+    def __deepcopy__(self, memo):
+        # suds copies the transport when cloning a client,
+        # each clone opens its own connections
+        return KeepAliveTransport(timeout=self.options.timeout,
+                                  proxy=self.options.proxy)
+
+    def get_connection(self, scheme, netloc):
+        """
+        Returns (connection, reused)
+        """
+        key = (scheme, netloc)
+        connection = self.connections.get(key)
+        if connection is not None:
+            return connection, True
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        connection = cls(netloc, timeout=self.options.timeout)
+        self.connections[key] = connection
+        return connection, False
+
+    def drop_connection(self, scheme, netloc):
+        connection = self.connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        for scheme, netloc in self.connections.keys():
+            self.drop_connection(scheme, netloc)
+
+    @staticmethod
+    def closed_by_server(error):
+        """
+        True if the connection was closed without a byte of the response,
+        as servers do with idle keep-alive connections
+        """
+        if isinstance(error, httplib.BadStatusLine):
+            return error.line.startswith("No status line received")
+        return (not isinstance(error, socket.timeout) and
+                error.errno in (errno.ECONNRESET, errno.EPIPE))
+
+    def send(self, request):
+        """
+        Sends the request, again through a new connection
+        only when a reused one was closed by the server
+        before it could have taken the request
+        """
+        if self.options.proxy:
+            return HttpTransport.send(self, request)
+        parts = urlparse.urlsplit(request.url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = dict(request.headers)
+        headers['Connection'] = 'keep-alive'
+        while True:
+            connection, reused = self.get_connection(parts.scheme, parts.netloc)
+            retry = False
+            try:
+                try:
+                    connection.request('POST', path, request.message, headers)
+                except (httplib.HTTPException, socket.error) as e:
+                    # The request did not go out
+                    retry = reused and not isinstance(e, socket.timeout)
+                    raise
+                try:
+                    response = connection.getresponse()
+                except (httplib.BadStatusLine, socket.error) as e:
+                    # The request went out, the SRI may have processed it
+                    retry = reused and self.closed_by_server(e)
+                    raise
+                message = response.read()
+                break
+            except (httplib.HTTPException, socket.error):
+                self.drop_connection(parts.scheme, parts.netloc)
+                if not retry:
+                    raise
+                # The server closed an idle connection, retry with a new one
+                logger.debug("Reconnecting to {}".format(parts.netloc))
+        if response.will_close:
+            self.drop_connection(parts.scheme, parts.netloc)
+        if response.status in (202, 204):
+            return None
+        if response.status >= 300:
+            raise TransportError(response.reason, response.status,
+                                 StringIO(message))
+        return Reply(200, dict(response.getheaders()), message)
+
+
+def get_wsdl_path(entorno, service):
+    return os.path.join(wsdl_dir, entorno, '{}.wsdl'.format(service))
+
+
+def get_wsdl_url(entorno, service):
+    """
+    URL of the local copy of the WSDL, raises MissingWSDL if there is none
+    """
+    path = get_wsdl_path(entorno, service)
+    if not os.path.exists(path):
+        raise MissingWSDL(
+            "No local WSDL for {} {} in {}, "
+            "run manage.py refresh_sri_wsdl".format(entorno, service, path))
+    return urlparse.urljoin('file:', urllib.pathname2url(path))
+
+
+def check_wsdls():
+    """
+    Raises MissingWSDL unless every WSDL has its local copy
+    """
+    for entorno in sorted(urls):
+        for service in sorted(urls[entorno]):
+            get_wsdl_url(entorno, service)
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_clients_generation = [0]
+_local = threading.local()
+
+
+def _get_shared_client(entorno, service):
+    """
+    Client with the parsed WSDL, shared by all the threads
+    """
+    key = (entorno, service)
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = Client(get_wsdl_url(entorno, service),
+                                transport=KeepAliveTransport(),
+                                cache=None)
+                _clients[key] = client
+    return client
+
+
+def get_client(entorno, service):
+    """
+    Returns the suds client for the service.
+    The WSDL is parsed once per process, each thread gets its own
+    clone of the client, with its own connections.
+    """
+    if getattr(_local, 'generation', None) != _clients_generation[0]:
+        _local.clients = {}
+        _local.generation = _clients_generation[0]
+    key = (entorno, service)
+    client = _local.clients.get(key)
+    if client is None:
+        client = _get_shared_client(entorno, service).clone()
+        _local.clients[key] = client
+    return client
+
+
+def clear_clients():
+    """
+    Forgets the clients, the next calls will load the WSDLs again
+    """
+    with _clients_lock:
+        _clients.clear()
+        _clients_generation[0] += 1
+
+
+# Imports of the JAX-WS WSDLs, like schemaLocation="...?xsd=1"
+_import_location = re.compile(
+    r'''((?:schemaLocation|location)=["'])(https?://[^"']+\?(xsd|wsdl)=[^"']*)(["'])''')
+
+
+def refresh_wsdl(entorno, service, fetch=None):
+    """
+    Downloads the WSDL and the documents it imports into wsdl_dir.
+    The imports are rewritten to point to the local copies,
+    the endpoint addresses are kept.
+    Returns the list of written files.
+    """
+    if fetch is None:
+        fetch = lambda url: urllib2.urlopen(url, timeout=90).read()
+    directory = os.path.join(wsdl_dir, entorno)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    documents = {}
+    local_names = {}
+
+    def download(url, name):
+        local_names[url] = name
+        content = fetch(url)
+
+        def replace(match):
+            imported = match.group(2)
+            if imported not in local_names:
+                download(imported, '{}_{}.{}'.format(
+                    service, len(local_names), match.group(3)))
+            return match.group(1) + local_names[imported] + match.group(4)
+        documents[name] = _import_location.sub(replace, content)
+
+    download(urls[entorno][service], '{}.wsdl'.format(service))
+
+    written = []
+    for name, content in documents.iteritems():
+        path = os.path.join(directory, name)
+        with open(path + '.tmp', 'w') as f:
+            f.write(content)
+        os.rename(path + '.tmp', path)
+        written.append(path)
+    clear_clients()
+    return sorted(written)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = [os.getpid()]
+
+
+def get_pool(entorno):
+    """
+    Threads querying the SRI in entorno, kept for the life of the process,
+    so their clients and connections are reused between calls
+    """
+    with _pools_lock:
+        if _pools_pid[0] != os.getpid():
+            # Forked, the threads of the parent are not here
+            _pools.clear()
+            _pools_pid[0] = os.getpid()
+        pool = _pools.get(entorno)
+        if pool is None:
+            pool = _pools[entorno] = ThreadPool(max_concurrency[entorno])
+    return pool
+
 
 def enviar_comprobante(xml_data, entorno='pruebas'):
-    client = Client(urls[entorno]['recepcion'])
+    client = get_client(entorno, 'recepcion')
     logger.info("enviar_comprobante {entorno} request: {xml}".format(xml=xml_data, entorno=entorno))
     result = client.service.validarComprobante(xml_data.encode('base64'))
     logger.info("enviar_comprobante {entorno} response: {res}".format(entorno=entorno, res=result))
@@ -23,8 +301,49 @@ def enviar_comprobante(xml_data, entorno='pruebas'):
 
 
 def autorizar_comprobante(clave_acceso, entorno='pruebas'):
-    client = Client(urls[entorno]['autorizacion'])
+    client = get_client(entorno, 'autorizacion')
     logger.info("autorizar_comprobante {entorno} request: {clave}".format(clave=clave_acceso, entorno=entorno))
     result = client.service.autorizacionComprobante(clave_acceso)
     logger.info("autorizar_comprobante {entorno} response: {res}".format(entorno=entorno, res=result))
     return result
+
+
+def enviar_lote(lote_xml, entorno='pruebas'):
+    """
+    Sends a lote masivo, the reception service takes it
+    like a single comprobante
+    """
+    return enviar_comprobante(lote_xml, entorno=entorno)
+
+
+def autorizar_lote(clave_acceso_lote, entorno='pruebas'):
+    client = get_client(entorno, 'autorizacion')
+    logger.info("autorizar_lote {entorno} request: {clave}".format(clave=clave_acceso_lote, entorno=entorno))
+    result = client.service.autorizacionComprobanteLote(clave_acceso_lote)
+    logger.info("autorizar_lote {entorno} response: {res}".format(entorno=entorno, res=result))
+    return result
+
+
+def autorizar_comprobantes(claves_acceso, entorno='pruebas'):
+    """
+    Runs autorizar_comprobante for many claves de acceso,
+    with up to max_concurrency[entorno] requests at a time.
+    Returns {clave_acceso: result}. When a request fails,
+    the result is the exception raised.
+    """
+    claves_acceso = list(OrderedDict.fromkeys(claves_acceso))
+    semaphore = _semaphores[entorno]
+
+    def autorizar(clave_acceso):
+        with semaphore:
+            try:
+                return clave_acceso, autorizar_comprobante(clave_acceso,
+                                                           entorno=entorno)
+            except Exception as e:
+                logger.exception("autorizar_comprobante {entorno} failed: {clave}".format(
+                    clave=clave_acceso, entorno=entorno))
+                return clave_acceso, e
+
+    if len(claves_acceso) < 2:
+        return dict(map(autorizar, claves_acceso))
+    return dict(get_pool(entorno).map(autorizar, claves_acceso))
@@ -1,4 +1,6 @@
 from contextlib import contextmanager
+import shutil
+import tempfile
 import urllib
 import xml.etree.ElementTree as ET
 
@@ -7,6 +9,8 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.test import Client
 
+from util import artifacts
+
 
 def add_instance(klass, **kwargs):
     """
@@ -36,6 +40,25 @@ def try_delete(item):
         pass
 
 
+class TemporaryArtifactsMixin(object):
+    """
+    Keeps the artifacts of each test in a temporary directory
+    """
+    def setUp(self):
+        self.orig_artifact_dir = artifacts.artifact_dir
+        self.orig_artifact_backends = artifacts._backends.copy()
+        artifacts.artifact_dir = tempfile.mkdtemp()
+        artifacts._backends.clear()
+        super(TemporaryArtifactsMixin, self).setUp()
+
+    def tearDown(self):
+        super(TemporaryArtifactsMixin, self).tearDown()
+        shutil.rmtree(artifacts.artifact_dir)
+        artifacts.artifact_dir = self.orig_artifact_dir
+        artifacts._backends.clear()
+        artifacts._backends.update(self.orig_artifact_backends)
+
+
 class TestHelpersMixin(object):
     def assertObjectMatchesData(self, ob, data, msg=''):
         """
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+
+from util import artifacts
+
+
+class FileSystemBackendTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = artifacts.FileSystemBackend(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_get(self):
+        key = artifacts.make_key('<xml></xml>')
+        self.assertFalse(self.backend.exists(key))
+        self.backend.put(key, '<xml></xml>')
+        self.assertTrue(self.backend.exists(key))
+        self.assertEquals(self.backend.get(key), '<xml></xml>')
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.directory, key[:2], key[2:4], key)))
+        # Stored once
+        self.backend.put(key, '<xml></xml>')
+        self.assertEquals(os.listdir(os.path.join(self.directory, key[:2], key[2:4])),
+                          [key])
+
+    def test_not_found(self):
+        with self.assertRaises(artifacts.ArtifactNotFound):
+            self.backend.get(artifacts.make_key('missing'))
+
+    def test_get_backend(self):
+        orig_artifact_dir = artifacts.artifact_dir
+        orig_backends = artifacts._backends.copy()
+        artifacts.artifact_dir = self.directory
+        artifacts._backends.clear()
+        try:
+            key = artifacts.put(u'<xml>\xf1</xml>')
+            self.assertEquals(key, artifacts.make_key(u'<xml>\xf1</xml>'.encode('utf-8')))
+            self.assertEquals(artifacts.get(key), u'<xml>\xf1</xml>'.encode('utf-8'))
+            self.assertEquals(artifacts.get_backend().directory, self.directory)
+        finally:
+            artifacts.artifact_dir = orig_artifact_dir
+            artifacts._backends.clear()
+            artifacts._backends.update(orig_backends)
+
+
+class ArtifactDirTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.chmod(self.directory, 0700)
+        shutil.rmtree(self.directory)
+
+    def test_setting(self):
+        with override_settings(ARTIFACT_DIR=self.directory):
+            self.assertEquals(artifacts.get_artifact_dir(),
+                              os.path.realpath(self.directory))
+            self.assertEquals(artifacts.FileSystemBackend().directory,
+                              os.path.realpath(self.directory))
+
+    def test_not_usable(self):
+        for directory in (None, '',
+                          os.path.join(self.directory, 'missing'),
+                          os.path.join(settings.BASE_DIR, 'artifacts'),
+                          settings.BASE_DIR):
+            with override_settings(ARTIFACT_DIR=directory):
+                with self.assertRaises(ImproperlyConfigured):
+                    artifacts.get_artifact_dir()
+        with override_settings():
+            del settings.ARTIFACT_DIR
+            with self.assertRaises(ImproperlyConfigured):
+                artifacts.get_artifact_dir()
+        os.chmod(self.directory, 0500)
+        if not os.access(self.directory, os.W_OK):
+            with override_settings(ARTIFACT_DIR=self.directory):
+                with self.assertRaises(ImproperlyConfigured):
+                    artifacts.get_artifact_dir()
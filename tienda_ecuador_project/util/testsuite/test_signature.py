@@ -0,0 +1,279 @@
+import base64
+import json
+import threading
+from multiprocessing.pool import ThreadPool
+
+import zmq
+from django.test import TestCase
+
+from util import signature
+
+
+class FakeSigner(object):
+    """
+    REP socket answering [name] + the request frames,
+    or the frames handle returns
+    """
+    def __init__(self, name, handle=None):
+        self.name = name
+        self.handle = handle or (lambda frames: [name] + frames)
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.REP)
+        port = self.socket.bind_to_random_port("tcp://127.0.0.1")
+        self.endpoint = "tcp://127.0.0.1:{}".format(port)
+        self.requests = []
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                frames = self.socket.recv_multipart()
+            except zmq.ContextTerminated:
+                break
+            self.requests.append(frames)
+            try:
+                reply = self.handle(frames)
+            except Exception as e:
+                reply = ["error {}".format(e)]
+            self.socket.send_multipart(reply)
+        self.socket.close()
+
+    def close(self):
+        self.context.term()
+        self.thread.join()
+
+
+class ClientTests(TestCase):
+    def setUp(self):
+        self.signers = [FakeSigner('one'), FakeSigner('two')]
+        self.client = signature.Client(
+            [signer.endpoint for signer in self.signers])
+
+    def tearDown(self):
+        self.client.close()
+        for signer in self.signers:
+            signer.close()
+
+    def test_round_robin(self):
+        replies = [self.client.request(['has_cert', str(i)])
+                   for i in range(4)]
+        self.assertEquals(replies, [['one', 'has_cert', '0'],
+                                    ['two', 'has_cert', '1'],
+                                    ['one', 'has_cert', '2'],
+                                    ['two', 'has_cert', '3']])
+
+    def test_in_flight(self):
+        pool = ThreadPool(8)
+        try:
+            replies = pool.map(
+                lambda i: self.client.request(['sign', str(i)]),
+                range(50))
+        finally:
+            pool.close()
+            pool.join()
+        # Every reply goes to its request
+        self.assertEquals([reply[-1] for reply in replies],
+                          [str(i) for i in range(50)])
+
+    def test_down(self):
+        dead = "tcp://127.0.0.1:1"
+        self.client.close()
+        self.client = signature.Client([dead, self.signers[0].endpoint])
+        with self.assertRaises(signature.Timeout):
+            self.client.request(['has_cert'], endpoint=dead, timeout=100)
+        # Skipped until it answers a health check
+        self.assertFalse(self.client.is_up(dead))
+        self.assertEquals(
+            [self.client.request(['has_cert']) for i in range(2)],
+            [['one', 'has_cert'], ['one', 'has_cert']])
+
+    def test_health_check(self):
+        endpoint = self.signers[1].endpoint
+        self.client.mark_down(endpoint)
+        self.assertEquals(self.client.request(['has_cert']),
+                          ['one', 'has_cert'])
+        self.signers[1].thread.join(0.5)
+        # In the default protocol of the server
+        self.assertIn(signature.TextProtocol.HEALTH_CHECK,
+                      self.signers[1].requests)
+        self.assertTrue(self.client.is_up(endpoint))
+
+    def test_fork(self):
+        orig_servers = signature.servers
+        signature.servers = [self.signers[0].endpoint]
+        try:
+            client = signature.get_client()
+            self.assertIs(signature.get_client(), client)
+            # As seen by a forked process
+            client.pid = -1
+            new_client = signature.get_client()
+            self.assertIsNot(new_client, client)
+            self.assertEquals(new_client.request(['has_cert']),
+                              ['one', 'has_cert'])
+        finally:
+            signature.servers = orig_servers
+            client.close()
+            new_client.close()
+            signature._client = None
+
+
+def fake_sign(ruc, company_id, xml):
+    if ruc == 'nocert':
+        return None
+    return "<signed>{}</signed>".format(xml)
+
+
+def handle_binary(frames):
+    command, metadata, payloads = (frames[0], json.loads(frames[1]),
+                                   frames[2:])
+    if command == 'has_cert':
+        return ['true']
+    if command == 'sign':
+        signed = fake_sign(metadata['ruc'], metadata['company_id'],
+                           payloads[0])
+        if signed is None:
+            return ['error', json.dumps({'message': 'no cert'})]
+        return ['signed_xml', '{}', signed]
+    if command == 'sign_batch':
+        errors = {}
+        signed_payloads = []
+        for index, (document, xml) in enumerate(
+                zip(metadata['documents'], payloads)):
+            signed = fake_sign(document['ruc'], document['company_id'], xml)
+            if signed is None:
+                errors[str(index)] = 'no cert'
+                signed = ''
+            signed_payloads.append(signed)
+        return ['signed_batch', json.dumps({'errors': errors})] + signed_payloads
+    return ['error', json.dumps({'message': 'unknown command'})]
+
+
+def handle_text(frames):
+    """
+    Signer that only knows the text sign command
+    """
+    parts = frames[0].split()
+    if parts[0] == 'has_cert':
+        return ['true']
+    if parts[0] != 'sign':
+        return ["error unknown_command"]
+    name, ruc, company_id, xml = parts
+    signed = fake_sign(ruc, company_id, base64.b64decode(xml))
+    if signed is None:
+        return ["error no_cert"]
+    return ["signed_xml " + base64.b64encode(signed)]
+
+
+def handle_text_batch(frames):
+    lines = frames[0].split("\n")
+    if not lines[0].startswith('sign_batch'):
+        return handle_text(frames)
+    reply = ['signed_batch']
+    for line in lines[1:]:
+        ruc, company_id, xml = line.split()
+        signed = fake_sign(ruc, company_id, base64.b64decode(xml))
+        if signed is None:
+            reply.append("error " + base64.b64encode("no cert"))
+        else:
+            reply.append("signed_xml " + base64.b64encode(signed))
+    return ["\n".join(reply)]
+
+
+class SignTests(TestCase):
+    def setUp(self):
+        self.orig_servers = signature.servers
+        self.orig_protocols = signature.protocols
+        self.orig_batch_size = signature.SIGN_BATCH_SIZE
+        signature.SIGN_BATCH_SIZE = 2
+        signature._client = None
+        self.signers = []
+        self.items = [('1790000000001', 1, '<factura>1</factura>'),
+                      ('nocert', 2, '<factura>2</factura>'),
+                      ('1790000000001', 1, '<factura>3</factura>')]
+
+    def tearDown(self):
+        signature.get_client().close()
+        signature._client = None
+        signature.servers = self.orig_servers
+        signature.protocols = self.orig_protocols
+        signature.SIGN_BATCH_SIZE = self.orig_batch_size
+        for signer in self.signers:
+            signer.close()
+
+    def start_signers(self, *handles):
+        """
+        handles are (handle, protocol)
+        """
+        self.signers = [FakeSigner(str(i), handle)
+                        for i, (handle, protocol) in enumerate(handles)]
+        signature.servers = [signer.endpoint for signer in self.signers]
+        signature.protocols = {
+            signer.endpoint: protocol
+            for signer, (handle, protocol) in zip(self.signers, handles)}
+
+    def check_signed(self, signed):
+        self.assertEquals(signed[0], '<signed><factura>1</factura></signed>')
+        self.assertIsInstance(signed[1], signature.SignError)
+        self.assertEquals(signed[2], '<signed><factura>3</factura></signed>')
+
+    def test_binary(self):
+        self.start_signers((handle_binary, 'binary'))
+        self.assertEquals(signature.sign('1790000000001', 1, '<factura/>'),
+                          '<signed><factura/></signed>')
+        self.assertIsNone(signature.sign('nocert', 1, '<factura/>'))
+        # The document goes as is, in its own frame
+        self.assertEquals(self.signers[0].requests[0],
+                          ['sign',
+                           json.dumps({'ruc': '1790000000001',
+                                       'company_id': 1}),
+                           '<factura/>'])
+
+    def test_sign_batch(self):
+        self.start_signers((handle_binary, 'binary'),
+                           (handle_text_batch, 'text'))
+        self.check_signed(signature.sign_batch(self.items))
+        # One request per SIGN_BATCH_SIZE documents, spread between the signers
+        self.assertEquals([len(signer.requests) for signer in self.signers],
+                          [1, 1])
+        self.assertEquals(self.signers[0].requests[0][2:],
+                          ['<factura>1</factura>', '<factura>2</factura>'])
+
+    def test_old_signer(self):
+        self.start_signers((handle_text, 'text'), (handle_text, 'text'))
+        self.check_signed(signature.sign_batch(self.items))
+        self.assertEquals(
+            sum(len(signer.requests) for signer in self.signers), 5)
+        # Not asked for sign_batch again
+        self.check_signed(signature.sign_batch(self.items))
+        self.assertEquals(
+            sum(len(signer.requests) for signer in self.signers), 8)
+
+    def test_mixed_signers(self):
+        self.start_signers((handle_text, 'text'), (handle_text_batch, 'text'))
+        self.check_signed(signature.sign_batch(self.items))
+        self.assertEquals(signature.get_client().no_sign_batch,
+                          set([self.signers[0].endpoint]))
+        for signer in self.signers:
+            signer.requests = []
+        self.check_signed(signature.sign_batch(self.items))
+        self.assertFalse(any(request[0].startswith('sign_batch')
+                             for request in self.signers[0].requests))
+        # A chunk for each signer, the second one still batched
+        self.assertEquals(len(self.signers[1].requests), 1)
+        self.assertTrue(
+            self.signers[1].requests[0][0].startswith('sign_batch'))
+
+    def test_default_protocol(self):
+        self.start_signers((handle_text, 'text'))
+        signature.protocols = {}
+        self.assertEquals(signature.sign('1790000000001', 1, '<factura/>'),
+                          '<signed><factura/></signed>')
+
+    def test_has_cert(self):
+        self.start_signers((handle_binary, 'binary'), (handle_text, 'text'))
+        self.assertTrue(signature.has_cert('1790000000001', 1))
+        # Asked to every signer
+        self.assertEquals([len(signer.requests) for signer in self.signers],
+                          [1, 1])
@@ -1,3 +1,12 @@
+import BaseHTTPServer
+import os
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import time
+
 from django.test import TestCase
 from util.property import Property, ConvertedProperty, ProtectedSetattr
 
@@ -60,3 +69,266 @@ class SRISenderTests(TestCase):
         self.assertEquals(res.claveAccesoConsultada, '123456')
         self.assertEquals(res.autorizaciones.autorizacion[0].estado, 'RECHAZADA')
         self.assertEquals(res.autorizaciones.autorizacion[0].mensajes.mensaje[0].identificador, 'null')
+
+
+SCHEMA = """<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema"
+           xmlns:tns="http://ec.gob.sri.ws.recepcion"
+           targetNamespace="http://ec.gob.sri.ws.recepcion">
+  <xs:element name="validarComprobante">
+    <xs:complexType><xs:sequence>
+      <xs:element name="xml" type="xs:base64Binary" minOccurs="0"/>
+    </xs:sequence></xs:complexType>
+  </xs:element>
+  <xs:element name="validarComprobanteResponse">
+    <xs:complexType><xs:sequence>
+      <xs:element name="estado" type="xs:string" minOccurs="0"/>
+    </xs:sequence></xs:complexType>
+  </xs:element>
+</xs:schema>
+"""
+
+WSDL = """<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/"
+             xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:xsd="http://www.w3.org/2001/XMLSchema"
+             xmlns:tns="http://ec.gob.sri.ws.recepcion"
+             targetNamespace="http://ec.gob.sri.ws.recepcion"
+             name="RecepcionComprobantesService">
+  <types>
+    <xsd:schema>
+      <xsd:import namespace="http://ec.gob.sri.ws.recepcion"
+                  schemaLocation="{url}?xsd=1"/>
+    </xsd:schema>
+  </types>
+  <message name="validarComprobante">
+    <part name="parameters" element="tns:validarComprobante"/>
+  </message>
+  <message name="validarComprobanteResponse">
+    <part name="parameters" element="tns:validarComprobanteResponse"/>
+  </message>
+  <portType name="RecepcionComprobantes">
+    <operation name="validarComprobante">
+      <input message="tns:validarComprobante"/>
+      <output message="tns:validarComprobanteResponse"/>
+    </operation>
+  </portType>
+  <binding name="RecepcionComprobantesPortBinding" type="tns:RecepcionComprobantes">
+    <soap:binding transport="http://schemas.xmlsoap.org/soap/http" style="document"/>
+    <operation name="validarComprobante">
+      <soap:operation soapAction=""/>
+      <input><soap:body use="literal"/></input>
+      <output><soap:body use="literal"/></output>
+    </operation>
+  </binding>
+  <service name="RecepcionComprobantesService">
+    <port name="RecepcionComprobantesPort" binding="tns:RecepcionComprobantesPortBinding">
+      <soap:address location="{endpoint}"/>
+    </port>
+  </service>
+</definitions>
+"""
+
+RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/">
+  <S:Body>
+    <ns2:validarComprobanteResponse xmlns:ns2="http://ec.gob.sri.ws.recepcion">
+      <estado>RECIBIDA</estado>
+    </ns2:validarComprobanteResponse>
+  </S:Body>
+</S:Envelope>
+"""
+
+
+class SOAPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = []
+    posts = []
+    # Closes the connections after answering, without telling the client
+    close_idle = False
+    # Seconds to wait before answering
+    delay = 0
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.connections.append(self.client_address)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.posts.append(self.client_address)
+        time.sleep(self.delay)
+        self.close_connection = self.close_idle
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalWsdlTests(TestCase):
+    """
+    Checks the local copy of the WSDLs and the client reuse
+    """
+    def setUp(self):
+        self.old_wsdl_dir = sri_sender.wsdl_dir
+        sri_sender.wsdl_dir = tempfile.mkdtemp()
+        sri_sender.clear_clients()
+
+        SOAPHandler.connections = []
+        SOAPHandler.posts = []
+        SOAPHandler.close_idle = False
+        SOAPHandler.delay = 0
+        self.server = SocketServer.ThreadingTCPServer(
+            ('127.0.0.1', 0), SOAPHandler)
+        self.server.daemon_threads = True
+        server_thread = threading.Thread(target=self.server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        endpoint = 'http://127.0.0.1:{}/RecepcionComprobantes'.format(
+            self.server.server_address[1])
+
+        url = urls['pruebas']['recepcion'].split('?')[0]
+        self.documents = {
+            urls['pruebas']['recepcion']: WSDL.format(url=url,
+                                                      endpoint=endpoint),
+            url + '?xsd=1': SCHEMA,
+        }
+        self.fetched = []
+
+    def tearDown(self):
+        sri_sender.get_client('pruebas', 'recepcion').options.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(sri_sender.wsdl_dir)
+        sri_sender.wsdl_dir = self.old_wsdl_dir
+        sri_sender.clear_clients()
+
+    def fetch(self, url):
+        self.fetched.append(url)
+        return self.documents[url]
+
+    def test_refresh(self):
+        written = sri_sender.refresh_wsdl('pruebas', 'recepcion', self.fetch)
+        self.assertEquals(len(self.fetched), 2)
+        self.assertEquals(
+            [os.path.basename(p) for p in written],
+            ['recepcion.wsdl', 'recepcion_1.xsd'])
+        with open(sri_sender.get_wsdl_path('pruebas', 'recepcion')) as f:
+            content = f.read()
+        self.assertIn('schemaLocation="recepcion_1.xsd"', content)
+        self.assertTrue(sri_sender.get_wsdl_url('pruebas', 'recepcion')
+                        .startswith('file:'))
+
+    def test_missing(self):
+        with self.assertRaises(sri_sender.MissingWSDL):
+            sri_sender.enviar_comprobante("<xml></xml>")
+        self.assertEquals(self.fetched, [])
+        sri_sender.refresh_wsdl('pruebas', 'recepcion', self.fetch)
+        with self.assertRaises(sri_sender.MissingWSDL):
+            sri_sender.check_wsdls()
+
+    def test_client_reused(self):
+        sri_sender.refresh_wsdl('pruebas', 'recepcion', self.fetch)
+        client = sri_sender.get_client('pruebas', 'recepcion')
+        self.assertIs(client, sri_sender.get_client('pruebas', 'recepcion'))
+
+        other_threads = []
+        thread = threading.Thread(target=lambda: other_threads.append(
+            sri_sender.get_client('pruebas', 'recepcion')))
+        thread.start()
+        thread.join()
+        # Each thread gets its own client sharing the parsed WSDL
+        self.assertIsNot(client, other_threads[0])
+        self.assertIs(client.wsdl, other_threads[0].wsdl)
+
+    def test_keep_alive(self):
+        sri_sender.refresh_wsdl('pruebas', 'recepcion', self.fetch)
+        for i in range(3):
+            res = sri_sender.enviar_comprobante("<xml></xml>")
+            self.assertEquals(res, 'RECIBIDA')
+        self.assertEquals(len(SOAPHandler.connections), 1)
+
+    def test_reconnect(self):
+        sri_sender.refresh_wsdl('pruebas', 'recepcion', self.fetch)
+        SOAPHandler.close_idle = True
+        for i in range(2):
+            res = sri_sender.enviar_comprobante("<xml></xml>")
+            self.assertEquals(res, 'RECIBIDA')
+        self.assertEquals(len(SOAPHandler.connections), 2)
+        self.assertEquals(len(SOAPHandler.posts), 2)
+
+    def test_timeout_not_retried(self):
+        sri_sender.refresh_wsdl('pruebas', 'recepcion', self.fetch)
+        client = sri_sender.get_client('pruebas', 'recepcion')
+        client.options.transport.options.timeout = 0.2
+        sri_sender.enviar_comprobante("<xml></xml>")
+        SOAPHandler.delay = 0.5
+        with self.assertRaises(socket.timeout):
+            sri_sender.enviar_comprobante("<xml></xml>")
+        time.sleep(0.5)
+        # Sent once, the SRI may have taken it
+        self.assertEquals(len(SOAPHandler.posts), 2)
+
+
+class AutorizarComprobantesTests(TestCase):
+    """
+    Checks the concurrent authorization of many claves
+    """
+    def setUp(self):
+        self.orig_autorizar = sri_sender.autorizar_comprobante
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.threads = set()
+
+    def tearDown(self):
+        sri_sender.autorizar_comprobante = self.orig_autorizar
+
+    def autorizar(self, clave_acceso, entorno='pruebas'):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self.threads.add(threading.current_thread())
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        if clave_acceso == 'error':
+            raise ValueError(clave_acceso)
+        return (clave_acceso, entorno)
+
+    def test_autorizar_comprobantes(self):
+        sri_sender.autorizar_comprobante = self.autorizar
+        claves = [str(i) for i in range(20)] + ['1', 'error']
+        res = sri_sender.autorizar_comprobantes(claves, entorno='pruebas')
+        self.assertEquals(len(res), 21)
+        self.assertEquals(res['7'], ('7', 'pruebas'))
+        self.assertIsInstance(res['error'], ValueError)
+        self.assertTrue(1 < self.max_running <= sri_sender.max_concurrency['pruebas'])
+
+    def test_pool_reused(self):
+        sri_sender.autorizar_comprobante = self.autorizar
+        claves = [str(i) for i in range(20)]
+        sri_sender.autorizar_comprobantes(claves, entorno='pruebas')
+        threads = self.threads
+        self.threads = set()
+        sri_sender.autorizar_comprobantes(claves, entorno='pruebas')
+        # The same threads, with their clients
+        self.assertTrue(self.threads <= threads)
+        self.assertIs(sri_sender.get_pool('pruebas'),
+                      sri_sender.get_pool('pruebas'))
+
+    def test_pool_after_fork(self):
+        pool = sri_sender.get_pool('pruebas')
+        orig_pid = sri_sender._pools_pid[0]
+        # As seen by a forked process
+        sri_sender._pools_pid[0] = -1
+        new_pool = sri_sender.get_pool('pruebas')
+        try:
+            self.assertIsNot(new_pool, pool)
+        finally:
+            new_pool.close()
+            sri_sender._pools_pid[0] = orig_pid
+            sri_sender._pools['pruebas'] = pool
@@ -230,6 +230,48 @@ def gen_respuesta_autorizacion_comprobante_valido(
     return mock
 
 
+################################################
+# respuestaLote                                #
+################################################
+def gen_respuesta_autorizacion_lote(clave_acceso_lote, comprobantes,
+                                    fecha_autorizacion=datetime.datetime(2015, 9, 23, 1, 51, 56)):
+    """
+    (respuestaLote){
+       claveAccesoLoteConsultada = "2209201501170439497000120021000000146680001466819"
+       numeroComprobantesLote = "2"
+       autorizaciones =
+          (autorizaciones){
+             autorizacion[] =
+                (autorizacion){
+                   estado = "AUTORIZADO"
+                   numeroAutorizacion = "2309201501515617043949700019460282211"
+                   fechaAutorizacion = 2015-09-23 01:51:56
+                   ambiente = "PRUEBAS"
+                   comprobante = "[[ comprobante ]]"
+                   mensajes = ""
+                },
+          }
+     }
+    comprobantes are the XMLs of the authorized comprobantes
+    """
+    mock = GenericObject()
+    mock.claveAccesoLoteConsultada = clave_acceso_lote
+    mock.numeroComprobantesLote = str(len(comprobantes))
+    mock.autorizaciones = GenericObject()
+    mock.autorizaciones.autorizacion = GenericList()
+    for i, comprobante in enumerate(comprobantes):
+        autorizacion = GenericObject()
+        autorizacion.estado = 'AUTORIZADO'
+        autorizacion.numeroAutorizacion = "23092015015156170439497000194602822{:02d}".format(i)
+        autorizacion.fechaAutorizacion = fecha_autorizacion
+        autorizacion.ambiente = 'PRUEBAS'
+        autorizacion.comprobante = comprobante
+        autorizacion.mensajes = ""
+        mock.autorizaciones.autorizacion.append(autorizacion)
+    mock._turn_read_only()
+    return mock
+
+
 class EnviarComprobanteMock(object):
     def __init__(self, response):
         self.response = response
@@ -298,6 +340,18 @@ def MockSRISender(enviar_response, autorizar_response):
     sri_sender.autorizar_comprobante = orig_autorizar_call
 
 
+@contextmanager
+def MockAutorizarLote(response):
+    """
+    Mocks the call
+    """
+    orig_autorizar_lote_call = sri_sender.autorizar_lote
+    mock = AutorizarComprobanteMock(response)
+    sri_sender.autorizar_lote = mock
+    yield mock
+    sri_sender.autorizar_lote = orig_autorizar_lote_call
+
+
 class SRISendMockTests(TestCase):
     def test_invalid_xml_response(self):
         clave_acceso = '2209201501170439497000120021000000146680001466819'
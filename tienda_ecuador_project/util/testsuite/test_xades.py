@@ -0,0 +1,165 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.fernet import Fernet
+from cryptography.x509.oid import NameOID
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from lxml import etree
+
+from util import signature, xades
+
+comprobantes_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))),
+    'comprobantes_electronicos')
+
+
+def make_p12(password):
+    """
+    PKCS#12 with a self signed certificate
+    """
+    backend = default_backend()
+    key = rsa.generate_private_key(65537, 2048, backend)
+    name = x509.Name([
+        x509.NameAttribute(NameOID.COUNTRY_NAME, u'EC'),
+        x509.NameAttribute(NameOID.COMMON_NAME, u'EMPRESA DE PRUEBAS'),
+    ])
+    cert = (x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(1313059319)
+            .not_valid_before(datetime.utcnow())
+            .not_valid_after(datetime.utcnow() + timedelta(days=1))
+            .sign(key, hashes.SHA256(), backend))
+    return pkcs12.serialize_key_and_certificates(
+        'test', key, cert, None,
+        serialization.BestAvailableEncryption(password))
+
+
+class XadesTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.password_key = Fernet.generate_key()
+        self.backend = xades.XadesBesBackend(self.directory,
+                                             self.password_key)
+        self.p12 = make_p12('secret')
+        with open(os.path.join(comprobantes_dir,
+                               'xml', '1.1.0', 'factura.xml')) as f:
+            self.xml = f.read()
+        self.schema = etree.XMLSchema(etree.parse(os.path.join(
+            comprobantes_dir, 'xsd', '1.1.0', 'factura_v1.1.0.xsd')))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sri_sample(self):
+        """
+        Checks the signature of a comprobante authorized by the SRI
+        """
+        tree = etree.parse(os.path.join(comprobantes_dir, 'examples',
+                                        '002-100-000014668.xml'))
+        comprobante = tree.find('comprobante').text.encode('utf-8')
+        self.assertTrue(xades.verify(comprobante))
+        self.assertFalse(xades.verify(
+            comprobante.replace('<propina>0</propina>',
+                                '<propina>1</propina>')))
+
+    def test_sign(self):
+        self.assertEquals(
+            self.backend.add_cert('1790000000001', 1, self.p12, 'secret'),
+            'ok')
+        self.assertTrue(self.backend.has_cert('1790000000001', 1))
+        signed = self.backend.sign('1790000000001', 1, self.xml)
+        self.assertTrue(xades.verify(signed))
+        self.assertTrue(self.schema.validate(etree.fromstring(signed)),
+                        self.schema.error_log)
+        # The parsed certificate is kept
+        certificate = self.backend.get_certificate('1790000000001', 1)
+        self.assertIs(self.backend.get_certificate('1790000000001', 1),
+                      certificate)
+        signed = self.backend.sign_batch([('1790000000001', 1, self.xml),
+                                          ('1790000000001', 2, self.xml)])
+        self.assertTrue(xades.verify(signed[0]))
+        self.assertIsInstance(signed[1], signature.SignError)
+
+    def test_password_encrypted(self):
+        self.backend.add_cert('1790000000001', 1, self.p12, 'secret')
+        with open(self.backend.path('1790000000001', 1, 'key'), 'rb') as f:
+            stored = f.read()
+        self.assertNotIn('secret', stored)
+        self.assertEquals(Fernet(self.password_key).decrypt(stored), 'secret')
+        # Another key can not read it
+        backend = xades.XadesBesBackend(self.directory, Fernet.generate_key())
+        with self.assertRaises(Exception):
+            backend.get_certificate('1790000000001', 1)
+
+    def test_plain_password(self):
+        """
+        The passwords written before they were encrypted
+        are encrypted when they are read
+        """
+        self.backend.add_cert('1790000000001', 1, self.p12, 'secret')
+        self.backend.write('1790000000001', 1, 'key', 'secret')
+        backend = xades.XadesBesBackend(self.directory, self.password_key)
+        self.assertTrue(backend.has_cert('1790000000001', 1))
+        with open(self.backend.path('1790000000001', 1, 'key'), 'rb') as f:
+            self.assertEquals(Fernet(self.password_key).decrypt(f.read()),
+                              'secret')
+
+    def test_wrong_password(self):
+        self.assertNotEquals(
+            self.backend.add_cert('1790000000001', 1, self.p12, 'wrong'),
+            'ok')
+        self.assertFalse(self.backend.has_cert('1790000000001', 1))
+        self.assertIsNone(self.backend.sign('1790000000001', 1, self.xml))
+
+    def test_del_cert(self):
+        self.backend.add_cert('1790000000001', 1, self.p12, 'secret')
+        self.backend.del_cert('1790000000001', 1)
+        self.assertFalse(self.backend.has_cert('1790000000001', 1))
+        self.assertEquals(os.listdir(self.directory), [])
+
+    def test_get_backend(self):
+        orig_backend = signature.backend
+        orig_cert_dir = xades.cert_dir
+        signature.backend = 'xades'
+        xades.cert_dir = self.directory
+        try:
+            with override_settings(CERT_PASSWORD_KEY=self.password_key):
+                signature.add_cert('1790000000001', 1, self.p12, 'secret')
+            self.assertIsInstance(signature.get_backend(),
+                                  xades.XadesBesBackend)
+            self.assertTrue(xades.verify(
+                signature.sign('1790000000001', 1, self.xml)))
+        finally:
+            signature.backend = orig_backend
+            xades.cert_dir = orig_cert_dir
+            signature._backends.pop('xades', None)
+
+    def test_settings_required(self):
+        with override_settings(CERT_DIR=None,
+                               CERT_PASSWORD_KEY=self.password_key):
+            with self.assertRaises(ImproperlyConfigured):
+                xades.XadesBesBackend()
+        with override_settings(CERT_DIR=os.path.join(settings.BASE_DIR, 'certs'),
+                               CERT_PASSWORD_KEY=self.password_key):
+            with self.assertRaises(ImproperlyConfigured):
+                xades.XadesBesBackend()
+        with override_settings(CERT_DIR=self.directory,
+                               CERT_PASSWORD_KEY=None):
+            with self.assertRaises(ImproperlyConfigured):
+                xades.XadesBesBackend()
+        with override_settings(CERT_DIR=self.directory,
+                               CERT_PASSWORD_KEY=self.password_key):
+            self.assertEquals(xades.XadesBesBackend().directory,
+                              os.path.realpath(self.directory))
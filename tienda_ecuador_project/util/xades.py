@@ -0,0 +1,322 @@
+"""
+XAdES-BES enveloped signatures of the comprobantes, as the SRI requires
+them, made inside the process instead of in the signer servers
+"""
+import base64
+import hashlib
+import os
+import random
+import threading
+from datetime import datetime
+
+import pytz
+from cryptography import x509
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.serialization import pkcs12
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from lxml import etree
+
+from util import signature
+from util.data_dirs import get_data_dir
+
+DS = 'http://www.w3.org/2000/09/xmldsig#'
+ETSI = 'http://uri.etsi.org/01903/v1.3.2#'
+NSMAP = {'ds': DS, 'etsi': ETSI}
+C14N = 'http://www.w3.org/TR/2001/REC-xml-c14n-20010315'
+RSA_SHA1 = DS + 'rsa-sha1'
+SHA1 = DS + 'sha1'
+ENVELOPED = DS + 'enveloped-signature'
+SIGNED_PROPERTIES = 'http://uri.etsi.org/01903#SignedProperties'
+
+# Directory with the certificates of the companies, a <ruc>_<company_id>.p12
+# and its .key with the password encrypted with CERT_PASSWORD_KEY.
+# The setting CERT_DIR when it is None
+cert_dir = None
+
+
+def get_cert_dir():
+    """
+    Raises ImproperlyConfigured when CERT_DIR is not set or is not usable
+    """
+    return cert_dir or get_data_dir('CERT_DIR')
+
+
+def get_password_key():
+    """
+    The Fernet key of the passwords of the certificates
+    """
+    if not getattr(settings, 'CERT_PASSWORD_KEY', None):
+        raise ImproperlyConfigured('The setting CERT_PASSWORD_KEY is required')
+    return settings.CERT_PASSWORD_KEY
+
+
+def b64(data):
+    """
+    base64 in lines of 76 characters, as the SRI samples
+    """
+    encoded = base64.b64encode(data)
+    return "\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+
+
+def int_to_b64(value):
+    data = ('%x' % value)
+    if len(data) % 2:
+        data = '0' + data
+    return b64(data.decode('hex'))
+
+
+def digest(data):
+    return base64.b64encode(hashlib.sha1(data).digest())
+
+
+def c14n(element):
+    """
+    Inclusive canonical form of element, with the namespaces
+    in scope in its document
+    """
+    return etree.tostring(element, method='c14n')
+
+
+def ds(tag):
+    return '{%s}%s' % (DS, tag)
+
+
+def etsi(tag):
+    return '{%s}%s' % (ETSI, tag)
+
+
+def sub(parent, tag, text=None, **attrib):
+    element = etree.SubElement(parent, tag, attrib)
+    if text is not None:
+        element.text = text
+    return element
+
+
+def add_reference(signed_info, uri, transform=None, **attrib):
+    reference = sub(signed_info, ds('Reference'), URI=uri, **attrib)
+    if transform:
+        transforms = sub(reference, ds('Transforms'))
+        sub(transforms, ds('Transform'), Algorithm=transform)
+    sub(reference, ds('DigestMethod'), Algorithm=SHA1)
+    return sub(reference, ds('DigestValue'))
+
+
+class Certificate(object):
+    """
+    Parsed certificate and key of a company, with the parts
+    of the signatures that only depend on them
+    """
+    def __init__(self, data, password):
+        key, cert, additional = pkcs12.load_key_and_certificates(
+            data, password, default_backend())
+        if key is None or cert is None:
+            raise signature.SignError("No key or certificate")
+        self.key = key
+        self.der = cert.public_bytes(serialization.Encoding.DER)
+        self.cert_b64 = b64(self.der)
+        self.cert_digest = digest(self.der)
+        self.issuer = cert.issuer.rfc4514_string()
+        self.serial = str(cert.serial_number)
+        numbers = key.public_key().public_numbers()
+        self.modulus = int_to_b64(numbers.n)
+        self.exponent = int_to_b64(numbers.e)
+
+    def sign(self, data):
+        return b64(self.key.sign(data, padding.PKCS1v15(), hashes.SHA1()))
+
+
+def sign_xml(xml, certificate, signing_time=None):
+    """
+    Appends to the comprobante the XAdES-BES signature of certificate.
+    The comprobantes of proformabill_xml.html have no namespaces,
+    comments nor DTD, so the enveloped-signature transform
+    is the canonical form of the document before signing.
+    The prefixes ds and etsi are declared once, in ds:Signature,
+    as the SRI samples do
+    """
+    root = etree.fromstring(signature.to_bytes(xml))
+    comprobante_digest = digest(c14n(root))
+    signing_time = signing_time or datetime.now(
+        tz=pytz.timezone('America/Guayaquil'))
+    n = random.randint(100000, 999999)
+    signature_id = 'Signature{}'.format(n)
+    signed_properties_id = '{}-SignedProperties{}'.format(signature_id, n)
+    certificate_id = 'Certificate{}'.format(n)
+    reference_id = 'Reference-ID-{}'.format(n)
+
+    signature_element = etree.SubElement(root, ds('Signature'),
+                                         {'Id': signature_id}, nsmap=NSMAP)
+    signed_info = sub(signature_element, ds('SignedInfo'),
+                      Id='Signature-SignedInfo{}'.format(n))
+    sub(signed_info, ds('CanonicalizationMethod'), Algorithm=C14N)
+    sub(signed_info, ds('SignatureMethod'), Algorithm=RSA_SHA1)
+    signed_properties_digest = add_reference(
+        signed_info, '#' + signed_properties_id,
+        Id='SignedPropertiesID{}'.format(n), Type=SIGNED_PROPERTIES)
+    certificate_digest = add_reference(signed_info, '#' + certificate_id)
+    add_reference(signed_info, '#comprobante', ENVELOPED,
+                  Id=reference_id).text = comprobante_digest
+    signature_value = sub(signature_element, ds('SignatureValue'),
+                          Id='SignatureValue{}'.format(n))
+
+    key_info = sub(signature_element, ds('KeyInfo'), Id=certificate_id)
+    x509_data = sub(key_info, ds('X509Data'))
+    sub(x509_data, ds('X509Certificate'), certificate.cert_b64)
+    rsa_key_value = sub(sub(key_info, ds('KeyValue')), ds('RSAKeyValue'))
+    sub(rsa_key_value, ds('Modulus'), certificate.modulus)
+    sub(rsa_key_value, ds('Exponent'), certificate.exponent)
+
+    signature_object = sub(signature_element, ds('Object'),
+                           Id='{}-Object{}'.format(signature_id, n))
+    qualifying_properties = sub(signature_object,
+                                etsi('QualifyingProperties'),
+                                Target='#' + signature_id)
+    signed_properties = sub(qualifying_properties, etsi('SignedProperties'),
+                            Id=signed_properties_id)
+    signed_signature_properties = sub(signed_properties,
+                                      etsi('SignedSignatureProperties'))
+    sub(signed_signature_properties, etsi('SigningTime'),
+        signing_time.replace(microsecond=0).isoformat())
+    cert = sub(sub(signed_signature_properties, etsi('SigningCertificate')),
+               etsi('Cert'))
+    cert_digest = sub(cert, etsi('CertDigest'))
+    sub(cert_digest, ds('DigestMethod'), Algorithm=SHA1)
+    sub(cert_digest, ds('DigestValue'), certificate.cert_digest)
+    issuer_serial = sub(cert, etsi('IssuerSerial'))
+    sub(issuer_serial, ds('X509IssuerName'), certificate.issuer)
+    sub(issuer_serial, ds('X509SerialNumber'), certificate.serial)
+    data_object_format = sub(
+        sub(signed_properties, etsi('SignedDataObjectProperties')),
+        etsi('DataObjectFormat'), ObjectReference='#' + reference_id)
+    sub(data_object_format, etsi('Description'), 'contenido comprobante')
+    sub(data_object_format, etsi('MimeType'), 'text/xml')
+
+    signed_properties_digest.text = digest(c14n(signed_properties))
+    certificate_digest.text = digest(c14n(key_info))
+    signature_value.text = certificate.sign(c14n(signed_info))
+    return etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+
+
+def verify(xml):
+    """
+    True if the references and the value of the signature
+    of the comprobante match
+    """
+    root = etree.fromstring(signature.to_bytes(xml))
+    signature_element = root.find(ds('Signature'))
+    if signature_element is None:
+        return False
+    for reference in signature_element.iter(ds('Reference')):
+        uri = reference.get('URI')[1:]
+        if reference.find('.//' + ds('Transform')) is not None:
+            # Enveloped signature
+            index = root.index(signature_element)
+            root.remove(signature_element)
+            data = c14n(root)
+            root.insert(index, signature_element)
+        else:
+            found = root.xpath('//*[@Id=$id or @id=$id]', id=uri)
+            if not found:
+                return False
+            data = c14n(found[0])
+        if digest(data) != reference.find(ds('DigestValue')).text:
+            return False
+    cert = x509.load_der_x509_certificate(
+        base64.b64decode(signature_element.find('.//' + ds('X509Certificate')).text),
+        default_backend())
+    try:
+        cert.public_key().verify(
+            base64.b64decode(signature_element.find(ds('SignatureValue')).text),
+            c14n(signature_element.find(ds('SignedInfo'))),
+            padding.PKCS1v15(), hashes.SHA1())
+    except Exception:
+        return False
+    return True
+
+
+class XadesBesBackend(signature.Backend):
+    """
+    Signs in the process, with the certificates kept in cert_dir.
+    The parsed certificates are cached by company,
+    and parsed again when their files change
+    """
+    def __init__(self, directory=None, password_key=None):
+        self.directory = directory or get_cert_dir()
+        self.fernet = Fernet(password_key or get_password_key())
+        self.lock = threading.Lock()
+        # (ruc, company_id) -> (modification time, Certificate)
+        self.certificates = {}
+
+    def path(self, ruc, company_id, extension):
+        return os.path.join(self.directory,
+                            '{}_{}.{}'.format(ruc, company_id, extension))
+
+    def add_cert(self, ruc, company_id, cert, key):
+        try:
+            Certificate(cert, signature.to_bytes(key))
+        except Exception as e:
+            return 'error {}'.format(e)
+        self.write(ruc, company_id, 'key',
+                   self.fernet.encrypt(signature.to_bytes(key)))
+        self.write(ruc, company_id, 'p12', signature.to_bytes(cert))
+        with self.lock:
+            self.certificates.pop((ruc, company_id), None)
+        return 'ok'
+
+    def write(self, ruc, company_id, extension, data):
+        path = self.path(ruc, company_id, extension)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+    def del_cert(self, ruc, company_id):
+        for extension in ('p12', 'key'):
+            try:
+                os.remove(self.path(ruc, company_id, extension))
+            except OSError:
+                pass
+        with self.lock:
+            self.certificates.pop((ruc, company_id), None)
+        return 'ok'
+
+    def get_certificate(self, ruc, company_id):
+        """
+        Certificate of the company, None if it has none
+        """
+        path = self.path(ruc, company_id, 'p12')
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        with self.lock:
+            cached = self.certificates.get((ruc, company_id))
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(self.path(ruc, company_id, 'key'), 'rb') as f:
+            stored = f.read()
+        try:
+            password = self.fernet.decrypt(stored)
+        except InvalidToken:
+            # Written before the passwords were encrypted
+            password = stored
+        certificate = Certificate(data, password)
+        if password is stored:
+            self.write(ruc, company_id, 'key', self.fernet.encrypt(password))
+        with self.lock:
+            self.certificates[(ruc, company_id)] = (mtime, certificate)
+        return certificate
+
+    def has_cert(self, ruc, company_id):
+        return self.get_certificate(ruc, company_id) is not None
+
+    def sign(self, ruc, company_id, xml):
+        certificate = self.get_certificate(ruc, company_id)
+        if certificate is None:
+            return None
+        return sign_xml(xml, certificate)